@@ -0,0 +1,227 @@
+"""Measures the API calls, bytes and wall time of run.py commands against
+fake_calendar_server.py, and appends the results to a JSONL file so they can
+be compared over time.
+
+    python benchmark.py --events 100000 --latency 0.05
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import httplib2
+from googleapiclient.discovery import build_from_document
+
+import run
+from event_store import EventStore
+from fake_calendar_server import FakeCalendarServer, start_server
+
+
+class Counts:
+    """Round trips and bytes, shared by a CountingHttp and its copies."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+
+    def add(self, received, sent):
+        with self.lock:
+            self.calls += 1
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+
+class CountingHttp(httplib2.Http):
+    """httplib2.Http that counts round trips and bytes. The copies that
+    run.worker_service makes for worker threads add to the same counts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counts = Counts()
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        response, content = super().request(uri, method, body, headers, *args, **kwargs)
+        self.counts.add(len(content or b''), len(body or b''))
+        return response, content
+
+
+def build_fake_service(port):
+    discovery = json.loads(run.load_discovery())
+    discovery['rootUrl'] = f'http://127.0.0.1:{port}/'
+    http = CountingHttp(timeout=60)
+    run.load_client_libraries()
+    from instrumented_http import InstrumentedRequest
+    return build_from_document(discovery, http=http, requestBuilder=InstrumentedRequest), http
+
+
+def commands(year, month):
+    """Returns (name, function(service)) pairs for the commands to measure."""
+    calendar_id = 'primary'
+    first = datetime.date(year, month, 1)
+    next_month = (first + datetime.timedelta(days=32)).replace(day=1)
+    created = []
+
+    def add(service):
+        run.create_event(service, calendar_id, 'benchmark', f'{year}', f'{month:02d}', '15', '10:00', '11:00')
+
+    def rm(service):
+        ids = [f'syn{i:07d}' for i in range(len(created) * 3 + 1, len(created) * 3 + 4)]
+        created.append(ids)
+        run.remove_events(service, calendar_id, ids)
+
+    return [
+        ('ls', lambda service: run.list_events_by_date(service, calendar_id, year, month, 15)),
+        ('ls -1', lambda service: run.get_one_week_events(service, calendar_id, year, month, 1)),
+        ('ls -Mon', lambda service: run.get_week_events(service, calendar_id, year, month, 'Mon')),
+        ('ls YYYY/MM/', lambda service: run.list_events_range(service, calendar_id, first, next_month)),
+        ('ls path path path', lambda service: run.list_events_by_dates(
+            service, calendar_id, [(year, month, 1), (year, month, 20), (year + 1, month, 1)])),
+        ('add', add),
+        ('rm id id id', rm),
+    ]
+
+
+def reset_state(store_path):
+    run.day_cache.clear()
+    run.day_cache.hits = run.day_cache.misses = 0
+    run.interval_indexes.clear()
+    run.event_calendars.clear()
+    if store_path is not None:
+        run.event_store.mark_stale('primary')
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_projection_comparison(results, projections):
+    """Prints the decoded and wire bytes of each command relative to the
+    first projection.
+    """
+    base = {result['command']: result for result in results if result['projection'] == projections[0]}
+    print()
+    print(f'bytes relative to {projections[0]}')
+    for result in results:
+        first = base[result['command']]
+        if result['projection'] == projections[0] or not first['bytes']:
+            continue
+        print(f'{result["command"].ljust(20)} {result["projection"][:8].ljust(8)} '
+              f'bytes x{result["bytes"] / first["bytes"]:.2f} '
+              f'wire x{result["wire_bytes"] / max(first["wire_bytes"], 1):.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark run.py against a fake Calendar API')
+    parser.add_argument('--events', type=int, default=10000, help='synthetic events in the calendar')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every request')
+    parser.add_argument('--page-size', type=int, default=250)
+    parser.add_argument('--quota-error-rate', type=float, default=0.0)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='requests per second allowed by the scheduler (0: unlimited)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--store', action='store_true', help='serve listings from a synced event store')
+    parser.add_argument('--projections', default='minimal',
+                        help='comma separated listing projections to compare (e.g. minimal,full)')
+    parser.add_argument('--no-gzip', action='store_true', help='let the fake server send uncompressed responses')
+    parser.add_argument('--recurring', type=int, default=0, help='recurring events in the calendar')
+    parser.add_argument('--recurrence', choices=('server', 'local'), default='server',
+                        help='with --store, who expands recurring events')
+    parser.add_argument('--output', default='bench_results.jsonl', help='JSONL file the results are appended to')
+    args = parser.parse_args()
+    run.scheduler.rate = args.rate
+
+    fake = FakeCalendarServer(args.events, latency=args.latency, page_size=args.page_size,
+                              quota_error_rate=args.quota_error_rate, gzip=not args.no_gzip,
+                              recurring=args.recurring)
+    server = start_server(fake)
+    service, http = build_fake_service(server.server_address[1])
+
+    store_dir = None
+    sync = None
+    if args.store:
+        store_dir = tempfile.TemporaryDirectory()
+        run.event_store = EventStore(os.path.join(store_dir.name, 'events.db'))
+        run.event_store.set_expand_recurrence(args.recurrence == 'local')
+        sent = fake.bytes_sent
+        started = time.perf_counter()
+        run.event_store.sync(service, 'primary')
+        sync = {'calls': http.counts.calls, 'bytes': http.counts.bytes_received, 'wire_bytes': fake.bytes_sent - sent,
+                'ms': (time.perf_counter() - started) * 1000}
+        print(f'initial sync: {sync["calls"]} calls {sync["bytes"]} bytes '
+              f'{sync["wire_bytes"]} wire bytes {sync["ms"]:.0f} ms')
+    else:
+        run.event_store = None
+
+    projections = args.projections.split(',')
+    results = []
+    print(f'{"command".ljust(20)} {"fields".ljust(8)} {"calls".rjust(6)} {"bytes".rjust(10)} '
+          f'{"wire".rjust(10)} {"ms".rjust(9)}')
+    for projection in projections:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run.set_list_projection(projection)
+        for name, command in commands(2024, 5):
+            calls = bytes_received = wire_bytes = 0
+            elapsed = []
+            for _ in range(args.repeat):
+                reset_state(store_dir)
+                http.counts.reset()
+                sent = fake.bytes_sent
+                started = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    command(service)
+                elapsed.append(time.perf_counter() - started)
+                calls += http.counts.calls
+                bytes_received += http.counts.bytes_received
+                wire_bytes += fake.bytes_sent - sent
+            result = {
+                'command': name,
+                'projection': projection,
+                'calls': calls / args.repeat,
+                'bytes': bytes_received / args.repeat,
+                'wire_bytes': wire_bytes / args.repeat,
+                'ms': min(elapsed) * 1000,
+            }
+            results.append(result)
+            print(f'{name.ljust(20)} {projection[:8].ljust(8)} {result["calls"]:6.1f} {result["bytes"]:10.0f} '
+                  f'{result["wire_bytes"]:10.0f} {result["ms"]:9.1f}')
+    if len(projections) > 1:
+        print_projection_comparison(results, projections)
+
+    record = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'events': args.events,
+        'latency': args.latency,
+        'page_size': args.page_size,
+        'quota_error_rate': args.quota_error_rate,
+        'rate': args.rate,
+        'store': args.store,
+        'gzip': not args.no_gzip,
+        'recurring': args.recurring,
+        'recurrence': args.recurrence if args.store else 'server',
+        'sync': sync,
+        'results': results,
+    }
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""Background daemon that keeps the authenticated session, the connection
+pool and the event caches of run.py warm between commands.
+
+Clients (mygcal) send one JSON line per command over a Unix socket and get
+the output of the command and the new prompt back. Each client session (one
+per terminal) has its own current directory and prefetcher, and all of them
+share the caches. Commands run one at a time on the main thread, like the
+prompt of run.py, so they use the service and its keep-alive connection
+directly and their output can be captured from stdout.
+
+    python daemon.py            # mygcal starts it on first use
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+# 最後のコマンドからこの秒数が経つとデーモンを終了する
+IDLE_TIMEOUT = 60 * 60
+
+
+def socket_path():
+    """Returns the path of the socket, in a directory only the user can use:
+    $XDG_RUNTIME_DIR, or otherwise a 0700 directory of the user in the
+    temporary directory, so another user cannot create the socket first.
+    """
+    runtime_directory = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_directory:
+        return os.path.join(runtime_directory, f'mygcal-{os.getuid()}.sock')
+    directory = os.path.join(tempfile.gettempdir(), f'mygcal-{os.getuid()}')
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        sys.exit(f"Error: {directory} is not a directory private to you. Remove it or set XDG_RUNTIME_DIR")
+    return os.path.join(directory, 'mygcal.sock')
+
+
+class Sessions:
+    """The shells of the connected terminals. They share the service, and
+    each has its own prefetcher so that moving in one terminal does not
+    cancel the prefetch of another.
+    """
+
+    def __init__(self, run, service):
+        self.run = run
+        self.service = service
+        self.shells = {}
+        self.commands = queue.Queue()
+        self.last_command = time.monotonic()
+
+    def execute(self, session, command, stdin=''):
+        """Queues a command from a connection thread and waits for the
+        response. stdin is what the command reads as its standard input
+        (the script of run_script -).
+        """
+        future = Future()
+        self.commands.put((session, command, stdin, future))
+        return future.result()
+
+    def run_forever(self):
+        """Runs the queued commands until stop() is called."""
+        while True:
+            item = self.commands.get()
+            if item is None:
+                return
+            session, command, stdin, future = item
+            try:
+                future.set_result(self.run_command(session, command, stdin))
+            except Exception as e:
+                future.set_result({'output': f"Error: {e}\n", 'prompt': '', 'exit': False})
+
+    def run_command(self, session, command, stdin=''):
+        self.last_command = time.monotonic()
+        shell = self.shells.get(session)
+        if shell is None:
+            shell = self.shells[session] = self.run.Shell(self.service)
+        output = io.StringIO()
+        started = time.perf_counter()
+        # デーモン自身の標準入力ではなく、クライアントから送られた入力を読ませる
+        stdin, sys.stdin = sys.stdin, io.StringIO(stdin)
+        try:
+            with contextlib.redirect_stdout(output):
+                running = shell.execute(command)
+        finally:
+            sys.stdin = stdin
+        if command:
+            self.run.stats.record('command', command.split(' ')[0], time.perf_counter() - started)
+        return {'output': output.getvalue(), 'prompt': shell.prompt(), 'exit': not running}
+
+    def stop(self):
+        self.commands.put(None)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Answers the JSON lines of one client connection until it closes."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.reply({'output': "Error: invalid request\n", 'exit': True})
+                return
+            if request.get('stop'):
+                self.server.sessions.stop()
+                self.reply({'output': "Daemon stopped\n", 'exit': True})
+                return
+            self.reply(self.server.sessions.execute(
+                str(request.get('session')), request.get('command', ''), request.get('stdin') or ''))
+
+    def reply(self, response):
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def remove_stale_socket(path):
+    """Removes the socket of a daemon that is no longer running. Returns
+    False when a daemon is still listening on it.
+    """
+    if not os.path.exists(path):
+        return True
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return False
+    except OSError:
+        os.unlink(path)
+        return True
+    finally:
+        probe.close()
+
+
+def stop_when_idle(sessions, idle_timeout):
+    while True:
+        time.sleep(min(idle_timeout, 60))
+        if time.monotonic() - sessions.last_command > idle_timeout:
+            sessions.stop()
+            return
+
+
+def serve(path, idle_timeout=IDLE_TIMEOUT, trace=None):
+    """Opens the store, starts the session like run.py and serves clients
+    until stopped or idle for idle_timeout seconds.
+    """
+    if not remove_stale_socket(path):
+        print(f"Error: a daemon is already listening on {path}")
+        return
+    # Googleのクライアントライブラリはデーモンでだけ読み込む
+    import run
+    from event_store import EventStore
+    from mutation_queue import MutationQueue, Replayer
+
+    if trace:
+        run.stats.open_trace(trace)
+    run.event_store = EventStore(run.STORE_FILE)
+    run.mutation_queue = MutationQueue(run.event_store)
+    service = run.start_session()
+    run.replayer = Replayer(run.mutation_queue, lambda mutation: run.apply_mutation(service, mutation))
+
+    # ソケットは本人だけが読み書きできるように作る
+    umask = os.umask(0o177)
+    try:
+        server = DaemonServer(path, RequestHandler)
+    finally:
+        os.umask(umask)
+    server.sessions = Sessions(run, service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    threading.Thread(target=stop_when_idle, args=(server.sessions, idle_timeout), daemon=True).start()
+    print(f"Listening on {path}", flush=True)
+    try:
+        server.sessions.run_forever()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+        run.event_store.close()
+        run.stats.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep a run.py session warm for mygcal')
+    parser.add_argument('--socket', default=socket_path(), help='path of the Unix socket')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='seconds without commands before the daemon exits')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='append a JSON line for every API call and command to FILE')
+    args = parser.parse_args()
+    serve(args.socket, args.idle_timeout, args.trace)
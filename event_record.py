@@ -0,0 +1,116 @@
+import datetime
+import sys
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+JST_OFFSET = 9 * 60 * 60
+DAY = 24 * 60 * 60
+# 1970-01-01の序数 (エポックからの日数をdateに変換する)
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# 表示する列の幅
+TIME_WIDTH = 12
+SUMMARY_WIDTH = 30
+
+
+class EventRecord:
+    """Compact event used by the listing views, the day cache and the
+    interval index.
+
+    The API resource is parsed once into epoch seconds, so listing never
+    parses dateTime strings again. Summaries and calendar ids repeat a lot
+    (recurring events) and are interned. calendar_id is set only in the
+    multi-calendar view, where the calendar is shown after the id.
+    """
+
+    __slots__ = ('id', 'summary', 'start', 'end', 'all_day', 'calendar_id')
+
+    def __init__(self, id, summary, start, end, all_day, calendar_id=None):
+        self.id = id
+        self.summary = summary
+        self.start = start
+        self.end = end
+        self.all_day = all_day
+        self.calendar_id = calendar_id
+
+    @classmethod
+    def from_resource(cls, event):
+        """Builds a record from an events resource (dict)."""
+        start = event.get('start', {})
+        end = event.get('end', {})
+        if 'dateTime' in start:
+            start_ts = parse_datetime(start['dateTime'])
+            end_ts = parse_datetime(end.get('dateTime', start['dateTime']))
+            all_day = False
+        else:
+            start_ts = parse_date(start.get('date', '1970-01-01'))
+            end_ts = parse_date(end['date']) if 'date' in end else start_ts + DAY
+            all_day = True
+        return cls(event.get('id', ''), sys.intern(event.get('summary', '')), start_ts, end_ts, all_day)
+
+    def with_calendar(self, calendar_id):
+        """Returns a copy tagged with calendar_id. Records are shared with the
+        day cache and the interval index, so they are never tagged in place.
+        """
+        return EventRecord(self.id, self.summary, self.start, self.end, self.all_day, calendar_id)
+
+    def day_ordinals(self):
+        """Returns the date ordinals of the first and the last JST day the
+        event covers. Events ending exactly at 0:00 (and all-day events) end
+        on the previous day.
+        """
+        first = EPOCH_ORDINAL + (self.start + JST_OFFSET) // DAY
+        last = EPOCH_ORDINAL + (max(self.end - 1, self.start) + JST_OFFSET) // DAY
+        return first, last
+
+    def first_day(self):
+        return datetime.date.fromordinal(self.day_ordinals()[0])
+
+    def last_day(self):
+        return datetime.date.fromordinal(self.day_ordinals()[1])
+
+    def days(self):
+        first, last = self.day_ordinals()
+        return [datetime.date.fromordinal(n) for n in range(first, last + 1)]
+
+    def __repr__(self):
+        return f'EventRecord({self.id!r}, {self.summary!r}, {self.start}, {self.end}, {self.all_day})'
+
+
+def parse_datetime(value):
+    """Parses an RFC 3339 dateTime into epoch seconds. Values without an
+    offset are taken as JST.
+    """
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=JST)
+    return int(dt.timestamp())
+
+
+def parse_date(value):
+    """Returns the epoch seconds of JST midnight of a YYYY-MM-DD date."""
+    return (datetime.date.fromisoformat(value).toordinal() - EPOCH_ORDINAL) * DAY - JST_OFFSET
+
+
+def clock(ts):
+    seconds = (ts + JST_OFFSET) % DAY
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}'
+
+
+def format_events(events, label=None):
+    """Formats events as lines of "time summary id" in one pass and returns
+    them as one string. label(calendar_id) adds the calendar of each event in
+    the multi-calendar view.
+    """
+    lines = []
+    for event in events:
+        if event.all_day:
+            time_range = 'All Day'
+        else:
+            time_range = f'{clock(event.start)}~{clock(event.end)}'
+        event_id = event.id
+        if label is not None and event.calendar_id is not None:
+            event_id = f'{event_id} ({label(event.calendar_id)})'
+        lines.append(f'{time_range:<{TIME_WIDTH}} {event.summary:<{SUMMARY_WIDTH}} {event_id}\n')
+    return ''.join(lines)
@@ -0,0 +1,430 @@
+import datetime
+import heapq
+import json
+import sqlite3
+import threading
+import time
+
+import pytz
+from googleapiclient.errors import HttpError
+
+from recurrence import Recurrence, UnsupportedRecurrence, expand, original_start_ts, parse_instance_id
+from search_index import bigrams, event_text, matches, query_terms
+
+# 前回の同期からこの秒数が経つまではネットワークに問い合わせない
+SYNC_INTERVAL = 60
+# 同期で取得するフィールド (fields=による部分レスポンス)。表示・検索・繰り返しの展開に使うものと、
+# 削除の判定に使うstatus、編集のIf-Matchに使うetagだけを保存する
+SYNC_ITEM_FIELDS = ('items(id,etag,status,summary,description,location,start,end,'
+                    'recurrence,recurringEventId,originalStartTime)')
+SYNC_FIELDS = f'etag,nextPageToken,nextSyncToken,{SYNC_ITEM_FIELDS}'
+INSTANCE_FIELDS = f'nextPageToken,{SYNC_ITEM_FIELDS}'
+
+
+def event_range(event):
+    """Returns the (start, end) epoch seconds of an event, in JST for all-day events."""
+    jst = pytz.timezone('Asia/Tokyo')
+    bounds = []
+    for key in ('start', 'end'):
+        value = event.get(key, {})
+        if 'dateTime' in value:
+            bounds.append(datetime.datetime.fromisoformat(value['dateTime']).timestamp())
+        elif 'date' in value:
+            day = datetime.datetime.strptime(value['date'], '%Y-%m-%d')
+            bounds.append(jst.localize(day).timestamp())
+        else:
+            bounds.append(bounds[0] if bounds else 0)
+    return bounds[0], max(bounds)
+
+
+def locked(method):
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class EventStore:
+    """SQLite store of events keyed by calendar id and event id.
+
+    It is filled by a full sync and kept current with syncToken incremental
+    syncs, so listings can be answered without calling the API.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # 複数のカレンダーを並行して同期するためのロック
+        self.lock = threading.RLock()
+        # カレンダーid -> 最後に同期した一覧のetag (次の差分同期のIf-None-Matchに使う)
+        self.list_etags = {}
+        self.revalidated = 0
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS events (
+                calendar_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                start_ts REAL NOT NULL,
+                end_ts REAL NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (calendar_id, event_id)
+            );
+            CREATE INDEX IF NOT EXISTS events_range
+                ON events (calendar_id, start_ts, end_ts);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                calendar_id TEXT PRIMARY KEY,
+                sync_token TEXT,
+                synced_at REAL
+            );
+            -- 繰り返し予定の親 (ローカルで展開する場合)。until_tsは最後の回の終了時刻
+            CREATE TABLE IF NOT EXISTS recurring_events (
+                calendar_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                start_ts REAL NOT NULL,
+                until_ts REAL NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (calendar_id, event_id)
+            );
+            -- 個別に変更・削除された回の元の開始時刻 (展開から除く)
+            CREATE TABLE IF NOT EXISTS recurrence_overrides (
+                calendar_id TEXT NOT NULL,
+                master_id TEXT NOT NULL,
+                original_start_ts REAL NOT NULL,
+                PRIMARY KEY (calendar_id, master_id, original_start_ts)
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        row = self.conn.execute("SELECT value FROM settings WHERE key = 'expand_recurrence'").fetchone()
+        self.expand_recurrence = bool(row and row[0] == '1')
+        has_index = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_terms'").fetchone()
+        # 予定の文字bigramの転置索引
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS search_terms (
+                term TEXT NOT NULL,
+                calendar_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                PRIMARY KEY (term, calendar_id, event_id)
+            ) WITHOUT ROWID''')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS search_terms_event ON search_terms (calendar_id, event_id)')
+        if not has_index:
+            self.rebuild_index()
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    @locked
+    def set_expand_recurrence(self, expand_recurrence):
+        """Switches between instances expanded by the server (singleEvents)
+        and recurring events expanded locally. Every calendar is fully
+        synced again on its next listing.
+        """
+        if expand_recurrence == self.expand_recurrence:
+            return
+        self.expand_recurrence = expand_recurrence
+        self.conn.execute("INSERT OR REPLACE INTO settings VALUES ('expand_recurrence', ?)",
+                          ('1' if expand_recurrence else '0',))
+        self.conn.execute('DELETE FROM sync_state')
+        self.conn.commit()
+        self.list_etags.clear()
+
+    @locked
+    def upsert(self, calendar_id, event, commit=True):
+        """Stores an event. Recurring events (with recurrence) are kept as
+        masters only when the store expands them locally, and raise
+        UnsupportedRecurrence when they cannot be; otherwise their instances
+        come from the server and the master is not stored.
+        """
+        if 'recurrence' in event:
+            if not self.expand_recurrence:
+                return
+            recurrence = Recurrence(event)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO recurring_events VALUES (?, ?, ?, ?, ?)',
+                (calendar_id, event['id'], event_range(event)[0], recurrence.series_end(),
+                 json.dumps(event, ensure_ascii=False)))
+            self._index(calendar_id, event)
+            if commit:
+                self.conn.commit()
+            return
+        if 'recurringEventId' in event and 'originalStartTime' in event:
+            self._override(calendar_id, event)
+        start_ts, end_ts = event_range(event)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)',
+            (calendar_id, event['id'], start_ts, end_ts, json.dumps(event, ensure_ascii=False)))
+        self._index(calendar_id, event)
+        if commit:
+            self.conn.commit()
+
+    def store_server_event(self, service, calendar_id, event):
+        """Stores an event returned by the API (insert, patch) the way a sync
+        does: a master whose rule cannot be expanded locally is replaced by
+        its instances as expanded by the server, and with expansion off the
+        calendar is synced again for the changed instances.
+        """
+        if 'recurrence' in event and not self.expand_recurrence:
+            self.mark_stale(calendar_id)
+            return
+        try:
+            self.upsert(calendar_id, event)
+        except UnsupportedRecurrence:
+            self._sync_instances(service, calendar_id, event)
+            with self.lock:
+                self.conn.commit()
+
+    @locked
+    def delete(self, calendar_id, event_id, commit=True):
+        """Deletes an event. Deleting a recurring event also deletes its
+        stored instances and exceptions, whose ids start with "{event_id}_".
+        Deleting an instance of a recurring event expanded locally leaves
+        it out of the expansion.
+        """
+        # "{event_id}_" で始まるidは範囲の条件で探す (ORでまとめると索引が使われない)
+        prefix = event_id + '_'
+        for table in ('events', 'search_terms'):
+            self.conn.execute(
+                f'DELETE FROM {table} WHERE calendar_id = ? AND event_id = ?', (calendar_id, event_id))
+            self.conn.execute(
+                f'DELETE FROM {table} WHERE calendar_id = ? AND event_id >= ? AND event_id < ?',
+                (calendar_id, prefix, event_id + chr(ord('_') + 1)))
+        self.conn.execute(
+            'DELETE FROM recurring_events WHERE calendar_id = ? AND event_id = ?',
+            (calendar_id, event_id))
+        self.conn.execute(
+            'DELETE FROM recurrence_overrides WHERE calendar_id = ? AND master_id = ?',
+            (calendar_id, event_id))
+        instance = parse_instance_id(event_id)
+        if instance is not None and self.conn.execute(
+                'SELECT 1 FROM recurring_events WHERE calendar_id = ? AND event_id = ?',
+                (calendar_id, instance[0])).fetchone():
+            # 展開した回はeventsにないので、削除した回として記録する
+            self.conn.execute('INSERT OR IGNORE INTO recurrence_overrides VALUES (?, ?, ?)',
+                              (calendar_id, *instance))
+        if commit:
+            self.conn.commit()
+
+    def _override(self, calendar_id, event):
+        self.conn.execute(
+            'INSERT OR IGNORE INTO recurrence_overrides VALUES (?, ?, ?)',
+            (calendar_id, event['recurringEventId'], original_start_ts(event)))
+
+    def _index(self, calendar_id, event):
+        self.conn.execute(
+            'DELETE FROM search_terms WHERE calendar_id = ? AND event_id = ?',
+            (calendar_id, event['id']))
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO search_terms VALUES (?, ?, ?)',
+            [(term, calendar_id, event['id']) for term in bigrams(event_text(event))])
+
+    @locked
+    def rebuild_index(self):
+        self.conn.execute('DELETE FROM search_terms')
+        for calendar_id, body in self.conn.execute(
+                'SELECT calendar_id, body FROM events UNION ALL SELECT calendar_id, body FROM recurring_events'
+        ).fetchall():
+            self._index(calendar_id, json.loads(body))
+        self.conn.commit()
+
+    @locked
+    def search(self, calendar_ids, query):
+        """Returns the events of the calendars whose summary, description or
+        location contain every word of the query, as (calendar_id, event)
+        pairs ordered by start time.
+        """
+        terms, prefixes = query_terms(query)
+        conditions = [('term = ?', (term,)) for term in terms] + \
+            [('term >= ? AND term < ?', (prefix, prefix + '\uffff')) for prefix in prefixes]
+        if not conditions:
+            return []
+        # 最も出現数の少ないn-gramで候補を絞り、残りの語は本文で確かめる
+        condition, params = min(conditions, key=lambda item: self.conn.execute(
+            f'SELECT COUNT(*) FROM search_terms WHERE {item[0]}', item[1]).fetchone()[0])
+        placeholders = ', '.join('?' * len(calendar_ids))
+        rows = self.conn.execute(
+            f'''SELECT e.calendar_id, e.body FROM (
+                    SELECT calendar_id, event_id, start_ts, body FROM events
+                    UNION ALL SELECT calendar_id, event_id, start_ts, body FROM recurring_events
+                ) e JOIN (
+                    SELECT DISTINCT calendar_id, event_id FROM search_terms WHERE {condition}
+                ) t ON e.calendar_id = t.calendar_id AND e.event_id = t.event_id
+                WHERE e.calendar_id IN ({placeholders})
+                ORDER BY e.start_ts, e.event_id''',
+            params + tuple(calendar_ids)).fetchall()
+        results = [(calendar_id, json.loads(body)) for calendar_id, body in rows]
+        return [(calendar_id, event) for calendar_id, event in results if matches(event, query)]
+
+    def query(self, calendar_id, start_ts, end_ts):
+        """Returns the events overlapping [start_ts, end_ts) ordered by start time."""
+        return list(self.iter_query(calendar_id, start_ts, end_ts))
+
+    def iter_query(self, calendar_id, start_ts, end_ts, chunk_size=500):
+        """Yields the same events as query() while holding only chunk_size rows
+        in memory at a time. Instances of locally expanded recurring events
+        are merged in by start time.
+        """
+        streams = [self._iter_rows(calendar_id, start_ts, end_ts, chunk_size)]
+        streams.extend(self._iter_instances(calendar_id, start_ts, end_ts))
+        for _, _, event in heapq.merge(*streams, key=lambda item: item[:2]):
+            yield event
+
+    def _iter_rows(self, calendar_id, start_ts, end_ts, chunk_size):
+        last = (float('-inf'), '')
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    '''SELECT start_ts, event_id, body FROM events
+                       WHERE calendar_id = ? AND start_ts < ? AND (end_ts > ? OR start_ts >= ?)
+                         AND (start_ts > ? OR (start_ts = ? AND event_id > ?))
+                       ORDER BY start_ts, event_id LIMIT ?''',
+                    (calendar_id, end_ts, start_ts, start_ts,
+                     last[0], last[0], last[1], chunk_size)).fetchall()
+            for row in rows:
+                yield row[0], row[1], json.loads(row[2])
+            if len(rows) < chunk_size:
+                return
+            last = (rows[-1][0], rows[-1][1])
+
+    def _iter_instances(self, calendar_id, start_ts, end_ts):
+        """Returns a (start_ts, event_id, event) stream for each recurring
+        event overlapping the range.
+        """
+        with self.lock:
+            masters = self.conn.execute(
+                '''SELECT body FROM recurring_events
+                   WHERE calendar_id = ? AND start_ts < ? AND until_ts > ?''',
+                (calendar_id, end_ts, start_ts)).fetchall()
+            overrides = {}
+            if masters:
+                for master_id, original in self.conn.execute(
+                        'SELECT master_id, original_start_ts FROM recurrence_overrides WHERE calendar_id = ?',
+                        (calendar_id,)):
+                    overrides.setdefault(master_id, set()).add(original)
+
+        def stream(master):
+            for instance_start, event in expand(master, start_ts, end_ts, overrides.get(master['id'], ())):
+                yield instance_start, event['id'], event
+        return [stream(json.loads(body)) for body, in masters]
+
+    @locked
+    def get(self, calendar_id, event_id):
+        row = self.conn.execute(
+            '''SELECT body FROM events WHERE calendar_id = ? AND event_id = ?
+               UNION ALL SELECT body FROM recurring_events WHERE calendar_id = ? AND event_id = ?''',
+            (calendar_id, event_id, calendar_id, event_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @locked
+    def sync_state(self, calendar_id):
+        row = self.conn.execute(
+            'SELECT sync_token, synced_at FROM sync_state WHERE calendar_id = ?',
+            (calendar_id,)).fetchone()
+        return row if row else (None, None)
+
+    def is_fresh(self, calendar_id):
+        sync_token, synced_at = self.sync_state(calendar_id)
+        return sync_token is not None and time.time() - synced_at < SYNC_INTERVAL
+
+    @locked
+    def mark_stale(self, calendar_id):
+        """Makes the next listing sync the calendar again."""
+        self.conn.execute('UPDATE sync_state SET synced_at = 0 WHERE calendar_id = ?', (calendar_id,))
+        self.conn.commit()
+
+    @locked
+    def clear(self, calendar_id):
+        for table in ('events', 'search_terms', 'recurring_events', 'recurrence_overrides', 'sync_state'):
+            self.conn.execute(f'DELETE FROM {table} WHERE calendar_id = ?', (calendar_id,))
+        self.conn.commit()
+        self.list_etags.pop(calendar_id, None)
+
+    def sync(self, service, calendar_id):
+        """Brings the store up to date.
+
+        A full sync is done the first time and whenever the server answers 410
+        Gone to an expired syncToken. Otherwise only the changes are fetched,
+        with the etag of the last sync in If-None-Match so that an unchanged
+        calendar is answered with 304 Not Modified.
+        """
+        sync_token, _ = self.sync_state(calendar_id)
+        if sync_token is None:
+            self.clear(calendar_id)
+        try:
+            self._sync_pages(service, calendar_id, sync_token)
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            # syncTokenが無効になったので最初から取り直す
+            self.clear(calendar_id)
+            self._sync_pages(service, calendar_id, None)
+
+    def _sync_pages(self, service, calendar_id, sync_token):
+        server_expanded = []
+        page_token = None
+        while True:
+            params = {'calendarId': calendar_id, 'singleEvents': not self.expand_recurrence,
+                      'maxResults': 2500, 'pageToken': page_token, 'fields': SYNC_FIELDS}
+            if sync_token:
+                params['syncToken'] = sync_token
+            request = service.events().list(**params)
+            etag = self.list_etags.get(calendar_id)
+            if sync_token and page_token is None and etag:
+                request.headers['If-None-Match'] = etag
+            try:
+                events_result = request.execute()
+            except HttpError as e:
+                if e.resp.status != 304:
+                    raise
+                # 前回の同期から変更がない
+                with self.lock:
+                    self.conn.execute('UPDATE sync_state SET synced_at = ? WHERE calendar_id = ?',
+                                      (time.time(), calendar_id))
+                    self.conn.commit()
+                    self.revalidated += 1
+                return
+            with self.lock:
+                for event in events_result.get('items', []):
+                    if event.get('status') == 'cancelled':
+                        self.delete(calendar_id, event['id'], commit=False)
+                        if 'recurringEventId' in event and 'originalStartTime' in event:
+                            # 繰り返し予定の1回だけが削除された
+                            self._override(calendar_id, event)
+                        continue
+                    try:
+                        self.upsert(calendar_id, event, commit=False)
+                    except UnsupportedRecurrence:
+                        server_expanded.append(event)
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                break
+        for event in server_expanded:
+            self._sync_instances(service, calendar_id, event)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                (calendar_id, events_result.get('nextSyncToken'), time.time()))
+            self.conn.commit()
+            if events_result.get('etag'):
+                self.list_etags[calendar_id] = events_result['etag']
+
+    def _sync_instances(self, service, calendar_id, master):
+        """Stores the instances of a recurring event whose rule is not
+        expanded locally, as expanded by the server.
+        """
+        with self.lock:
+            self.delete(calendar_id, master['id'], commit=False)
+        page_token = None
+        while True:
+            events_result = service.events().instances(
+                calendarId=calendar_id, eventId=master['id'], maxResults=2500,
+                pageToken=page_token, fields=INSTANCE_FIELDS).execute()
+            with self.lock:
+                for event in events_result.get('items', []):
+                    if event.get('status') != 'cancelled':
+                        self.upsert(calendar_id, event, commit=False)
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                return
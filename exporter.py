@@ -0,0 +1,151 @@
+import csv
+import datetime
+import json
+import os
+
+from event_record import EventRecord, clock, parse_datetime
+
+# 出力ファイルのバッファの大きさ (バイト)
+BUFFER_SIZE = 1 << 16
+CSV_HEADER = ['date', 'time', 'summary', 'start', 'end', 'location', 'description', 'id', 'calendar']
+
+
+class JsonlWriter:
+    """One events resource per line, with the calendar it came from."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def begin(self):
+        pass
+
+    def write(self, event, calendar_id):
+        self.f.write(json.dumps(dict(event, calendarId=calendar_id), ensure_ascii=False))
+        self.f.write('\n')
+
+    def end(self):
+        pass
+
+
+class CsvWriter:
+    """Rows starting with "date,time,summary" in the format of import, so
+    that an export can be imported again, followed by the raw fields. Import
+    keys the rows by the id column, so importing an edited export again
+    does not duplicate its events.
+    """
+
+    def __init__(self, f):
+        self.writer = csv.writer(f)
+
+    def begin(self):
+        self.writer.writerow(CSV_HEADER)
+
+    def write(self, event, calendar_id):
+        record = EventRecord.from_resource(event)
+        time = '' if record.all_day else f'{clock(record.start)}~{clock(record.end)}'
+        start = event.get('start', {})
+        end = event.get('end', {})
+        self.writer.writerow([
+            record.first_day().strftime('%Y/%m/%d'), time, record.summary,
+            start.get('dateTime', start.get('date', '')), end.get('dateTime', end.get('date', '')),
+            event.get('location', ''), event.get('description', ''), record.id, calendar_id])
+
+    def end(self):
+        pass
+
+
+class IcsWriter:
+    """One VCALENDAR with a VEVENT per event (RFC 5545)."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def begin(self):
+        self.f.write('BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Mygcal//export//EN\r\n')
+
+    def write(self, event, calendar_id):
+        lines = ['BEGIN:VEVENT', f'UID:{event.get("iCalUID") or event.get("id", "") + "@google.com"}']
+        lines.append(f'DTSTAMP:{ics_timestamp(event.get("updated"))}')
+        for name, key in (('DTSTART', 'start'), ('DTEND', 'end')):
+            if key in event:
+                lines.append(ics_time(name, event[key]))
+        if 'recurringEventId' in event and 'originalStartTime' in event:
+            # 繰り返し予定の各回は同じUIDになるので元の開始時刻で区別する
+            lines.append(ics_time('RECURRENCE-ID', event['originalStartTime']))
+        for name, key in (('SUMMARY', 'summary'), ('LOCATION', 'location'), ('DESCRIPTION', 'description')):
+            if event.get(key):
+                lines.append(f'{name}:{ics_escape(event[key])}')
+        lines.append('END:VEVENT')
+        self.f.write(''.join(fold(line) for line in lines))
+
+    def end(self):
+        self.f.write('END:VCALENDAR\r\n')
+
+
+WRITERS = {'ics': IcsWriter, 'jsonl': JsonlWriter, 'csv': CsvWriter}
+
+
+def ics_escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def ics_time(name, value):
+    """Formats a start/end of the API as a DATE or a UTC DATE-TIME property."""
+    if 'dateTime' in value:
+        return f'{name}:{utc_stamp(parse_datetime(value["dateTime"]))}'
+    return f'{name};VALUE=DATE:{value["date"].replace("-", "")}'
+
+
+def ics_timestamp(value):
+    if value:
+        return utc_stamp(parse_datetime(value))
+    return utc_stamp(int(datetime.datetime.now(datetime.timezone.utc).timestamp()))
+
+
+def utc_stamp(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def fold(line):
+    """Folds a content line at 75 octets without splitting a character."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts = []
+    current = ''
+    size = 0
+    limit = 75
+    for character in line:
+        width = len(character.encode('utf-8'))
+        if size + width > limit:
+            parts.append(current)
+            current = ''
+            size = 0
+            # 2行目以降は先頭の空白の分だけ短くする
+            limit = 74
+        current += character
+        size += width
+    parts.append(current)
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def checkpoint_path(path):
+    return path + '.resume'
+
+
+def save_checkpoint(path, state):
+    """Writes the resume state atomically next to the output file."""
+    temporary = checkpoint_path(path) + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(temporary, checkpoint_path(path))
+
+
+def load_checkpoint(path):
+    with open(checkpoint_path(path), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def remove_checkpoint(path):
+    if os.path.exists(checkpoint_path(path)):
+        os.unlink(checkpoint_path(path))
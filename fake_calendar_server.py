@@ -0,0 +1,543 @@
+"""Local stand-in for the Calendar v3 API, used by benchmark.py.
+
+It serves events.list/get/insert/patch/delete, calendarList.list and batch
+requests for synthetic calendars with configurable latency, page size and
+quota errors, so that commands can be measured without the real API. Like
+the real API it honours fields= masks, ETags (If-Match, If-None-Match) and
+gzips responses when asked to.
+
+    python fake_calendar_server.py --port 8080 --events 100000
+"""
+import argparse
+import bisect
+import datetime
+import email.parser
+import gzip
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from recurrence import expand, parse_instance_id
+
+JST = datetime.timezone(datetime.timedelta(hours=9))
+# 合成する繰り返し予定の規則 (順に使う)
+RECURRENCE_RULES = ('FREQ=DAILY', 'FREQ=WEEKLY;BYDAY=MO,WE,FR', 'FREQ=WEEKLY;BYDAY=TU,TH',
+                    'FREQ=MONTHLY;BYDAY=1MO')
+# 合成した予定の最長の長さ (範囲検索で開始時刻をどこまで遡るか)
+MAX_DURATION = 24 * 60 * 60
+
+
+def iso(ts):
+    return datetime.datetime.fromtimestamp(ts, JST).isoformat()
+
+
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+class SyntheticCalendar:
+    """A calendar of n generated events plus the changes made through the API.
+
+    Generated events are kept as arrays of start times and durations and are
+    turned into event resources only when they are returned.
+    """
+
+    def __init__(self, calendar_id, n_events, start_date=datetime.date(2024, 1, 1), days=730, seed=0,
+                 n_recurring=0):
+        self.calendar_id = calendar_id
+        until = (start_date + datetime.timedelta(days=days)).strftime('%Y%m%d')
+        self.recurring = [self.recurring_event(i, start_date, RECURRENCE_RULES[i % len(RECURRENCE_RULES)], until)
+                          for i in range(n_recurring)]
+        rng = random.Random(seed)
+        base = datetime.datetime.combine(start_date, datetime.time(), JST).timestamp()
+        pairs = []
+        for i in range(n_events):
+            day = base + (i * days // max(n_events, 1)) * 86400
+            if i % 50 == 0:
+                pairs.append((day, -1))
+            else:
+                start = day + (8 + rng.randrange(12)) * 3600 + rng.choice((0, 900, 1800, 2700))
+                pairs.append((start, 1800 * (1 + rng.randrange(4))))
+        pairs.sort()
+        self.starts = array('d', (start for start, _ in pairs))
+        # -1は終日の予定
+        self.durations = array('i', (duration for _, duration in pairs))
+        self.added = {}
+        self.deleted = set()
+        # 繰り返し予定のid -> {削除された回の元の開始時刻: 削除された回のリソース}
+        self.cancelled = {}
+        # 差分同期用の変更履歴 (syncTokenはこのリストの位置)
+        self.changes = []
+        self.lock = threading.Lock()
+
+    def synthetic_event(self, i):
+        start = self.starts[i]
+        duration = self.durations[i]
+        event_id = f'syn{i:07d}'
+        if duration < 0:
+            day = datetime.datetime.fromtimestamp(start, JST).date()
+            start_value = {'date': day.isoformat()}
+            end_value = {'date': (day + datetime.timedelta(days=1)).isoformat()}
+        else:
+            start_value = {'dateTime': iso(start), 'timeZone': 'Asia/Tokyo'}
+            end_value = {'dateTime': iso(start + duration), 'timeZone': 'Asia/Tokyo'}
+        return {
+            'kind': 'calendar#event',
+            'etag': f'"{int(start)}{i}"',
+            'id': event_id,
+            'status': 'confirmed',
+            'htmlLink': f'https://www.google.com/calendar/event?eid={event_id}',
+            'created': '2023-12-01T00:00:00.000Z',
+            'updated': '2023-12-01T00:00:00.000Z',
+            'summary': f'Synthetic event {i}',
+            'description': 'Generated by fake_calendar_server.py for benchmarking.',
+            'location': 'Tokyo',
+            'creator': {'email': 'bench@example.com', 'self': True},
+            'organizer': {'email': 'bench@example.com', 'self': True},
+            'start': start_value,
+            'end': end_value,
+            'iCalUID': f'{event_id}@example.com',
+            'sequence': 0,
+            'reminders': {'useDefault': True},
+            'eventType': 'default',
+        }
+
+    def recurring_event(self, i, start_date, rule, until):
+        start = datetime.datetime.combine(start_date, datetime.time(9, 15 * (i % 4)), JST)
+        event_id = f'rec{i:05d}'
+        return {
+            'kind': 'calendar#event',
+            'etag': f'"rec{i}"',
+            'id': event_id,
+            'status': 'confirmed',
+            'summary': f'Recurring event {i}',
+            'description': 'Generated by fake_calendar_server.py for benchmarking.',
+            'location': 'Tokyo',
+            'start': {'dateTime': start.isoformat(), 'timeZone': 'Asia/Tokyo'},
+            'end': {'dateTime': (start + datetime.timedelta(minutes=15)).isoformat(), 'timeZone': 'Asia/Tokyo'},
+            'recurrence': [f'RRULE:{rule};UNTIL={until}'],
+            'iCalUID': f'{event_id}@example.com',
+            'sequence': 0,
+            'reminders': {'useDefault': True},
+            'eventType': 'default',
+        }
+
+    def event_bounds(self, event):
+        bounds = []
+        for key in ('start', 'end'):
+            value = event[key]
+            if 'dateTime' in value:
+                bounds.append(parse_time(value['dateTime']))
+            else:
+                bounds.append(datetime.datetime.combine(
+                    datetime.date.fromisoformat(value['date']), datetime.time(), JST).timestamp())
+        return bounds
+
+    def matching(self, time_min, time_max, single_events=False):
+        """Returns the keys (int for generated events, str for added ones and
+        the resource itself for recurring events) of the events overlapping
+        [time_min, time_max), ordered by start time. With single_events the
+        recurring events are expanded into their instances.
+        """
+        lo = bisect.bisect_left(self.starts, time_min - MAX_DURATION)
+        hi = bisect.bisect_left(self.starts, time_max)
+        keys = []
+        for i in range(lo, hi):
+            duration = self.durations[i]
+            end = self.starts[i] + (86400 if duration < 0 else duration)
+            if end > time_min and f'syn{i:07d}' not in self.deleted:
+                keys.append((self.starts[i], i))
+        with self.lock:
+            for event_id, event in self.added.items():
+                start, end = self.event_bounds(event)
+                if start < time_max and end > time_min:
+                    keys.append((start, event_id))
+        for master in self.recurring:
+            cancelled = self.cancelled.get(master['id'], {})
+            if single_events:
+                keys.extend(expand(master, max(time_min, 0), min(time_max, 2 ** 40), cancelled))
+            elif self.event_bounds(master)[0] < time_max:
+                keys.append((self.event_bounds(master)[0], master))
+                # APIと同じく、展開しない一覧には削除された回も含める
+                keys.extend(cancelled.items())
+        keys.sort(key=lambda item: (item[0], item[1]['id'] if isinstance(item[1], dict) else str(item[1])))
+        return [key for _, key in keys]
+
+    def resource(self, key):
+        if isinstance(key, dict):
+            return key
+        return self.synthetic_event(key) if isinstance(key, int) else self.added[key]
+
+    def insert(self, event):
+        with self.lock:
+            event_id = event.get('id') or f'add{len(self.changes):07d}'
+            if event_id in self.added or (event_id.startswith('syn') and event_id not in self.deleted):
+                return None
+            event = local_times(dict(event, id=event_id, kind='calendar#event', status='confirmed',
+                                     etag=f'"{time.time_ns()}"'))
+            self.added[event_id] = event
+            self.changes.append(event)
+            return event
+
+    def get(self, event_id):
+        with self.lock:
+            if event_id in self.added:
+                return self.added[event_id]
+            for master in self.recurring:
+                if master['id'] == event_id:
+                    return master
+            if event_id.startswith('syn') and event_id not in self.deleted \
+                    and event_id[3:].isdigit() and int(event_id[3:]) < len(self.starts):
+                return self.synthetic_event(int(event_id[3:]))
+        return None
+
+    def patch(self, event_id, changes):
+        """Updates the given fields of an event and gives it a new etag."""
+        event = self.get(event_id)
+        if event is None:
+            return None
+        with self.lock:
+            event = local_times(dict(merge_patch(event, changes), etag=f'"{time.time_ns()}"'))
+            if 'recurrence' in event:
+                self.recurring = [event if master['id'] == event_id else master for master in self.recurring]
+                self.changes.append(event)
+                return event
+            if event_id.startswith('syn'):
+                # 生成した予定は変更後のものに置き換える
+                self.deleted.add(event_id)
+            self.added[event_id] = event
+            self.changes.append(event)
+            return event
+
+    def delete(self, event_id):
+        with self.lock:
+            if event_id in self.added:
+                del self.added[event_id]
+            elif event_id.startswith('syn') and event_id not in self.deleted \
+                    and event_id[3:].isdigit() and int(event_id[3:]) < len(self.starts):
+                self.deleted.add(event_id)
+            else:
+                return self.cancel_instance(event_id)
+            self.changes.append({'kind': 'calendar#event', 'id': event_id, 'status': 'cancelled'})
+            return True
+
+    def cancel_instance(self, event_id):
+        """Deletes one instance of a recurring event, like the API does for
+        an id "{recurring event id}_{original start}". Called with the lock held.
+        """
+        instance = parse_instance_id(event_id)
+        master = next((master for master in self.recurring if instance and master['id'] == instance[0]), None)
+        if master is None:
+            return False
+        cancelled = self.cancelled.setdefault(master['id'], {})
+        for start, event in expand(master, instance[1], instance[1] + 1, cancelled):
+            if start == instance[1] and event['id'] == event_id:
+                cancelled[start] = {'kind': 'calendar#event', 'id': event_id, 'status': 'cancelled',
+                                    'recurringEventId': master['id'],
+                                    'originalStartTime': event['originalStartTime']}
+                self.changes.append(cancelled[start])
+                return True
+        return False
+
+
+class FakeCalendarServer:
+    """Holds the calendars and the behaviour settings of the fake API."""
+
+    def __init__(self, n_events=10000, calendars=('primary',), latency=0.0,
+                 page_size=250, quota_error_rate=0.0, seed=0, gzip=True, recurring=0):
+        self.calendars = {calendar_id: SyntheticCalendar(calendar_id, n_events, seed=seed + i, n_recurring=recurring)
+                          for i, calendar_id in enumerate(calendars)}
+        self.latency = latency
+        self.page_size = page_size
+        self.quota_error_rate = quota_error_rate
+        self.gzip = gzip
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.query_cache = {}
+
+    def handle(self, method, path, query, body, headers=None):
+        """Returns (status, dict or None) for one (sub-)request."""
+        headers = headers or {}
+        status, result = self.dispatch(method, path, query, body, headers)
+        if status == 200 and result.get('etag') and result['etag'] == headers.get('if-none-match'):
+            return 304, None
+        if status == 200 and query.get('fields'):
+            result = apply_fields(result, parse_fields(query['fields']))
+        return status, result
+
+    def dispatch(self, method, path, query, body, headers):
+        with self.lock:
+            self.requests += 1
+            quota_error = self.random.random() < self.quota_error_rate
+        if quota_error:
+            return 403, error_body(403, 'Rate Limit Exceeded', 'rateLimitExceeded')
+        path = urllib.parse.unquote(path)
+        if path == '/calendar/v3/users/me/calendarList':
+            items = [{'kind': 'calendar#calendarListEntry', 'id': calendar_id,
+                      'summary': calendar_id, 'primary': calendar_id == 'primary'}
+                     for calendar_id in self.calendars]
+            return 200, {'kind': 'calendar#calendarList', 'items': items}
+        match = re.fullmatch(r'/calendar/v3/calendars/([^/]+)/events(?:/([^/]+))?', path)
+        if not match or match.group(1) not in self.calendars:
+            return 404, error_body(404, 'Not Found', 'notFound')
+        calendar = self.calendars[match.group(1)]
+        event_id = match.group(2)
+        if method == 'GET' and event_id is None:
+            return self.list_events(calendar, query)
+        if method == 'POST' and event_id is None:
+            event = calendar.insert(json.loads(body or '{}'))
+            if event is None:
+                return 409, error_body(409, 'The requested identifier already exists.', 'duplicate')
+            return 200, event
+        if method == 'GET' and event_id is not None:
+            event = calendar.get(event_id)
+            if event is None:
+                return 404, error_body(404, 'Not Found', 'notFound')
+            return 200, event
+        if method == 'PATCH' and event_id is not None:
+            event = calendar.get(event_id)
+            if event is None:
+                return 404, error_body(404, 'Not Found', 'notFound')
+            if headers.get('if-match') not in (None, '*', event['etag']):
+                return 412, error_body(412, 'Precondition Failed', 'conditionNotMet')
+            return 200, calendar.patch(event_id, json.loads(body or '{}'))
+        if method == 'DELETE' and event_id is not None:
+            if not calendar.delete(event_id):
+                return 410, error_body(410, 'Resource has been deleted', 'deleted')
+            return 204, None
+        return 400, error_body(400, 'Bad Request', 'badRequest')
+
+    def list_events(self, calendar, query):
+        page_size = min(int(query.get('maxResults', self.page_size)), self.page_size)
+        offset = int(query.get('pageToken', 0))
+        if 'syncToken' in query:
+            position = int(query['syncToken'])
+            if position > len(calendar.changes):
+                return 410, error_body(410, 'Sync token is no longer valid', 'fullSyncRequired')
+            items = calendar.changes[position + offset:position + offset + page_size]
+            result = {'kind': 'calendar#events', 'etag': f'"{len(calendar.changes)}"', 'items': items}
+            if position + offset + page_size < len(calendar.changes):
+                result['nextPageToken'] = str(offset + page_size)
+            else:
+                result['nextSyncToken'] = str(len(calendar.changes))
+            return 200, result
+
+        time_min = parse_time(query['timeMin']) if 'timeMin' in query else float('-inf')
+        time_max = parse_time(query['timeMax']) if 'timeMax' in query else float('inf')
+        single_events = query.get('singleEvents') == 'true'
+        cache_key = (calendar.calendar_id, time_min, time_max, single_events, len(calendar.changes))
+        keys = self.query_cache.get(cache_key)
+        if keys is None:
+            keys = calendar.matching(time_min, time_max, single_events)
+            self.query_cache = {cache_key: keys}
+        items = [calendar.resource(key) for key in keys[offset:offset + page_size]]
+        # 一覧のetagはカレンダーが変更されるたびに変わる
+        result = {'kind': 'calendar#events', 'etag': f'"{len(calendar.changes)}"',
+                  'summary': calendar.calendar_id, 'timeZone': 'Asia/Tokyo', 'items': items}
+        if offset + page_size < len(keys):
+            result['nextPageToken'] = str(offset + page_size)
+        else:
+            result['nextSyncToken'] = str(len(calendar.changes))
+        return 200, result
+
+
+def local_times(event):
+    """Gives dateTime values without an offset the JST offset, like the API
+    does with the timeZone of the event.
+    """
+    event = dict(event)
+    for key in ('start', 'end'):
+        value = event.get(key, {})
+        if 'dateTime' in value and not re.search(r'([+-]\d\d:\d\d|Z)$', value['dateTime']):
+            event[key] = dict(value, dateTime=value['dateTime'] + '+09:00')
+        if event[key].get('timeZone') == 'JST':
+            event[key] = dict(event[key], timeZone='Asia/Tokyo')
+    return event
+
+
+def merge_patch(value, changes):
+    """Applies patch semantics: objects are merged and null removes a field."""
+    merged = dict(value)
+    for key, change in changes.items():
+        if change is None:
+            merged.pop(key, None)
+        elif isinstance(change, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_patch(merged[key], change)
+        else:
+            merged[key] = change
+    return merged
+
+
+def parse_fields(mask):
+    """Parses a fields= mask such as "nextPageToken,items(id,start/dateTime)"
+    into nested dicts of {name: sub-mask}, where None selects the whole value.
+    """
+    def add(spec, name, sub=None):
+        name = name.strip()
+        if not name:
+            return
+        *parents, last = name.split('/')
+        for part in parents:
+            if part in spec and spec[part] is None:
+                # 値全体が選択済み
+                return
+            spec = spec.setdefault(part, {})
+        if sub is None:
+            spec[last] = None
+        elif not (last in spec and spec[last] is None):
+            spec.setdefault(last, {}).update(sub)
+
+    def parse(i, spec):
+        name = ''
+        while i < len(mask):
+            c = mask[i]
+            i += 1
+            if c == '(':
+                sub = {}
+                i = parse(i, sub)
+                add(spec, name, sub)
+                name = ''
+            elif c == ')':
+                add(spec, name)
+                return i
+            elif c == ',':
+                add(spec, name)
+                name = ''
+            else:
+                name += c
+        add(spec, name)
+        return i
+
+    spec = {}
+    parse(0, spec)
+    return spec
+
+
+def apply_fields(value, spec):
+    """Keeps only the parts of value selected by a parsed fields= mask."""
+    if spec is None or '*' in spec:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, spec) for item in value]
+    if isinstance(value, dict):
+        return {key: apply_fields(value[key], sub) for key, sub in spec.items() if key in value}
+    return value
+
+
+def error_body(code, message, reason):
+    return {'error': {'code': code, 'message': message,
+                      'errors': [{'domain': 'global', 'reason': reason, 'message': message}]}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        fake = self.server.fake
+        if fake.latency:
+            time.sleep(fake.latency)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        url = urllib.parse.urlsplit(self.path)
+        if url.path.startswith('/batch/'):
+            content_type, payload = self.batch(fake, body)
+            self.reply(200, payload, content_type)
+            return
+        headers = {name.lower(): value for name, value in self.headers.items()}
+        status, result = fake.handle(method, url.path, dict(urllib.parse.parse_qsl(url.query)), body, headers)
+        self.reply(status, json.dumps(result).encode('utf-8') if result is not None else b'')
+
+    def batch(self, fake, body):
+        message = email.parser.Parser().parsestr(
+            f'Content-Type: {self.headers["Content-Type"]}\r\n\r\n{body}')
+        parts = []
+        for part in message.get_payload():
+            request_line, _, rest = part.get_payload().partition('\n')
+            method, target, _ = request_line.strip().split(' ', 2)
+            header_lines, _, sub_body = rest.replace('\r\n', '\n').partition('\n\n')
+            headers = {}
+            for line in header_lines.split('\n'):
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            url = urllib.parse.urlsplit(target)
+            status, result = fake.handle(method, url.path, dict(urllib.parse.parse_qsl(url.query)),
+                                         sub_body.strip(), headers)
+            content = json.dumps(result) if result is not None else ''
+            parts.append(
+                f'--batch_fake\r\nContent-Type: application/http\r\n'
+                f'Content-ID: <response-{part["Content-ID"].strip("<>")}>\r\n\r\n'
+                f'HTTP/1.1 {status} {self.responses.get(status, ("",))[0]}\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\n\r\n{content}\r\n')
+        payload = (''.join(parts) + '--batch_fake--\r\n').encode('utf-8')
+        return 'multipart/mixed; boundary=batch_fake', payload
+
+    def reply(self, status, payload, content_type='application/json; charset=UTF-8'):
+        fake = self.server.fake
+        compressed = fake.gzip and payload and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if compressed:
+            payload = gzip.compress(payload, compresslevel=6)
+        with fake.lock:
+            fake.bytes_sent += len(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_server(fake, port=0):
+    """Starts the server in a daemon thread and returns it. The chosen port is
+    server.server_address[1].
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.fake = fake
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Calendar v3 API server')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--events', type=int, default=10000, help='synthetic events per calendar')
+    parser.add_argument('--calendars', default='primary', help='comma separated calendar ids')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--page-size', type=int, default=250)
+    parser.add_argument('--quota-error-rate', type=float, default=0.0)
+    parser.add_argument('--no-gzip', action='store_true', help='never compress responses')
+    parser.add_argument('--recurring', type=int, default=0, help='recurring events per calendar')
+    args = parser.parse_args()
+    fake = FakeCalendarServer(args.events, args.calendars.split(','), args.latency,
+                              args.page_size, args.quota_error_rate, gzip=not args.no_gzip,
+                              recurring=args.recurring)
+    server = start_server(fake, args.port)
+    print(f'Serving on http://127.0.0.1:{server.server_address[1]}/')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
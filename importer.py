@@ -0,0 +1,147 @@
+import csv
+import datetime
+import hashlib
+
+import pytz
+
+
+def iter_import_rows(path):
+    """Yields (line_no, date, time, summary, uid, error) from a CSV or ICS
+    file, reading it one line at a time.
+
+    date is "YYYY/MM/DD", time is "" (all day), "HH:MM" or "HH:MM~HH:MM" in
+    the same format as the add command. uid identifies an ICS event (its UID
+    and RECURRENCE-ID, or DTSTART, since every instance of a series shares
+    the UID) or a CSV row of an export (its id column), and is None for
+    other CSV rows. error is the reason a row cannot be imported, or None.
+    """
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.lower().endswith('.ics'):
+            yield from iter_ics_rows(f)
+        else:
+            yield from iter_csv_rows(f)
+
+
+def iter_csv_rows(f):
+    """CSV rows are "date,time,summary". A header row starting with "date" is
+    skipped; when it has an "id" column, as an export has, that column
+    identifies the rows so that an edited export is not imported twice.
+    """
+    id_column = None
+    for line_no, row in enumerate(csv.reader(f), 1):
+        if line_no == 1 and row and row[0].strip().lower() == 'date':
+            header = [cell.strip().lower() for cell in row]
+            id_column = header.index('id') if 'id' in header else None
+            continue
+        if not row:
+            continue
+        row = [cell.strip() for cell in row] + ['', '']
+        uid = row[id_column] if id_column is not None and id_column < len(row) else ''
+        yield line_no, row[0].replace('-', '/'), row[1], row[2], uid or None, None
+
+
+def unfold_ics_lines(f):
+    """Joins folded ICS lines (continuation lines start with a space or tab)."""
+    line_no = 0
+    current = None
+    current_no = 0
+    for line_no, line in enumerate(f, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current_no, current
+        current = line
+        current_no = line_no
+    if current is not None:
+        yield current_no, current
+
+
+def ics_param(params, name):
+    """Returns the value of a property parameter such as TZID, or None."""
+    for param in params.split(';'):
+        key, _, value = param.partition('=')
+        if key.upper() == name:
+            return value.strip('"')
+    return None
+
+
+def ics_datetime(value, params):
+    """Converts a DTSTART/DTEND value to a JST (date, "HH:MM" or None).
+
+    UTC values and values with a TZID are converted to JST; floating times
+    are taken as JST. Raises ValueError with the reason a value cannot be read.
+    """
+    jst = pytz.timezone('Asia/Tokyo')
+    try:
+        if (ics_param(params, 'VALUE') or '').upper() == 'DATE' or len(value) == 8:
+            return datetime.datetime.strptime(value, '%Y%m%d').date(), None
+        dt = datetime.datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S')
+    except ValueError:
+        raise ValueError(f"Invalid date : {value}")
+    tzid = ics_param(params, 'TZID')
+    if value.endswith('Z'):
+        dt = pytz.utc.localize(dt).astimezone(jst)
+    elif tzid is not None:
+        try:
+            zone = pytz.timezone(tzid)
+        except pytz.UnknownTimeZoneError:
+            raise ValueError(f"Unknown time zone : {tzid}")
+        dt = zone.localize(dt).astimezone(jst)
+    return dt.date(), dt.strftime('%H:%M')
+
+
+def iter_ics_rows(f):
+    event = None
+    for line_no, line in unfold_ics_lines(f):
+        name, _, value = line.partition(':')
+        name, _, params = name.partition(';')
+        name = name.upper()
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event = {'line_no': line_no}
+        elif event is None:
+            continue
+        elif name == 'END' and value.upper() == 'VEVENT':
+            yield ics_row(event)
+            event = None
+        elif name in ('DTSTART', 'DTEND', 'SUMMARY', 'UID', 'RECURRENCE-ID', 'RRULE'):
+            event[name] = (value, params)
+
+
+def ics_row(event):
+    line_no = event['line_no']
+    summary = event.get('SUMMARY', ('', ''))[0].replace('\\,', ',').replace('\\;', ';').replace('\\n', ' ')
+    uid = event.get('UID', (None, ''))[0]
+    if uid:
+        # 繰り返し予定の各回は同じUIDなので、その回の元の開始時刻 (なければDTSTART) で区別する
+        uid = f"{uid}\n{event.get('RECURRENCE-ID', event.get('DTSTART', ('', '')))[0]}"
+    if 'RRULE' in event:
+        # 1回目だけを取り込むと残りの回が失われるので取り込まない
+        return line_no, '', '', summary, uid, "Recurring events (RRULE) are not imported; export them with their instances"
+    if 'DTSTART' not in event:
+        return line_no, '', '', summary, uid, "The event has no DTSTART"
+    try:
+        start_date, start_time = ics_datetime(*event['DTSTART'])
+        end_date, end_time = ics_datetime(*event['DTEND']) if 'DTEND' in event else (start_date, start_time)
+    except ValueError as e:
+        return line_no, '', '', summary, uid, str(e)
+
+    date = start_date.strftime('%Y/%m/%d')
+    # addと同じく日をまたぐ予定は扱えない (終日の予定は1日分のみ)
+    if (start_time is None and (end_date - start_date).days > 1) or \
+            (start_time is not None and end_date != start_date):
+        return line_no, date, '', summary, uid, "Events spanning several days are not imported"
+    if start_time is None:
+        return line_no, date, '', summary, uid, None
+    if end_time == start_time:
+        return line_no, date, start_time, summary, uid, None
+    return line_no, date, f'{start_time}~{end_time}', summary, uid, None
+
+
+def import_event_id(calendar_id, date, time, summary, uid):
+    """Returns a deterministic event id so that importing a file twice does
+    not create duplicates. Hex digits are valid base32hex event id characters.
+    """
+    key = uid if uid else f'{date}\n{time}\n{summary}'
+    return hashlib.sha1(f'{calendar_id}\n{key}'.encode('utf-8')).hexdigest()
@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+import urllib.parse
+
+# ヒストグラムの区切り (ミリ秒)
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+    """Latency histogram with fixed millisecond buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+
+    def add(self, ms, size=0):
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.bytes += size
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket holding the percentile."""
+        target = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+        return 0.0
+
+
+class Stats:
+    """Collects timings of API calls and REPL commands.
+
+    Each record is added to a histogram keyed by (kind, name) and, when a
+    trace file is open, written to it as one JSON line.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.trace_file = None
+
+    def open_trace(self, path):
+        self.trace_file = open(path, 'a', encoding='utf-8')
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+    def record(self, kind, name, seconds, size=0, **extra):
+        ms = seconds * 1000
+        with self.lock:
+            key = (kind, name)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].add(ms, size)
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(dict(
+                    {'ts': time.time(), 'kind': kind, 'name': name, 'ms': round(ms, 3), 'bytes': size},
+                    **extra)) + '\n')
+                self.trace_file.flush()
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def print_report(self, cache=None):
+        with self.lock:
+            items = sorted(self.histograms.items())
+        print(f'{"kind".ljust(8)} {"name".ljust(28)} {"count".rjust(6)} {"total ms".rjust(10)} '
+              f'{"p50".rjust(7)} {"p90".rjust(7)} {"max".rjust(9)} {"bytes".rjust(10)}')
+        for (kind, name), histogram in items:
+            print(f'{kind.ljust(8)} {name[:28].ljust(28)} {histogram.count:6d} {histogram.total:10.1f} '
+                  f'{histogram.percentile(0.5):7.0f} {histogram.percentile(0.9):7.0f} '
+                  f'{histogram.max:9.1f} {histogram.bytes:10d}')
+        if cache is not None:
+            print(f'cache hits: {cache.hits} misses: {cache.misses}')
+
+
+stats = Stats()
+
+
+def endpoint_name(uri):
+    """Shortens a request URI to the resource it calls, e.g. "events"."""
+    url = urllib.parse.urlsplit(uri)
+    if url.path.startswith('/batch/'):
+        return 'batch'
+    if 'oauth2' in url.netloc or url.path.endswith('/token'):
+        return 'token refresh'
+    parts = [part for part in url.path.split('/') if part]
+    for name in ('events', 'calendarList'):
+        if name in parts:
+            return name
+    return url.path
@@ -0,0 +1,43 @@
+"""httplib2/googleapiclient classes that record their timings in stats.
+
+They are kept apart from instrumentation.py because importing httplib2 and
+googleapiclient takes most of the startup time; run.py imports this module
+only when it builds the service.
+"""
+import time
+
+import httplib2
+from googleapiclient.http import HttpRequest
+
+from instrumentation import endpoint_name, stats
+from scheduler import is_idempotent, scheduler
+
+
+class InstrumentedHttp(httplib2.Http):
+    """httplib2.Http that records the time and size of every round trip,
+    including the token refreshes made through it.
+    """
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        started = time.perf_counter()
+        response, content = super().request(uri, method, body, headers, *args, **kwargs)
+        stats.record('http', f'{method} {endpoint_name(uri)}', time.perf_counter() - started,
+                     size=len(content or b''), status=response.status)
+        return response, content
+
+
+class InstrumentedRequest(HttpRequest):
+    """HttpRequest sent through the request scheduler, whose execute() time,
+    which includes building the request, the round trip and decoding the
+    JSON, is recorded per API method.
+    """
+
+    def execute(self, http=None, num_retries=0):
+        return scheduler.run(lambda: self.execute_once(http, num_retries), idempotent=is_idempotent(self))
+
+    def execute_once(self, http, num_retries):
+        started = time.perf_counter()
+        try:
+            return super().execute(http=http, num_retries=num_retries)
+        finally:
+            stats.record('api', self.methodId or 'unknown', time.perf_counter() - started)
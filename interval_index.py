@@ -0,0 +1,139 @@
+import datetime
+import random
+import threading
+from collections import OrderedDict
+
+from event_record import DAY, EPOCH_ORDINAL, JST_OFFSET
+
+
+class _Node:
+    __slots__ = ('start', 'end', 'key', 'event', 'priority', 'left', 'right', 'max_end')
+
+    def __init__(self, start, end, key, event):
+        self.start = start
+        self.end = end
+        self.key = key
+        self.event = event
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.max_end = end
+
+
+def _update(node):
+    node.max_end = node.end
+    for child in (node.left, node.right):
+        if child is not None and child.max_end > node.max_end:
+            node.max_end = child.max_end
+    return node
+
+
+def _split(node, key):
+    """Splits a treap into (< key, >= key)."""
+    if node is None:
+        return None, None
+    if node.key < key:
+        node.right, right = _split(node.right, key)
+        return _update(node), right
+    left, node.left = _split(node.left, key)
+    return left, _update(node)
+
+
+def _merge(left, right):
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+class IntervalIndex:
+    """Interval tree (a treap ordered by start time, augmented with the
+    largest end time of each subtree) over the timed events of a calendar.
+
+    Inserts and removals take O(log n) and an overlap query takes
+    O(log n + k) for k overlapping events. The index also remembers which
+    days have been loaded into it, and drops the events of the least
+    recently used days beyond max_days so that a long-running daemon does
+    not keep every event it has ever listed.
+    """
+
+    def __init__(self, max_days=512):
+        self.root = None
+        # event id -> ノードのキー
+        self.keys = {}
+        # 読み込み済みの日 (最近使った順)
+        self.days = OrderedDict()
+        self.max_days = max_days
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def insert(self, event_id, start, end, event):
+        # 長さ0の予定も重なりを判定できるように1秒の幅を持たせる
+        end = max(end, start + 1)
+        with self.lock:
+            self.remove(event_id)
+            key = (start, event_id)
+            left, right = _split(self.root, key)
+            self.root = _merge(_merge(left, _Node(start, end, key, event)), right)
+            self.keys[event_id] = key
+
+    def remove(self, event_id):
+        with self.lock:
+            key = self.keys.pop(event_id, None)
+            if key is None:
+                return
+            left, right = _split(self.root, key)
+            _, right = _split(right, (key[0], key[1] + '\0'))
+            self.root = _merge(left, right)
+
+    def is_loaded(self, day):
+        with self.lock:
+            if day not in self.days:
+                return False
+            self.days.move_to_end(day)
+            return True
+
+    def mark_loaded(self, days):
+        with self.lock:
+            for day in days:
+                self.days[day] = True
+                self.days.move_to_end(day)
+            while len(self.days) > self.max_days:
+                self._evict(next(iter(self.days)))
+
+    def _evict(self, day):
+        start = (day.toordinal() - EPOCH_ORDINAL) * DAY - JST_OFFSET
+        for event in self.overlapping(start, start + DAY):
+            self.remove(event.id)
+            # 日をまたぐ予定が消えた日も読み込み直させる
+            first, last = event.day_ordinals()
+            for ordinal in range(first, last + 1):
+                self.days.pop(datetime.date.fromordinal(ordinal), None)
+        self.days.pop(day, None)
+
+    def overlapping(self, start, end):
+        """Returns the events overlapping [start, end) ordered by start time."""
+        end = max(end, start + 1)
+        found = []
+        with self.lock:
+            stack = []
+            node = self.root
+            # 中順に辿り、max_endが開始時刻以下の部分木は読み飛ばす
+            while stack or node is not None:
+                while node is not None and node.max_end > start:
+                    stack.append(node)
+                    node = node.left
+                if not stack:
+                    break
+                node = stack.pop()
+                if node.start >= end:
+                    break
+                if node.end > start:
+                    found.append(node.event)
+                node = node.right
+        return found
@@ -0,0 +1,167 @@
+import calendar
+import datetime
+
+from event_record import DAY, EPOCH_ORDINAL, JST_OFFSET
+
+WEEK_HEADER = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+# 月表示のセルの幅 (日付と「件数 時間」が入る)
+CELL_WIDTH = 9
+# 年表示のセルの幅 (日付と件数だけ)
+YEAR_CELL_WIDTH = 3
+MONTHS_PER_ROW = 3
+
+
+class DayTotals:
+    """Per-day event counts and busy seconds of a date range, filled in one
+    pass over the events.
+
+    Busy time is the union of the timed events of each day, so overlapping
+    events are not counted twice. The union relies on the events arriving in
+    start time order, as every listing returns them; all-day events are
+    counted but do not make a day busy.
+    """
+
+    def __init__(self, start_date, end_date):
+        self.start_date = start_date
+        self.first = start_date.toordinal()
+        length = (end_date - start_date).days
+        self.counts = [0] * length
+        self.all_day = [0] * length
+        self.busy = [0] * length
+        # 各日でどこまでを忙しい時間として数えたか (エポック秒)
+        self.covered = [0] * length
+        # 月ごとの予定の数 (複数の日にまたがる予定も1件)
+        self.month_counts = {}
+        self.total = 0
+
+    def add(self, event):
+        first, last = event.day_ordinals()
+        lo = max(first - self.first, 0)
+        hi = min(last - self.first + 1, len(self.counts))
+        if lo >= hi:
+            return
+        self.total += 1
+        first_day = datetime.date.fromordinal(self.first + lo)
+        last_day = datetime.date.fromordinal(self.first + hi - 1)
+        for month_index in range(first_day.year * 12 + first_day.month - 1, last_day.year * 12 + last_day.month):
+            key = divmod(month_index, 12)
+            self.month_counts[key] = self.month_counts.get(key, 0) + 1
+        for i in range(lo, hi):
+            self.counts[i] += 1
+            if event.all_day:
+                self.all_day[i] += 1
+                continue
+            day_start = (self.first + i - EPOCH_ORDINAL) * DAY - JST_OFFSET
+            start = max(event.start, day_start, self.covered[i])
+            end = min(event.end, day_start + DAY)
+            if end > start:
+                self.add_busy(i, day_start, start, end)
+                self.covered[i] = end
+
+    def add_busy(self, i, day_start, start, end):
+        """Counts [start, end) of day i, not yet counted, as busy."""
+        self.busy[i] += end - start
+
+    def add_all(self, events):
+        for event in events:
+            self.add(event)
+        return self
+
+    def day(self, date):
+        """Returns (count, busy seconds) of a date in the range."""
+        i = date.toordinal() - self.first
+        return self.counts[i], self.busy[i]
+
+    def month(self, year, month):
+        """Returns (count, busy seconds) of a month in the range."""
+        first = datetime.date(year, month, 1).toordinal() - self.first
+        last = first + calendar.monthrange(year, month)[1]
+        return self.month_counts.get((year, month - 1), 0), sum(self.busy[first:last])
+
+
+def hours(seconds):
+    return f'{seconds / 3600:.1f}h'
+
+
+def month_weeks(year, month):
+    """Returns the weeks of the month as lists of 7 dates (None outside the month)."""
+    return [[day if day.month == month else None for day in week]
+            for week in calendar.Calendar().monthdatescalendar(year, month)]
+
+
+def format_month(year, month, totals):
+    """Draws the month like cal(1), with the event count and the busy hours
+    under each day, and the totals of the month below the grid.
+    """
+    width = CELL_WIDTH * 7
+    lines = [f'{year}/{month:02d}'.center(width).rstrip(),
+             ''.join(name.rjust(CELL_WIDTH) for name in WEEK_HEADER)]
+    busiest = None
+    for week in month_weeks(year, month):
+        numbers = []
+        cells = []
+        for day in week:
+            if day is None:
+                numbers.append(' ' * CELL_WIDTH)
+                cells.append(' ' * CELL_WIDTH)
+                continue
+            count, busy = totals.day(day)
+            numbers.append(str(day.day).rjust(CELL_WIDTH))
+            if not count:
+                cells.append('.'.rjust(CELL_WIDTH))
+            elif busy:
+                cells.append(f'{count} {hours(busy)}'.rjust(CELL_WIDTH))
+            else:
+                cells.append(str(count).rjust(CELL_WIDTH))
+            if count and (busiest is None or busy > busiest[1]):
+                busiest = (day, busy)
+        lines.append(''.join(numbers).rstrip())
+        lines.append(''.join(cells).rstrip())
+    count, busy = totals.month(year, month)
+    summary = f'{count} events, {hours(busy)} busy'
+    if busiest is not None and busiest[1]:
+        summary += f', busiest {busiest[0].strftime("%m/%d")} ({hours(busiest[1])})'
+    lines.append(summary)
+    return '\n'.join(lines) + '\n'
+
+
+def format_small_month(year, month, totals):
+    """Returns the lines of one month of the year view: the day numbers and,
+    under them, the event count of each day.
+    """
+    width = YEAR_CELL_WIDTH * 7
+    count, busy = totals.month(year, month)
+    lines = [f'{month:02d}'.center(width), ''.join(name[:2].rjust(YEAR_CELL_WIDTH) for name in WEEK_HEADER)]
+    for week in month_weeks(year, month):
+        numbers = []
+        counts = []
+        for day in week:
+            if day is None:
+                numbers.append(' ' * YEAR_CELL_WIDTH)
+                counts.append(' ' * YEAR_CELL_WIDTH)
+            else:
+                day_count = totals.day(day)[0]
+                numbers.append(str(day.day).rjust(YEAR_CELL_WIDTH))
+                counts.append((str(day_count) if day_count else '.').rjust(YEAR_CELL_WIDTH))
+        lines.append(''.join(numbers))
+        lines.append(''.join(counts))
+    lines.append(f'{count} ev {hours(busy)}'.rjust(width))
+    return lines
+
+
+def format_year(year, totals):
+    """Draws the twelve months of the year, MONTHS_PER_ROW side by side."""
+    width = YEAR_CELL_WIDTH * 7
+    lines = [str(year).center((width + 2) * MONTHS_PER_ROW).rstrip()]
+    for first_month in range(1, 13, MONTHS_PER_ROW):
+        months = [format_small_month(year, month, totals)
+                  for month in range(first_month, first_month + MONTHS_PER_ROW)]
+        height = max(len(month) for month in months)
+        # 週の数が少ない月は合計の行を最後に揃える
+        months = [month[:-1] + [' ' * width] * (height - len(month)) + month[-1:] for month in months]
+        lines.append('')
+        for row in zip(*months):
+            lines.append('  '.join(row).rstrip())
+    lines.append('')
+    lines.append(f'{totals.total} events, {hours(sum(totals.busy))} busy')
+    return '\n'.join(lines) + '\n'
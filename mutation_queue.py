@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+
+
+class MutationQueue:
+    """Write-ahead journal of add/rm mutations kept in the event store's
+    database, so queued changes survive a restart.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        with store.lock:
+            store.conn.execute('''
+                CREATE TABLE IF NOT EXISTS mutations (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    calendar_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    event_id TEXT NOT NULL,
+                    body TEXT,
+                    created_at REAL NOT NULL
+                )''')
+            store.conn.commit()
+        # 再送しても反映できなかった変更 (queueコマンドで表示する)
+        self.failures = []
+
+    def enqueue(self, calendar_id, kind, event_id, body=None):
+        """Journals a mutation and applies it to the local store at once."""
+        with self.store.lock:
+            self.store.conn.execute(
+                'INSERT INTO mutations (calendar_id, kind, event_id, body, created_at) VALUES (?, ?, ?, ?, ?)',
+                (calendar_id, kind, event_id,
+                 json.dumps(body, ensure_ascii=False) if body is not None else None, time.time()))
+            self._apply_locally(calendar_id, kind, event_id, body)
+            self.store.conn.commit()
+
+    def _apply_locally(self, calendar_id, kind, event_id, body):
+        if kind == 'insert':
+            self.store.upsert(calendar_id, body, commit=False)
+        else:
+            self.store.delete(calendar_id, event_id, commit=False)
+
+    def pending(self):
+        """Returns the queued mutations, oldest first, as dicts."""
+        with self.store.lock:
+            rows = self.store.conn.execute(
+                'SELECT seq, calendar_id, kind, event_id, body FROM mutations ORDER BY seq').fetchall()
+        return [{'seq': seq, 'calendar_id': calendar_id, 'kind': kind, 'event_id': event_id,
+                 'body': json.loads(body) if body else None}
+                for seq, calendar_id, kind, event_id, body in rows]
+
+    def complete(self, seq):
+        with self.store.lock:
+            self.store.conn.execute('DELETE FROM mutations WHERE seq = ?', (seq,))
+            self.store.conn.commit()
+
+    def reapply(self, calendar_id):
+        """Applies the pending mutations of a calendar to the store again,
+        for example after a full sync replaced its contents.
+        """
+        with self.store.lock:
+            for mutation in self.pending():
+                if mutation['calendar_id'] == calendar_id:
+                    self._apply_locally(calendar_id, mutation['kind'],
+                                        mutation['event_id'], mutation['body'])
+            self.store.conn.commit()
+
+
+class Replayer:
+    """Background thread that sends queued mutations to the server in order.
+
+    apply(mutation) returns True when the mutation is done, returns False when
+    the server rejected it for good (it is dropped and recorded as a failure)
+    and raises when it should be retried later.
+    """
+
+    def __init__(self, queue, apply, max_delay=60):
+        self.queue = queue
+        self.apply = apply
+        self.max_delay = max_delay
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def _run(self):
+        delay = 1
+        while True:
+            self.wakeup.wait(timeout=delay if self.queue.pending() else None)
+            self.wakeup.clear()
+            for mutation in self.queue.pending():
+                try:
+                    done = self.apply(mutation)
+                except Exception:
+                    # 送れなかったので順番を保ったまま後で再送する
+                    delay = min(delay * 2, self.max_delay)
+                    break
+                if not done:
+                    self.queue.failures.append(mutation)
+                self.queue.complete(mutation['seq'])
+            else:
+                delay = 1
@@ -0,0 +1,217 @@
+"""Paths of the calendar directories (YYYY/MM/DD).
+
+A path is compiled once into steps (up, match a level) and resolved against
+the current directory. Both are memoised, so resolving the same path again,
+as scripts and the prefetch of run_script do, costs a dictionary lookup.
+
+Besides ".", "..", "..." (up two levels, the same as "../..") and absolute
+(YYYY/MM/DD) or half-absolute (MM/DD) paths, a path may use
+    {01..07} {01,15}  brace ranges and lists (expanded first, like a shell)
+    * ? [1-3]         globs matched against the months or the days of the month
+"""
+import calendar
+import fnmatch
+import functools
+import re
+
+GLOB_CHARACTERS = '*?['
+BRACE_RANGE = re.compile(r'^(-?\d+)\.\.(-?\d+)$')
+# 1つのパスが展開できる日付の上限 (YYYY/{0001..9999}/... のような誤りを防ぐ)
+MAX_EXPANSION = 4096
+
+
+class PathError(ValueError):
+    """The path does not name a directory."""
+
+
+def expand_braces(path):
+    """Expands the first {a..b} or {a,b,...} of path and then the rest,
+    returning the paths in order.
+    """
+    start = path.find('{')
+    if start < 0:
+        return [path]
+    depth = 0
+    for end in range(start, len(path)):
+        if path[end] == '{':
+            depth += 1
+        elif path[end] == '}':
+            depth -= 1
+            if depth == 0:
+                break
+    else:
+        raise PathError("unmatched {")
+    body = path[start + 1:end]
+    match = BRACE_RANGE.match(body)
+    if match:
+        first, last = int(match.group(1)), int(match.group(2))
+        step = 1 if first <= last else -1
+        # 先頭が0の範囲 ({01..07}) は同じ桁数で埋める
+        padded = any(len(bound.lstrip('-')) > 1 and bound.lstrip('-')[0] == '0' for bound in match.groups())
+        width = max(len(bound) for bound in match.groups()) if padded else 0
+        if abs(last - first) >= MAX_EXPANSION:
+            raise PathError(f"range {{{body}}} is too long")
+        items = [str(n).zfill(width) for n in range(first, last + step, step)]
+    else:
+        items = split_brace_list(body)
+    expanded = []
+    for item in items:
+        expanded.extend(expand_braces(path[:start] + item + path[end + 1:]))
+        if len(expanded) > MAX_EXPANSION:
+            raise PathError("the path names too many directories")
+    return expanded
+
+
+def split_brace_list(body):
+    """Splits "a,b,{c,d}" on the commas that are not inside nested braces."""
+    items = []
+    depth = 0
+    current = ''
+    for character in body:
+        if character == ',' and depth == 0:
+            items.append(current)
+            current = ''
+            continue
+        depth += character == '{'
+        depth -= character == '}'
+        current += character
+    items.append(current)
+    return items
+
+
+def is_glob(component):
+    return any(character in component for character in GLOB_CHARACTERS)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_path(path):
+    """Compiles a path into alternatives of (anchor, steps).
+
+    anchor is "root" for absolute paths, "year" for half-absolute ones
+    (resolved from the current year) and "current" otherwise. Steps are
+    ("up", levels) and ("match", component).
+    """
+    alternatives = []
+    for expanded in expand_braces(path):
+        components = expanded.split('/')
+        if len(components) > 1 and components[-1] == '':
+            # 末尾の / は無視する
+            components.pop()
+        dots = {'.', '..', '...'}
+        if len(components[0]) == 4 and components[0].isdecimal():
+            anchor = 'root'
+        elif len(components) == 2 and not dots & set(components) and '' not in components:
+            anchor = 'year'
+        else:
+            anchor = 'current'
+        steps = []
+        for component in components:
+            if component == '.':
+                continue
+            if component in ('..', '...'):
+                steps.append(('up', len(component) - 1))
+            elif component:
+                steps.append(('match', component))
+            elif len(components) > 1:
+                raise PathError("empty directory name")
+        alternatives.append((anchor, tuple(steps)))
+    return tuple(alternatives)
+
+
+def level(directory):
+    """Returns how many of year, month and date are set."""
+    year, month, date = directory
+    return 3 if date else 2 if month else 1 if year else 0
+
+
+def up(directory, levels):
+    for _ in range(levels):
+        depth = level(directory)
+        if depth == 0:
+            raise PathError("already at the top directory")
+        directory = directory[:depth - 1] + (None,) * (4 - depth)
+    return directory
+
+
+def children(directory):
+    """Returns the names of the directories under a year or a month."""
+    year, month, _ = directory
+    if month:
+        return [f'{day:02d}' for day in range(1, calendar.monthrange(int(year), int(month))[1] + 1)]
+    return [f'{month:02d}' for month in range(1, 13)]
+
+
+def enter(directory, component):
+    """Returns the directories component matches under directory."""
+    depth = level(directory)
+    if depth == 3:
+        raise PathError("already at the bottom directory")
+    if depth == 0:
+        if is_glob(component):
+            raise PathError("the year cannot be a pattern")
+        if not component.isdecimal() or not 1 <= int(component) <= 9999:
+            raise PathError(f"no such year : {component}")
+        return [(str(int(component)), None, None)]
+    names = children(directory)
+    if is_glob(component):
+        matched = [name for name in names if fnmatch.fnmatchcase(name, component)]
+    elif component.isdecimal() and 1 <= int(component) <= len(names):
+        matched = [names[int(component) - 1]]
+    else:
+        kind = 'date' if depth == 2 else 'month'
+        raise PathError(f"no such {kind} : {component}")
+    return [directory[:depth] + (name,) + (None,) * (2 - depth) for name in matched]
+
+
+@functools.lru_cache(maxsize=1024)
+def resolve_paths(current, path):
+    """Returns the (year, month, date) directories path names from current,
+    in the order of the path. Raises PathError when it names none.
+
+    Names that do not exist under some of the matched directories (the 31st
+    of 2024/*/31 or {28..31} in February) are skipped when the path is a
+    pattern, and are errors otherwise.
+    """
+    alternatives = compile_path(path)
+    pattern = len(alternatives) > 1 or any(
+        kind == 'match' and is_glob(argument) for _, steps in alternatives for kind, argument in steps)
+    resolved = []
+    seen = set()
+    error = None
+    for anchor, steps in alternatives:
+        if anchor == 'root':
+            directories = [(None, None, None)]
+        elif anchor == 'year' and current[0]:
+            directories = [(str(current[0]), None, None)]
+        else:
+            directories = [current]
+        for kind, argument in steps:
+            if kind == 'up':
+                directories = [up(directory, argument) for directory in directories]
+            else:
+                entered = []
+                for directory in directories:
+                    try:
+                        entered.extend(enter(directory, argument))
+                    except PathError as e:
+                        if not pattern:
+                            raise
+                        error = e
+                directories = entered
+            if len(directories) > MAX_EXPANSION:
+                raise PathError("the path names too many directories")
+        for directory in directories:
+            if directory not in seen:
+                seen.add(directory)
+                resolved.append(directory)
+    if not resolved:
+        raise error or PathError("no directory matches")
+    return tuple(resolved)
+
+
+def resolve_path(current, path):
+    """Returns the one directory path names from current."""
+    resolved = resolve_paths(tuple(current), path)
+    if len(resolved) > 1:
+        raise PathError(f"matches {len(resolved)} directories")
+    return resolved[0]
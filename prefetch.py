@@ -0,0 +1,171 @@
+import datetime
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+class DayCache:
+    """LRU cache of the events of one calendar day with a TTL.
+
+    Keys are (calendar_id, date) and values are lists of events.
+    """
+
+    def __init__(self, max_days=512, ttl=300):
+        self.max_days = max_days
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key, now):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, events = entry
+        if now - stored_at > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return events
+
+    def get_range(self, calendar_id, start_date, end_date, count=True):
+        """Returns [events of each day] or None if any day is missing or expired."""
+        now = time.monotonic()
+        days = []
+        with self.lock:
+            day = start_date
+            while day < end_date:
+                events = self._get((calendar_id, day), now)
+                if events is None:
+                    if count:
+                        self.misses += 1
+                    return None
+                days.append(events)
+                day += datetime.timedelta(days=1)
+            if count:
+                self.hits += 1
+        return days
+
+    def put_days(self, calendar_id, events_by_day):
+        now = time.monotonic()
+        with self.lock:
+            for day, events in events_by_day.items():
+                self.entries[(calendar_id, day)] = (now, events)
+                self.entries.move_to_end((calendar_id, day))
+            while len(self.entries) > self.max_days:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, calendar_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == calendar_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ValidatorCache:
+    """LRU cache of the ETag and the events of the last answer to a listing,
+    so that a listing whose days have expired from the DayCache can be
+    revalidated with If-None-Match instead of downloaded again.
+
+    Keys start with the calendar id; values are (etag, events).
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.revalidated = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, etag, events):
+        with self.lock:
+            self.entries[key] = (etag, events)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def not_modified(self, key):
+        """Returns the events of key after a 304 Not Modified answer."""
+        with self.lock:
+            self.revalidated += 1
+            return self.entries[key][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class Prefetcher:
+    """Background thread that warms a DayCache with windows around the
+    current directory.
+
+    Every schedule() call starts a new generation, so windows queued for a
+    directory the user has already left are dropped instead of fetched.
+    """
+
+    def __init__(self, cache, load):
+        # load(calendar_id, (start_date, end_date)) を呼ぶとキャッシュが埋まる
+        self.cache = cache
+        self.load = load
+        self.jobs = queue.Queue()
+        self.generation = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, calendar_ids, windows):
+        """Replaces the pending windows. Earlier windows are fetched first."""
+        self.generation += 1
+        for window in windows:
+            for calendar_id in calendar_ids:
+                self.jobs.put((self.generation, calendar_id, window))
+
+    def cancel(self):
+        self.generation += 1
+
+    def _run(self):
+        while True:
+            generation, calendar_id, window = self.jobs.get()
+            if generation != self.generation:
+                continue
+            if self.cache.get_range(calendar_id, *window, count=False) is not None:
+                continue
+            try:
+                self.load(calendar_id, window)
+            except Exception:
+                # 先読みの失敗は表示せず、lsのときに改めて取得する
+                pass
+
+
+def neighbour_windows(year, month, date):
+    """Returns the windows to prefetch for a directory, nearest first: the day,
+    its week (Mon-Sun), the current month and then the previous and next months.
+    """
+    if not year or not month:
+        return []
+    year = int(year)
+    month = int(month)
+    windows = []
+    if date:
+        day = datetime.date(year, month, int(date))
+        windows.append((day, day + datetime.timedelta(days=1)))
+        monday = day - datetime.timedelta(days=day.weekday())
+        windows.append((monday, monday + datetime.timedelta(days=7)))
+    first = datetime.date(year, month, 1)
+    previous_month = (first - datetime.timedelta(days=1)).replace(day=1)
+    next_month = (first + datetime.timedelta(days=32)).replace(day=1)
+    after_next_month = (next_month + datetime.timedelta(days=32)).replace(day=1)
+    windows.append((first, next_month))
+    windows.append((previous_month, first))
+    windows.append((next_month, after_next_month))
+    return windows
@@ -0,0 +1,318 @@
+import calendar
+import datetime
+import heapq
+
+import pytz
+
+WEEKDAYS = {'MO': 0, 'TU': 1, 'WE': 2, 'TH': 3, 'FR': 4, 'SA': 5, 'SU': 6}
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+# 展開できるRRULEの要素 (それ以外を含むシリーズはサーバーに展開してもらう)
+SUPPORTED_PARTS = {'FREQ', 'INTERVAL', 'COUNT', 'UNTIL', 'BYDAY', 'BYMONTHDAY', 'BYMONTH', 'WKST'}
+
+
+class UnsupportedRecurrence(ValueError):
+    """The recurrence uses RRULE parts that are not expanded locally."""
+
+
+class Rule:
+    """One parsed RRULE."""
+
+    def __init__(self, value):
+        parts = dict(part.split('=', 1) for part in value.split(';') if '=' in part)
+        unsupported = set(parts) - SUPPORTED_PARTS
+        if unsupported or parts.get('FREQ') not in FREQUENCIES:
+            raise UnsupportedRecurrence(value)
+        self.freq = parts['FREQ']
+        self.interval = int(parts.get('INTERVAL', 1))
+        self.count = int(parts['COUNT']) if 'COUNT' in parts else None
+        self.until = parts.get('UNTIL')
+        self.by_day = []
+        for day in parts['BYDAY'].split(',') if 'BYDAY' in parts else []:
+            ordinal, weekday = day[:-2], day[-2:]
+            if weekday not in WEEKDAYS:
+                raise UnsupportedRecurrence(value)
+            self.by_day.append((int(ordinal) if ordinal else None, WEEKDAYS[weekday]))
+        self.by_month_day = [int(day) for day in parts['BYMONTHDAY'].split(',')] if 'BYMONTHDAY' in parts else []
+        self.by_month = [int(month) for month in parts['BYMONTH'].split(',')] if 'BYMONTH' in parts else []
+        if self.freq in ('DAILY', 'WEEKLY') and any(ordinal for ordinal, _ in self.by_day):
+            raise UnsupportedRecurrence(value)
+        if self.freq == 'YEARLY' and not self.by_month and any(ordinal for ordinal, _ in self.by_day):
+            # 年の何番目の曜日という指定は扱わない
+            raise UnsupportedRecurrence(value)
+
+    def dates(self, first, skip_to=None):
+        """Yields the dates of the rule from first (the DTSTART date) in order.
+
+        skip_to lets rules without COUNT start near a later date instead of
+        walking every period since DTSTART.
+        """
+        periods = 0
+        if skip_to is not None and self.count is None and skip_to > first:
+            periods = max(self.periods_between(first, skip_to) // self.interval - 1, 0)
+        while True:
+            for day in self.period_dates(first, periods * self.interval):
+                if day >= first:
+                    yield day
+            periods += 1
+            if periods * self.interval > 100000:
+                return
+
+    def periods_between(self, first, day):
+        if self.freq == 'DAILY':
+            return (day - first).days
+        if self.freq == 'WEEKLY':
+            return (day - first).days // 7
+        if self.freq == 'MONTHLY':
+            return (day.year - first.year) * 12 + day.month - first.month
+        return day.year - first.year
+
+    def period_dates(self, first, offset):
+        """Returns the sorted dates of the period offset periods after first."""
+        if self.freq == 'DAILY':
+            day = first + datetime.timedelta(days=offset)
+            return [day] if self.matches(day) else []
+        if self.freq == 'WEEKLY':
+            monday = first - datetime.timedelta(days=first.weekday()) + datetime.timedelta(weeks=offset)
+            weekdays = sorted({weekday for _, weekday in self.by_day}) or [first.weekday()]
+            days = [monday + datetime.timedelta(days=weekday) for weekday in weekdays]
+            return [day for day in days if not self.by_month or day.month in self.by_month]
+        if self.freq == 'MONTHLY':
+            month_index = first.year * 12 + first.month - 1 + offset
+            year, month = divmod(month_index, 12)
+            if self.by_month and month + 1 not in self.by_month:
+                return []
+            return self.month_dates(first, year, month + 1)
+        year = first.year + offset
+        days = []
+        for month in self.by_month or [first.month]:
+            days.extend(self.month_dates(first, year, month))
+        return sorted(days)
+
+    def month_dates(self, first, year, month):
+        length = calendar.monthrange(year, month)[1]
+        candidates = None
+        if self.by_month_day:
+            candidates = {day if day > 0 else length + day + 1 for day in self.by_month_day}
+            candidates = {day for day in candidates if 1 <= day <= length}
+        if self.by_day:
+            weekday_days = set()
+            for ordinal, weekday in self.by_day:
+                days = [day for day in range(1, length + 1)
+                        if datetime.date(year, month, day).weekday() == weekday]
+                if ordinal is None:
+                    weekday_days.update(days)
+                elif -len(days) <= ordinal <= len(days) and ordinal != 0:
+                    weekday_days.add(days[ordinal - 1 if ordinal > 0 else ordinal])
+            candidates = weekday_days if candidates is None else candidates & weekday_days
+        if candidates is None:
+            candidates = {first.day} if first.day <= length else set()
+        return [datetime.date(year, month, day) for day in sorted(candidates)]
+
+    def matches(self, day):
+        """Filter used by DAILY rules."""
+        if self.by_month and day.month not in self.by_month:
+            return False
+        if self.by_month_day:
+            length = calendar.monthrange(day.year, day.month)[1]
+            if day.day not in {d if d > 0 else length + d + 1 for d in self.by_month_day}:
+                return False
+        if self.by_day and day.weekday() not in {weekday for _, weekday in self.by_day}:
+            return False
+        return True
+
+
+class Recurrence:
+    """The recurrence of a master event: RRULEs, RDATEs and EXDATEs
+    expanded in the time zone of the event.
+    """
+
+    def __init__(self, event):
+        start = event.get('start', {})
+        end = event.get('end', {})
+        self.all_day = 'dateTime' not in start
+        if self.all_day:
+            self.tz = pytz.timezone('Asia/Tokyo')
+            first = datetime.date.fromisoformat(start['date'])
+            self.time = datetime.time()
+            last = datetime.date.fromisoformat(end.get('date', start['date']))
+            self.duration = datetime.timedelta(days=max((last - first).days, 1))
+        else:
+            start_dt = parse_datetime(start['dateTime'])
+            end_dt = parse_datetime(end.get('dateTime', start['dateTime']))
+            self.tz = zone(start.get('timeZone'), start_dt)
+            local = start_dt.astimezone(self.tz)
+            first = local.date()
+            self.time = local.time().replace(tzinfo=None)
+            self.duration = end_dt - start_dt
+        self.first = first
+        self.rules = []
+        self.rdates = []
+        self.exdates = set()
+        for line in event.get('recurrence', []):
+            name, _, value = line.partition(':')
+            name, _, params = name.partition(';')
+            if name == 'RRULE':
+                self.rules.append(Rule(value))
+            elif name in ('EXDATE', 'RDATE'):
+                moments = [self.moment(item, params) for item in value.split(',')]
+                if name == 'EXDATE':
+                    self.exdates.update(moment.timestamp() for moment in moments)
+                else:
+                    self.rdates.extend(moments)
+            else:
+                raise UnsupportedRecurrence(line)
+
+    def moment(self, value, params):
+        """Converts an EXDATE/RDATE value to an aware datetime."""
+        if 'VALUE=PERIOD' in params:
+            raise UnsupportedRecurrence(value)
+        if 'T' not in value:
+            day = datetime.datetime.strptime(value, '%Y%m%d').date()
+            return self.localize(day)
+        if value.endswith('Z'):
+            return pytz.utc.localize(datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ'))
+        tz = self.tz
+        for param in params.split(';'):
+            if param.startswith('TZID='):
+                tz = zone(param[5:], None)
+        return tz.localize(datetime.datetime.strptime(value, '%Y%m%dT%H%M%S'))
+
+    def localize(self, day):
+        return self.tz.localize(datetime.datetime.combine(day, self.time))
+
+    def until(self, rule):
+        if rule.until is None:
+            return None
+        if 'T' in rule.until:
+            return self.moment(rule.until, '').timestamp()
+        # 日付だけのUNTILはその日の開始までを含む
+        return self.localize(datetime.datetime.strptime(rule.until, '%Y%m%d').date()).timestamp()
+
+    def starts(self, skip_to=None):
+        """Yields the aware start datetimes of the instances in order,
+        without the EXDATEs.
+        """
+        streams = [self.rule_starts(rule, skip_to) for rule in self.rules]
+        streams.append(iter(sorted(self.rdates)))
+        last = None
+        for moment in heapq.merge(*streams):
+            if moment == last or moment.timestamp() in self.exdates:
+                continue
+            last = moment
+            yield moment
+
+    def rule_starts(self, rule, skip_to):
+        until = self.until(rule)
+        for i, day in enumerate(rule.dates(self.first, skip_to)):
+            moment = self.localize(day)
+            if until is not None and moment.timestamp() > until:
+                return
+            if rule.count is not None and i >= rule.count:
+                return
+            yield moment
+
+    def between(self, start_ts, end_ts):
+        """Yields (start, end) aware datetimes of the instances overlapping
+        [start_ts, end_ts).
+        """
+        skip_to = datetime.datetime.fromtimestamp(start_ts - self.duration.total_seconds(), self.tz).date()
+        for moment in self.starts(skip_to):
+            if moment.timestamp() >= end_ts:
+                return
+            end = moment + self.duration
+            if end.timestamp() > start_ts or (moment.timestamp() >= start_ts and end == moment):
+                yield moment, end
+
+    def series_end(self):
+        """Returns the epoch seconds the last instance ends at, or inf for
+        series without COUNT or UNTIL.
+        """
+        if any(rule.count is None and rule.until is None for rule in self.rules):
+            return float('inf')
+        last = None
+        for last in self.starts():
+            pass
+        return (last + self.duration).timestamp() if last is not None else 0.0
+
+
+def zone(name, moment):
+    """Returns the pytz zone of an event, or its fixed offset when the name is
+    unknown.
+    """
+    try:
+        return pytz.timezone(name or '')
+    except pytz.UnknownTimeZoneError:
+        if moment is None or moment.utcoffset() is None:
+            return pytz.timezone('Asia/Tokyo')
+        return pytz.FixedOffset(int(moment.utcoffset().total_seconds() // 60))
+
+
+def parse_datetime(value):
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = pytz.timezone('Asia/Tokyo').localize(moment)
+    return moment
+
+
+def instance_id(master_id, start, all_day):
+    """Builds the id the API gives to an instance of a recurring event."""
+    if all_day:
+        return f'{master_id}_{start.strftime("%Y%m%d")}'
+    return f'{master_id}_{start.astimezone(pytz.utc).strftime("%Y%m%dT%H%M%SZ")}'
+
+
+def parse_instance_id(event_id):
+    """Returns (master id, original start epoch seconds) of an id built by
+    instance_id, or None for any other id.
+    """
+    master_id, separator, suffix = event_id.rpartition('_')
+    if not separator or not master_id:
+        return None
+    try:
+        if len(suffix) == 8:
+            day = datetime.datetime.strptime(suffix, '%Y%m%d')
+            return master_id, pytz.timezone('Asia/Tokyo').localize(day).timestamp()
+        moment = datetime.datetime.strptime(suffix, '%Y%m%dT%H%M%SZ')
+    except ValueError:
+        return None
+    return master_id, pytz.utc.localize(moment).timestamp()
+
+
+def instance(master, start, end, all_day):
+    """Builds the events resource of one instance of master."""
+    event = {key: value for key, value in master.items() if key != 'recurrence'}
+    event['id'] = instance_id(master['id'], start, all_day)
+    event['recurringEventId'] = master['id']
+    if all_day:
+        event['start'] = {'date': start.date().isoformat()}
+        event['end'] = {'date': end.date().isoformat()}
+    else:
+        time_zone = master['start'].get('timeZone')
+        event['start'] = dict({'dateTime': start.isoformat()}, **({'timeZone': time_zone} if time_zone else {}))
+        event['end'] = dict({'dateTime': end.isoformat()}, **({'timeZone': time_zone} if time_zone else {}))
+    event['originalStartTime'] = event['start']
+    return event
+
+
+def expand(master, start_ts, end_ts, overridden=()):
+    """Yields (start_ts, instance resource) for the instances of master
+    overlapping [start_ts, end_ts) in start order, leaving out the original
+    start times in overridden (instances modified or cancelled on their own).
+    """
+    recurrence = Recurrence(master)
+    for start, end in recurrence.between(start_ts, end_ts):
+        timestamp = start.timestamp()
+        if timestamp in overridden:
+            continue
+        yield timestamp, instance(master, start, end, recurrence.all_day)
+
+
+def original_start_ts(event):
+    """Returns the epoch seconds of the originalStartTime of an exception."""
+    original = event.get('originalStartTime', {})
+    if 'dateTime' in original:
+        return parse_datetime(original['dateTime']).timestamp()
+    day = datetime.date.fromisoformat(original['date'])
+    return pytz.timezone('Asia/Tokyo').localize(datetime.datetime.combine(day, datetime.time())).timestamp()
@@ -1,34 +1,142 @@
 from __future__ import print_function
 
+import time
+# 起動時間の計測を始める (--profile-startup)
+startup_started = time.perf_counter()
+
+import argparse
+import calendar
+import contextlib
+import copy
 import datetime
+import io
+import json
 import os
 import os.path
+import sys
+import threading
+import heapq
 import pytz
+from concurrent.futures import ThreadPoolExecutor
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+# httplib2やgoogle.authなどの重いモジュールはload_client_libraries()で後から読み込む
 from googleapiclient.errors import HttpError
 
+from event_record import EventRecord, format_events
+from event_store import EventStore, event_range
+from instrumentation import stats
+from interval_index import IntervalIndex
+from month_grid import DayTotals, format_month, format_year
+from mutation_queue import MutationQueue, Replayer
+from paths import PathError, resolve_path, resolve_paths
+from prefetch import DayCache, Prefetcher, ValidatorCache, neighbour_windows
+from scheduler import BACKGROUND, BULK, is_idempotent, is_retryable, lane, scheduler
+
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
+# 同梱したCalendar v3のディスカバリードキュメント (起動時のネットワークアクセスを省く)
+DISCOVERY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calendar_v3_discovery.json')
+discovery_document = None
+
+# 予定のローカルキャッシュ (token.jsonと同じ場所に作成される)
+STORE_FILE = 'events.db'
+event_store = None
+
+# オフラインモードではadd/rmをジャーナルに書いてすぐに戻り、バックグラウンドで送信する
+offline_mode = False
+mutation_queue = None
+replayer = None
+# ネットワークに繋がらないときに発生する例外 (httplib2とgoogle.authの例外は読み込み時に追加する)
+NETWORK_ERRORS = (OSError,)
+client_libraries_loaded = False
+
+# 1回のバッチリクエストにまとめる要求の最大数 (Calendar APIの上限は50)
+BATCH_SIZE = 50
+
+# 複数のカレンダーを同時に取得するときのスレッド数
+MAX_WORKERS = 4
+worker_local = threading.local()
+
+# calendarList().listの結果 (セッション中は使い回す)
+calendar_list_cache = None
+# 複数カレンダー表示で表示した予定のid -> その予定があるカレンダーidの集合
+# (共有・取り込みで同じidの予定が複数のカレンダーにあることがある)
+event_calendars = {}
+
+# importで同時に送るバッチリクエストの数
+IMPORT_CONCURRENCY = 2
+
+# カレンダーid -> 読み込んだ予定の区間木 (addで重なる予定を探す)
+interval_indexes = {}
+
+# exportで書き出せる形式
+EXPORT_FORMATS = ('ics', 'jsonl', 'csv')
+
+# editで変更できる項目 (edit {id} summary=... date=... time=...)
+EDIT_FIELDS = ('summary', 'date', 'time', 'location', 'description')
+
+# 一覧で取得するフィールド (fields=による部分レスポンス)。表示に使うのはid・summary・start・endだけ
+# 応答はgoogleapiclientが付けるAccept-Encoding: gzipで圧縮される。etagは再検証 (If-None-Match) に使う
+LIST_PROJECTIONS = {
+    'minimal': 'etag,nextPageToken,items(id,summary,start,end)',
+    'full': '*',
+}
+list_fields = LIST_PROJECTIONS['minimal']
+# fieldsで指定しても必ず取得する予定のフィールド
+LIST_ITEM_FIELDS = ('id', 'start', 'end')
+
+# 日ごとの予定のキャッシュ (cdの後に周辺の日付を先読みする)
+day_cache = DayCache()
+# (カレンダーid, 開始日, 終了日, fields) -> 最後に取得した一覧のetagと予定
+listing_validators = ValidatorCache()
+
+# プロンプトを表示するまでの目標時間 (ミリ秒)
+STARTUP_TARGET_MS = 100
+
+def load_client_libraries():
+    """Imports the Google client libraries, which take most of the startup time.
+
+    run.py uses them only through the service, so they are imported the first
+    time it is built (normally in the background thread of start_session).
+    """
+    global NETWORK_ERRORS, client_libraries_loaded
+    if client_libraries_loaded:
+        return
+    started = time.perf_counter()
+    import httplib2
+    from google.auth.exceptions import TransportError
+    import google_auth_httplib2
+    import googleapiclient.discovery
+    import instrumented_http
+    NETWORK_ERRORS = (OSError, httplib2.HttpLib2Error, TransportError)
+    client_libraries_loaded = True
+    stats.record('startup', 'import client libraries', time.perf_counter() - started)
+
 def init():
     """Shows basic usage of the Google Calendar API.
     Prints the start and name of the next 10 events on the user's calendar.
     """
+    load_client_libraries()
+    from google_auth_httplib2 import Request
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
     if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        creds = token_saving_credentials().from_authorized_user_file('token.json', SCOPES)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+            started = time.perf_counter()
+            try:
+                creds.refresh(Request(httplib2_http()))
+            except NETWORK_ERRORS:
+                # オフラインのときは後でAuthorizedHttpが更新する
+                pass
+            stats.record('startup', 'token refresh', time.perf_counter() - started)
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
                 'credentials.json', SCOPES)
             creds = flow.run_local_server(port=0)
@@ -36,12 +144,290 @@ def init():
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
 
-    return creds
+    return build_service(creds)
+
+def httplib2_http():
+    from instrumented_http import InstrumentedHttp
+    return InstrumentedHttp(timeout=30)
+
+token_saving_credentials_class = None
+
+def token_saving_credentials():
+    """Returns a Credentials subclass that writes token.json again whenever it
+    is refreshed. It is defined on first use so google.oauth2 is not imported
+    before the prompt.
+    """
+    global token_saving_credentials_class
+    if token_saving_credentials_class is None:
+        from google.oauth2.credentials import Credentials
+
+        class TokenSavingCredentials(Credentials):
+            def refresh(self, request):
+                super().refresh(request)
+                with open('token.json', 'w') as token:
+                    token.write(self.to_json())
 
-def create_event(creds, calendar_id, event_summary, year, month, date, start_time, end_time):
-    service = build('calendar', 'v3', credentials=creds)
+        token_saving_credentials_class = TokenSavingCredentials
+    return token_saving_credentials_class
+
+def build_service(creds):
+    """Builds the Calendar service once for the whole session.
+
+    The discovery document is read from the bundled file and all requests share
+    one keep-alive connection. Expired tokens are refreshed by AuthorizedHttp.
+    """
+    load_client_libraries()
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build_from_document
+    from instrumented_http import InstrumentedRequest
+    if not isinstance(creds, token_saving_credentials()):
+        creds = token_saving_credentials().from_authorized_user_info(
+            json.loads(creds.to_json()), SCOPES)
+    started = time.perf_counter()
+    http = AuthorizedHttp(creds, http=httplib2_http())
+    service = build_from_document(load_discovery(), http=http, requestBuilder=InstrumentedRequest)
+    stats.record('startup', 'build service', time.perf_counter() - started)
+    return service
+
+class Session:
+    """Stands in for the Calendar service while init() runs in a background
+    thread, so the prompt is shown before the client libraries are imported
+    and the token is refreshed. The first attribute access waits for it.
+    """
+
+    def __init__(self, build):
+        self._service = None
+        self._error = None
+        self._ready = threading.Event()
+        threading.Thread(target=self._build, args=(build,), daemon=True).start()
+
+    def _build(self, build):
+        started = time.perf_counter()
+        try:
+            self._service = build()
+        except BaseException as e:
+            self._error = e
+        stats.record('startup', 'session ready', time.perf_counter() - started)
+        self._ready.set()
+
+    def wait(self):
+        if not self._ready.is_set():
+            started = time.perf_counter()
+            self._ready.wait()
+            stats.record('startup', 'wait for session', time.perf_counter() - started)
+        if self._error is not None:
+            raise self._error
+        return self._service
+
+    def __getattr__(self, name):
+        return getattr(self.wait(), name)
+
+def start_session():
+    """Returns the service, built in the background when token.json exists.
+
+    Without token.json the browser login has to finish first, so init() runs
+    before the prompt as before.
+    """
+    if not os.path.exists('token.json'):
+        return init()
+    return Session(init)
+
+def load_discovery():
+    global discovery_document
+    if discovery_document is None:
+        with open(DISCOVERY_FILE, encoding='utf-8') as f:
+            discovery_document = f.read()
+    return discovery_document
+
+def worker_service(service):
+    """Returns a service for the current worker thread.
+
+    httplib2.Http is not thread-safe, so each worker thread gets its own
+    Http of the same class, with its own keep-alive connections, sharing the
+    session credentials and settings. The worker
+    service is built from the discovery document of the given service, so it
+    sends to the same endpoint (rootUrl and batch path) as the service.
+    """
+    if threading.current_thread() is threading.main_thread() or service is getattr(worker_local, 'service', None):
+        return service
+    if getattr(worker_local, 'parent', None) is not service:
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build_from_document
+        http = service._http
+        if isinstance(http, AuthorizedHttp):
+            http = AuthorizedHttp(http.credentials, http=httplib2_http())
+        else:
+            # 認証なしのHttp (ベンチマークなど) も設定はそのままで接続だけを分ける
+            http = copy.copy(http)
+            http.connections = {}
+            http.authorizations = []
+        worker_local.service = build_from_document(
+            service._rootDesc, http=http, requestBuilder=service._requestBuilder)
+        worker_local.parent = service
+    return worker_local.service
+
+def create_event(service, calendar_id, event_summary, year, month, date, start_time, end_time, batch=None):
     print("create_event")
+    # 複数カレンダー表示では最初のカレンダーに追加する
+    calendar_id = as_calendar_ids(calendar_id)[0]
+    event = build_event_body(event_summary, year, month, date, start_time, end_time)
+
+    conflicts = find_conflicts(service, calendar_id, event)
+    if conflicts:
+        print("This event overlaps with:")
+        print_events(conflicts)
+
+    if offline_mode:
+        queue_event_insert(calendar_id, event)
+        return
+
+    def done(results):
+        (created, exception), = results
+        if exception is not None:
+            print(f"Error: event is not created. {exception}")
+            return
+        if event_store is not None:
+            event_store.upsert(calendar_id, created)
+        day_cache.invalidate(calendar_id)
+        index_event(calendar_id, EventRecord.from_resource(created))
+        print(f"Event created: {created.get('id')}")
 
+    def failed(e):
+        print(f"Network is unavailable. {e}")
+        queue_event_insert(calendar_id, event)
+
+    # 予定を作成 (スクリプトでは他の書き込みとまとめて送る)
+    request = service.events().insert(calendarId=calendar_id, body=event)
+    if batch is not None:
+        batch.add([request], done, failed)
+        return
+    try:
+        results = [(request.execute(), None)]
+    except HttpError as e:
+        results = [(None, e)]
+    except NETWORK_ERRORS as e:
+        failed(e)
+        return
+    done(results)
+
+def interval_index(calendar_id):
+    if calendar_id not in interval_indexes:
+        interval_indexes[calendar_id] = IntervalIndex()
+    return interval_indexes[calendar_id]
+
+def index_event(calendar_id, event):
+    """Adds a timed EventRecord to the calendar's interval index. All-day
+    events are not indexed since they do not block time.
+    """
+    if event.all_day or not event.id:
+        return
+    interval_index(calendar_id).insert(event.id, event.start, event.end, event)
+
+def index_window(calendar_id, window, events):
+    """Brings the window's part of the interval index in line with the events
+    just loaded for it.
+    """
+    jst = pytz.timezone('Asia/Tokyo')
+    start_date, end_date = window
+    start_ts = jst.localize(datetime.datetime.combine(start_date, datetime.time())).timestamp()
+    end_ts = jst.localize(datetime.datetime.combine(end_date, datetime.time())).timestamp()
+    index = interval_index(calendar_id)
+    with index.lock:
+        # 他の端末で削除された予定を取り除く
+        loaded_ids = {event.id for event in events}
+        for event in index.overlapping(start_ts, end_ts):
+            if event.id not in loaded_ids:
+                index.remove(event.id)
+        for event in events:
+            index_event(calendar_id, event)
+        index.mark_loaded(start_date + datetime.timedelta(days=i)
+                          for i in range((end_date - start_date).days))
+
+def local_event(event):
+    """Returns the event with a JST offset on dateTime values that have none."""
+    event = dict(event)
+    for key in ('start', 'end'):
+        if 'dateTime' in event.get(key, {}) and event[key]['dateTime'][-6] not in '+-' \
+                and not event[key]['dateTime'].endswith('Z'):
+            event[key] = dict(event[key], dateTime=event[key]['dateTime'] + '+09:00')
+    return event
+
+def find_conflicts(service, calendar_id, event):
+    """Returns the loaded events overlapping a new timed event. The week of
+    the event is loaded into the index first if it has not been yet.
+    """
+    if 'dateTime' not in event['start']:
+        return []
+    start_ts, end_ts = event_range(local_event(event))
+    jst = pytz.timezone('Asia/Tokyo')
+    day = datetime.datetime.fromtimestamp(start_ts, jst).date()
+    index = interval_index(calendar_id)
+    if not index.is_loaded(day):
+        monday = day - datetime.timedelta(days=day.weekday())
+        load_windows(service, calendar_id, [(monday, monday + datetime.timedelta(days=7))], count=False)
+    return index.overlapping(start_ts, end_ts)
+
+def queue_event_insert(calendar_id, event):
+    """Journals an insert and shows the event locally before it reaches the server."""
+    if mutation_queue is None:
+        print("Error: event is not created. The offline queue is not available")
+        return
+    # ローカルで表示できるようにJSTのオフセットを付ける
+    event = local_event(dict(event, id=os.urandom(16).hex()))
+    mutation_queue.enqueue(calendar_id, 'insert', event['id'], event)
+    day_cache.invalidate(calendar_id)
+    index_event(calendar_id, EventRecord.from_resource(event))
+    replayer.notify()
+    print(f"Event queued: {event['id']}")
+
+def queue_event_delete(calendar_id, event_id):
+    if mutation_queue is None:
+        print(f"No event is deleted. {event_id} The offline queue is not available")
+        return
+    mutation_queue.enqueue(calendar_id, 'delete', event_id)
+    day_cache.invalidate(calendar_id)
+    interval_index(calendar_id).remove(event_id)
+    forget_event_calendar(event_id, calendar_id)
+    replayer.notify()
+    print(f"Event deletion queued: {event_id}")
+
+def apply_mutation(service, mutation):
+    """Sends one journaled mutation. Called by the Replayer thread.
+
+    Returns True when the server has the change and False when it rejected
+    it, in which case the optimistic local change is undone. Network and rate
+    limit errors are raised so that the mutation is retried later.
+    """
+    worker = worker_service(service)
+    calendar_id = mutation['calendar_id']
+    try:
+        with lane(BACKGROUND):
+            if mutation['kind'] == 'insert':
+                event = worker.events().insert(calendarId=calendar_id, body=mutation['body']).execute()
+                if event.get('id') != mutation['event_id']:
+                    event_store.delete(calendar_id, mutation['event_id'])
+                event_store.upsert(calendar_id, event)
+            else:
+                worker.events().delete(calendarId=calendar_id, eventId=mutation['event_id']).execute()
+    except HttpError as e:
+        if is_retryable(e):
+            raise
+        status = e.resp.status
+        # 以前の再送で既に反映されている場合
+        if (mutation['kind'] == 'insert' and status == 409) or \
+                (mutation['kind'] == 'delete' and status in (404, 410)):
+            return True
+        if mutation['kind'] == 'insert':
+            event_store.delete(calendar_id, mutation['event_id'])
+        else:
+            # サーバーの状態に合わせるため次のlsで同期し直す
+            event_store.mark_stale(calendar_id)
+        day_cache.invalidate(calendar_id)
+        return False
+    day_cache.invalidate(calendar_id)
+    return True
+
+def build_event_body(event_summary, year, month, date, start_time, end_time):
     if not start_time and not end_time:
         event = {
             'summary': event_summary,
@@ -79,17 +465,265 @@ def create_event(creds, calendar_id, event_summary, year, month, date, start_tim
                 'timeZone': 'JST',  # タイムゾーンを適宜変更してください
             },
         }
+    return event
+
+def parse_time_range(time):
+    """Validates the time argument of add: "HH:MM" or "HH:MM~HH:MM".
+
+    Returns (start_time, end_time), where end_time is None when only the start
+    time is given, or raises ValueError with the message to show.
+    """
+    if len(time) == 5:
+        start_time, end_time = time, None
+        if ":" not in start_time:
+            raise ValueError("You need to include ':' in start time")
+    elif len(time) == 11:
+        start_time, end_time = time[:5], time[6:]
+        if ":" not in start_time or ":" not in end_time:
+            raise ValueError("You need to include ':' in start time and end time")
+        if start_time > end_time:
+            raise ValueError("Start time must be earlier than end time")
+    else:
+        raise ValueError("You need to input valid time")
 
-    # 予定を作成
+    for value in (start_time, end_time):
+        if value is None:
+            continue
+        if value[2] != ':':
+            raise ValueError("You need to add '0' to the time")
+        if not value[:2].isdecimal() or not value[3:].isdecimal():
+            raise ValueError("You need to input valid time")
+        hour = int(value[:2])
+        minute = int(value[3:])
+        if hour > 23 or hour < 0 or minute > 59 or minute < 0:
+            raise ValueError("You need to input valid time")
+    return start_time, end_time
+
+def import_event_body(date, time, summary):
+    """Validates an imported row with the same rules as add and builds its body."""
+    if not whether_absolute_path(date):
+        raise ValueError(f"Invalid date : {date}")
+    year, month, day = date[0:4], date[5:7], date[8:10]
     try:
-        event = service.events().insert(calendarId=calendar_id, body=event).execute()
-        event_id = event.get('id')
-        print(f"Event created: {event_id}")
-    except HttpError as e:
-        print(f"Error: event is not created. {e}")
-    
+        datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        raise ValueError(f"Invalid date : {date}")
+    if not summary:
+        raise ValueError("You need to input summary")
+    if not time:
+        return build_event_body(summary, year, month, day, None, None)
+    start_time, end_time = parse_time_range(time)
+    return build_event_body(summary, year, month, day, start_time, end_time)
+
+def insert_events(service, calendar_id, rows, concurrency):
+    """Inserts (line_no, body) rows with up to `concurrency` batch requests in
+    flight, in the bulk lane of the scheduler, which also sends rate limited
+    rows again.
+
+    Returns a list of (line_no, status, detail) with status 'created',
+    'exists' or 'failed'.
+    """
+    def send(batch):
+        with lane(BULK):
+            worker = worker_service(service)
+            return execute_batch(worker, [
+                worker.events().insert(calendarId=calendar_id, body=body) for _, body in batch])
+
+    batches = [rows[i:i + BATCH_SIZE] for i in range(0, len(rows), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        batch_results = list(executor.map(send, batches))
+
+    results = []
+    for batch, responses in zip(batches, batch_results):
+        for (line_no, body), (response, exception) in zip(batch, responses):
+            if exception is None:
+                if event_store is not None:
+                    event_store.upsert(calendar_id, response)
+                results.append((line_no, 'created', response.get('id')))
+            elif isinstance(exception, HttpError) and exception.resp.status == 409:
+                # 同じidの予定は取り込み済み
+                results.append((line_no, 'exists', body['id']))
+            else:
+                results.append((line_no, 'failed', str(exception)))
+    return results
+
+def parse_import_arguments(arguments):
+    """Splits "[-j N] FILE" into (path, concurrency), raising ValueError with
+    the message to show.
+    """
+    concurrency = IMPORT_CONCURRENCY
+    if arguments.startswith('-j'):
+        option, _, path = arguments[2:].strip().partition(' ')
+        if not option.isdecimal() or int(option) < 1:
+            raise ValueError(f"Invalid concurrency : {option} (use -j N with N >= 1)")
+        concurrency = int(option)
+        arguments = path.strip()
+    if not arguments:
+        raise ValueError("You need to input a file")
+    return arguments, concurrency
+
+def import_events(service, calendar_id, path, concurrency=IMPORT_CONCURRENCY):
+    """Imports a CSV or ICS file. Rows are streamed and validated like add,
+    inserted in batches, and given deterministic ids so that running the
+    same import again does not create duplicates.
+    """
+    # importerはimportコマンドでしか使わないので起動時には読み込まない
+    from importer import import_event_id, iter_import_rows
+    calendar_id = as_calendar_ids(calendar_id)[0]
+    counts = {'created': 0, 'exists': 0, 'failed': 0}
+    failures = []
+
+    def tally(results):
+        for line_no, status, detail in results:
+            counts[status] += 1
+            if status == 'failed':
+                failures.append((line_no, detail))
+
+    chunk = []
+    try:
+        for line_no, date, time, summary, uid, error in iter_import_rows(path):
+            if error is not None:
+                tally([(line_no, 'failed', error)])
+                continue
+            try:
+                body = import_event_body(date, time, summary)
+            except ValueError as e:
+                tally([(line_no, 'failed', str(e))])
+                continue
+            body['id'] = import_event_id(calendar_id, date, time, summary, uid)
+            chunk.append((line_no, body))
+            if len(chunk) >= BATCH_SIZE * concurrency:
+                tally(insert_events(service, calendar_id, chunk, concurrency))
+                chunk = []
+        if chunk:
+            tally(insert_events(service, calendar_id, chunk, concurrency))
+    except OSError as e:
+        print(f"Error: {path} is not imported. {e}")
+        return
+    finally:
+        day_cache.invalidate(calendar_id)
+
+    print(f"Imported: {counts['created']} created, {counts['exists']} already existed, {counts['failed']} failed")
+    for line_no, detail in sorted(failures):
+        print(f"line {line_no}: {detail}")
     return
 
+def directory_window(year, month, date):
+    """Returns the (start, end) dates of a year, month or day directory."""
+    if date:
+        start_date = datetime.date(int(year), int(month), int(date))
+        return start_date, start_date + datetime.timedelta(days=1)
+    if month:
+        start_date = datetime.date(int(year), int(month), 1)
+        return start_date, (start_date + datetime.timedelta(days=32)).replace(day=1)
+    start_date = datetime.date(int(year), 1, 1)
+    return start_date, start_date.replace(year=start_date.year + 1)
+
+def directory_windows(directories):
+    """Merges the ranges of directories into sorted, non-overlapping windows."""
+    windows = []
+    for start_date, end_date in sorted(directory_window(*directory) for directory in directories):
+        if windows and start_date <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], end_date)
+        else:
+            windows.append([start_date, end_date])
+    return [tuple(window) for window in windows]
+
+def parse_export_arguments(arguments):
+    """Splits the arguments of export into (paths, format, output, resume)."""
+    paths = []
+    export_format = None
+    output = None
+    resume = False
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument == '--format':
+            export_format = next(arguments, '')
+        elif argument in ('-o', '--output'):
+            output = next(arguments, '')
+        elif argument == '--resume':
+            resume = True
+        else:
+            paths.append(argument)
+    if export_format is None:
+        extension = os.path.splitext(output or '')[1][1:].lower()
+        export_format = extension if extension in EXPORT_FORMATS else 'jsonl'
+    return paths, export_format, output or f'export.{export_format}', resume
+
+def export_events(service, calendar_ids, windows, export_format, path, resume=False):
+    """Writes the events of the windows to path page by page.
+
+    Each page is written through a buffered file as it arrives, so memory
+    does not grow with the range. After every page the file is flushed and
+    the next page token is saved next to it, so an interrupted export can be
+    continued with resume=True from the last complete page.
+    """
+    # exporterはexportコマンドでしか使わないので起動時には読み込まない
+    from exporter import BUFFER_SIZE, WRITERS, load_checkpoint, remove_checkpoint, save_checkpoint
+    if resume:
+        try:
+            state = load_checkpoint(path)
+        except (OSError, ValueError):
+            print(f"Error: there is no interrupted export to {path}")
+            return
+    else:
+        state = {'format': export_format, 'calendars': calendar_ids,
+                 'windows': [[start_date.isoformat(), end_date.isoformat()] for start_date, end_date in windows],
+                 'job': 0, 'page_token': None, 'offset': 0, 'events': 0}
+    # (カレンダー, 期間) の順に書き出す。stateのjobとpage_tokenが次に取得するページ
+    jobs = [(calendar_id, (datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)))
+            for calendar_id in state['calendars'] for start, end in state['windows']]
+    try:
+        with open(path, 'r+' if resume else 'w', encoding='utf-8', newline='', buffering=BUFFER_SIZE) as f:
+            writer = WRITERS[state['format']](f)
+            if resume:
+                # 最後に保存したページより後の書きかけの部分を捨てる
+                f.seek(state['offset'])
+                f.truncate()
+            else:
+                writer.begin()
+            while state['job'] < len(jobs):
+                calendar_id, (start_date, end_date) = jobs[state['job']]
+                with lane(BULK):
+                    events_result = events_list_request(
+                        service, calendar_id, start_date, end_date, state['page_token'], fields='*').execute()
+                for event in events_result.get('items', []):
+                    writer.write(event, calendar_id)
+                state['events'] += len(events_result.get('items', []))
+                state['page_token'] = events_result.get('nextPageToken')
+                if state['page_token'] is None:
+                    state['job'] += 1
+                f.flush()
+                state['offset'] = f.tell()
+                save_checkpoint(path, state)
+            writer.end()
+    except (HttpError,) + NETWORK_ERRORS as e:
+        print(f"Error: export stopped after {state['events']} events. {e}")
+        print(f"Run export --resume -o {path} to continue")
+        return
+    remove_checkpoint(path)
+    print(f"Exported {state['events']} events to {path}")
+
+def run_export(shell, arguments):
+    """export [paths] [--format ics|jsonl|csv] [-o FILE] [--resume]"""
+    paths, export_format, output, resume = parse_export_arguments(arguments)
+    if export_format not in EXPORT_FORMATS:
+        print(f"Invalid format : {export_format} (choose from {', '.join(EXPORT_FORMATS)})")
+        return
+    if resume:
+        export_events(shell.service, None, None, export_format, output, resume=True)
+        return
+    directories = []
+    for path in paths or ['.']:
+        try:
+            directories.extend(resolve_paths(shell.directory(), path))
+        except PathError as e:
+            print(f"Invalid path : {path} ({e})")
+            return
+    if not all(year for year, _, _ in directories):
+        print("You must specify year")
+        return
+    export_events(shell.service, shell.calendar_ids, directory_windows(directories), export_format, output)
 
 def num_to_week(num):
     if num == 0:
@@ -107,86 +741,809 @@ def num_to_week(num):
     elif num == 6:
         return "Sun"
 
-def remove_event(creds, calendar_id, event_id):
-    service = build('calendar', 'v3', credentials=creds)
+def remove_event(service, calendar_id, event_id):
+    remove_events(service, calendar_id, [event_id])
+
+def remove_events(service, calendar_id, event_ids, batch=None):
+    """Deletes several events with batch requests and reports each id.
+
+    In the multi-calendar view each id is deleted from the calendar it was
+    listed from, or from the calendar of a "{calendar id}:{event id}".
+    """
+    owners = []
+    targets = []
+    for event_id in event_ids:
+        try:
+            owner, event_id = event_owner(calendar_id, event_id)
+        except ValueError as e:
+            print(f"No event is deleted. {e}")
+            continue
+        owners.append(owner)
+        targets.append(event_id)
+    event_ids = targets
+    if not event_ids:
+        return
+    if offline_mode:
+        for owner, event_id in zip(owners, event_ids):
+            queue_event_delete(owner, event_id)
+        return
+
+    def done(results):
+        # 予定を削除
+        for owner, event_id, (_, exception) in zip(owners, event_ids, results):
+            if exception is None:
+                if event_store is not None:
+                    event_store.delete(owner, event_id)
+                day_cache.invalidate(owner)
+                interval_index(owner).remove(event_id)
+                forget_event_calendar(event_id, owner)
+                print(f"Event deleted: {event_id}")
+            else:
+                print(f"No event is deleted. {event_id} {exception}")
+
+    def failed(e):
+        print(f"Network is unavailable. {e}")
+        for owner, event_id in zip(owners, event_ids):
+            queue_event_delete(owner, event_id)
+
+    requests = [service.events().delete(calendarId=owner, eventId=event_id)
+                for owner, event_id in zip(owners, event_ids)]
+    if batch is not None:
+        batch.add(requests, done, failed)
+        return
+    try:
+        results = execute_batch(service, requests)
+    except NETWORK_ERRORS as e:
+        failed(e)
+        return
+    done(results)
+
+def parse_edit_arguments(arguments):
+    """Turns ["summary=Meeting", "time=10:00~11:00", ...] into a dict of the
+    fields to change, raising ValueError with the message to show.
+    """
+    changes = {}
+    for argument in arguments:
+        name, separator, value = argument.partition('=')
+        if not separator or name not in EDIT_FIELDS:
+            raise ValueError(f"Invalid change : {argument} (use {'=, '.join(EDIT_FIELDS)}=)")
+        changes[name] = value
+    if not changes:
+        raise ValueError("You need to input the fields to change")
+    return changes
+
+def shift_time(value, days):
+    """Moves a start/end of the API by days, keeping its time and zone."""
+    if 'date' in value:
+        return dict(value, date=(datetime.date.fromisoformat(value['date']) + datetime.timedelta(days=days)).isoformat())
+    moved = datetime.datetime.fromisoformat(value['dateTime']) + datetime.timedelta(days=days)
+    return dict(value, dateTime=moved.isoformat())
+
+def build_event_patch(event, changes, day):
+    """Returns the minimal patch body for the changes of an event. day is the
+    (year, month, date) of date=, or None.
+    """
+    patch = {name: changes[name] for name in ('summary', 'location', 'description') if name in changes}
+    if 'time' not in changes and day is None:
+        return patch
+    first_day = EventRecord.from_resource(event).first_day()
+    if 'time' not in changes:
+        # 日付だけを変える場合は時刻と長さをそのままにする
+        days = (datetime.date(*map(int, day)) - first_day).days
+        patch['start'] = shift_time(event['start'], days)
+        patch['end'] = shift_time(event['end'], days)
+        return patch
+    year, month, date = day or (str(first_day.year), f'{first_day.month:02d}', f'{first_day.day:02d}')
+    if changes['time'] == 'allday':
+        start_date = datetime.date(int(year), int(month), int(date))
+        # 時刻付きの予定を終日にする場合はdateTimeを消す (nullで項目を削除する)
+        patch['start'] = {'date': start_date.isoformat(), 'dateTime': None}
+        patch['end'] = {'date': (start_date + datetime.timedelta(days=1)).isoformat(), 'dateTime': None}
+        return patch
+    start_time, end_time = parse_time_range(changes['time'])
+    body = build_event_body(event.get('summary', ''), year, month, date, start_time, end_time)
+    patch['start'] = dict(body['start'], date=None)
+    patch['end'] = dict(body['end'], date=None)
+    return patch
 
-    # 予定を削除
+def edit_event(service, calendar_id, event_id, changes, day=None):
+    """Changes some fields of an event with one events().patch request.
+
+    The patch carries the etag of the event in If-Match, so an event changed
+    elsewhere since it was synced is not overwritten.
+    """
+    try:
+        calendar_id, event_id = event_owner(calendar_id, event_id)
+    except ValueError as e:
+        print(f"Error: event is not edited. {e}")
+        return
+    if offline_mode:
+        print("Error: event is not edited. Editing needs the network")
+        return
     try:
-        service.events().delete(calendarId=calendar_id, eventId=event_id).execute()
-        print(f"Event deleted")
+        event = event_store.get(calendar_id, event_id) if event_store is not None else None
+        if event is None or 'etag' not in event:
+            event = service.events().get(calendarId=calendar_id, eventId=event_id).execute()
+        patch = build_event_patch(event, changes, day)
+        request = service.events().patch(calendarId=calendar_id, eventId=event_id, body=patch)
+        request.headers['If-Match'] = event['etag']
+        updated = request.execute()
+    except ValueError as e:
+        print(e)
+        return
     except HttpError as e:
-        print(f"No event is deleted. {e}")
+        if e.resp.status == 412:
+            print(f"Error: event is not edited. {event_id} was changed elsewhere; run ls and edit it again")
+            if event_store is not None:
+                event_store.mark_stale(calendar_id)
+            day_cache.invalidate(calendar_id)
+        else:
+            print(f"Error: event is not edited. {e}")
+        return
+    except NETWORK_ERRORS as e:
+        print(f"Network is unavailable. {e}")
+        return
+    day_cache.invalidate(calendar_id)
+    interval_index(calendar_id).remove(event_id)
+    if 'recurrence' not in updated:
+        index_event(calendar_id, EventRecord.from_resource(updated))
+    print(f"Event updated: {event_id}")
+    if event_store is None:
+        return
+    try:
+        # 同期と同じく繰り返し予定の設定に合わせて保存する
+        event_store.store_server_event(service, calendar_id, updated)
+    except (HttpError,) + NETWORK_ERRORS as e:
+        # 変更はサーバーに反映済みなので次のlsで同期し直す
+        event_store.mark_stale(calendar_id)
+        print(f"Warning: the local cache is synced again on the next ls. {e}")
 
-    return
+def execute_batch(service, requests):
+    """Sends the requests as batch requests of up to BATCH_SIZE sub-requests
+    through the scheduler, each sub-request counting against the quota.
+    Rate limited sub-requests (and failed idempotent ones) are sent again in
+    the next batch after a backoff.
+
+    Returns a list of (response, exception) in the order of the requests, so a
+    failing sub-request does not abort the others.
+    """
+    results = [(None, None)] * len(requests)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+
+    pending = list(range(len(requests)))
+    # schedulerが再送し尽くしたバッチはもう送らない
+    given_up = set()
+    for attempt in range(scheduler.max_retries + 1):
+        for offset in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[offset:offset + BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for i in chunk:
+                batch.add(requests[i], request_id=str(i))
+            try:
+                scheduler.run(batch.execute, cost=len(chunk),
+                              idempotent=all(is_idempotent(requests[i]) for i in chunk))
+            except HttpError as e:
+                # バッチ自体が失敗した場合は含まれていた全ての要求を失敗とする
+                for i in chunk:
+                    results[i] = (None, e)
+                given_up.update(chunk)
+        retry = [i for i in pending if i not in given_up
+                 and is_retryable(results[i][1], is_idempotent(requests[i]))]
+        if not retry or attempt == scheduler.max_retries:
+            break
+        pending = retry
+        scheduler.wait_backoff(attempt, results[retry[0]][1])
+    return results
+
+class WriteBatch:
+    """Write requests of several script commands sent as one batch request.
+
+    Each command adds its requests with a done(results) callback, called with
+    the (response, exception) of its own requests, and a failed(error)
+    callback for network errors. The callbacks print to the stdout that was
+    current when the command added them, so run_script can keep the output of
+    each command in order.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def add(self, requests, done, failed):
+        self.commands.append((requests, done, failed, sys.stdout))
+
+    def execute(self, service):
+        requests = [request for command in self.commands for request in command[0]]
+        try:
+            results = execute_batch(service, requests) if requests else []
+        except NETWORK_ERRORS as e:
+            for _, _, failed, output in self.commands:
+                with contextlib.redirect_stdout(output):
+                    failed(e)
+            return
+        offset = 0
+        for command_requests, done, _, output in self.commands:
+            with contextlib.redirect_stdout(output):
+                done(results[offset:offset + len(command_requests)])
+            offset += len(command_requests)
+
+def events_list_request(service, calendar_id, start_date, end_date, page_token=None, fields=None):
+    """Builds the events().list request for start_date..end_date (exclusive, JST).
 
-def list_events_by_date(creds, calendar_id, year, month, date):
+    Only the fields of the current projection are requested unless fields
+    is given; pass fields='*' for the full resources.
+    """
+    fields = fields or list_fields
+    if fields == '*':
+        fields = None
     jst = pytz.timezone('Asia/Tokyo')
-    service = build('calendar', 'v3', credentials=creds)
-    
-    year = int(year)
-    month = int(month)
-    date = int(date)
-    
-    # 指定された日付をJSTに変換
-    start_dt = jst.localize(datetime.datetime(year, month, date, 0, 0, 0))
-    end_dt = jst.localize(datetime.datetime(year, month, date, 23, 59, 59))
-    
-    week = start_dt.weekday()
-    week = num_to_week(week)
-    
-    # JSTでの開始日時と終了日時を文字列に変換
-    start_str = start_dt.astimezone(pytz.utc).isoformat()
-    end_str = end_dt.astimezone(pytz.utc).isoformat()
-    
-    # JSTでのイベント取得
-    events_result = service.events().list(
+    start_dt = jst.localize(datetime.datetime.combine(start_date, datetime.time()))
+    end_dt = jst.localize(datetime.datetime.combine(end_date, datetime.time()))
+    return service.events().list(
         calendarId=calendar_id,
-        timeMin=start_str,
-        timeMax=end_str,
+        timeMin=start_dt.astimezone(pytz.utc).isoformat(),
+        timeMax=end_dt.astimezone(pytz.utc).isoformat(),
         singleEvents=True,
-        orderBy='startTime'
-    ).execute()
+        orderBy='startTime',
+        maxResults=2500,
+        pageToken=page_token,
+        fields=fields
+    )
 
-    events = events_result.get('items', [])
-    
-    # 年-月-日を出力
-    print(f'{year}-{month}-{date}-{week}')
+def split_fields(mask):
+    """Splits a fields= mask at its top-level commas."""
+    fields = ['']
+    depth = 0
+    for character in mask:
+        if character == ',' and depth == 0:
+            fields.append('')
+            continue
+        depth += {'(': 1, ')': -1}.get(character, 0)
+        fields[-1] += character
+    return [field.strip() for field in fields]
+
+def list_fields_mask(projection):
+    """Turns a projection name or a list of event fields ("summary,location")
+    into a fields= mask for events().list. Returns None for an unknown name.
+
+    The listing needs id, start and end, so they are always requested.
+    """
+    if projection in LIST_PROJECTIONS:
+        return LIST_PROJECTIONS[projection]
+    if 'items' not in projection:
+        projection = f'items({projection})'
+    fields = split_fields(projection)
+    if not all(fields) or any(field.startswith('items/') for field in fields):
+        return None
+    for i, field in enumerate(fields):
+        if field.startswith('items(') and field.endswith(')'):
+            item_fields = split_fields(field[len('items('):-1])
+            if not all(item_fields):
+                return None
+            item_fields = [name for name in LIST_ITEM_FIELDS if name not in item_fields] + item_fields
+            fields[i] = f"items({','.join(item_fields)})"
+    for name in ('nextPageToken', 'etag'):
+        if name not in fields:
+            fields.insert(0, name)
+    return ','.join(fields)
+
+def set_list_projection(projection):
+    """Changes the fields requested by listings read from the API without the
+    local store. Cached days were loaded with the old fields, so the day
+    cache is cleared.
+    """
+    global list_fields
+    fields = list_fields_mask(projection)
+    if fields is None:
+        print(f"Invalid fields : {projection}")
+        return
+    list_fields = fields
+    day_cache.clear()
+    print(f"Listing fields: {list_fields}")
+    if event_store is not None:
+        print("Listings are read from the local event store, which syncs its own fields")
+
+def fetch_remaining_pages(service, calendar_id, start_date, end_date, events_result):
+    """Follows nextPageToken from an already fetched first page."""
+    events = list(events_result.get('items', []))
+    page_token = events_result.get('nextPageToken')
+    while page_token:
+        events_result = events_list_request(
+            service, calendar_id, start_date, end_date, page_token).execute()
+        events.extend(events_result.get('items', []))
+        page_token = events_result.get('nextPageToken')
+    return events
+
+def fetch_windows(service, calendar_id, windows):
+    """Fetches several (start, end) windows with one batch request for their
+    first pages. Returns a list of (events, exception) per window.
+
+    A window fetched before in one page is requested with the etag of that
+    answer in If-None-Match, and a 304 Not Modified reuses its events.
+    """
+    keys = [(calendar_id, start_date, end_date, list_fields) for start_date, end_date in windows]
+    requests = []
+    for key in keys:
+        request = events_list_request(service, calendar_id, key[1], key[2])
+        validator = listing_validators.get(key)
+        if validator is not None:
+            request.headers['If-None-Match'] = validator[0]
+        requests.append(request)
+    if len(requests) == 1:
+        try:
+            responses = [(requests[0].execute(), None)]
+        except HttpError as e:
+            responses = [(None, e)]
+    else:
+        responses = execute_batch(service, requests)
+
+    results = []
+    for key, (response, exception) in zip(keys, responses):
+        if isinstance(exception, HttpError) and exception.resp.status == 304:
+            # 前回の取得から変わっていない
+            results.append((listing_validators.not_modified(key), None))
+            continue
+        if exception is not None:
+            results.append((None, exception))
+            continue
+        try:
+            events = fetch_remaining_pages(service, calendar_id, key[1], key[2], response)
+        except HttpError as e:
+            results.append((None, e))
+            continue
+        # 複数ページの一覧は最初のページのetagだけでは検証できない
+        if response.get('etag') and 'nextPageToken' not in response:
+            listing_validators.put(key, response['etag'], events)
+        results.append((events, None))
+    return results
 
+def bucket_events_by_day(events, start_date, end_date):
+    """Splits events into {date: [event, ...]} for each JST day in the range."""
+    first = start_date.toordinal()
+    buckets = [[] for _ in range((end_date - start_date).days)]
     for event in events:
-        start = event.get('start', {}).get(
-            'dateTime', event.get('start', {}).get('date', ''))
-        end = event.get('end', {}).get(
-            'dateTime', event.get('end', {}).get('date', ''))
-        summary = event.get('summary', '')
-        id = event.get('id', '')
-        
-        flag_all_day = 'T' not in start and 'T' not in end
-        if flag_all_day:
-            # 終日の予定の場合はsummaryのみ出力
-            all_day_str = 'All Day'.ljust(12)
-            summary = summary.ljust(30)
-            print(f'{all_day_str} {summary} {id}')
+        start, last = event.day_ordinals()
+        for i in range(max(start - first, 0), min(last - first + 1, len(buckets))):
+            buckets[i].append(event)
+    return {datetime.date.fromordinal(first + i): bucket for i, bucket in enumerate(buckets)}
+
+def print_events(events):
+    """Prints EventRecords with the renderer shared by every view."""
+    started = time.perf_counter()
+    sys.stdout.write(format_events(events, calendar_name))
+    stats.record('render', 'print_events', time.perf_counter() - started, events=len(events))
+
+def group_date_windows(dates, max_gap=7):
+    """Groups dates into contiguous (start, end) windows so that dates that are
+    close to each other are fetched with a single query.
+    """
+    windows = []
+    for day in sorted(set(dates)):
+        if windows and (day - windows[-1][1]).days <= max_gap:
+            windows[-1][1] = day + datetime.timedelta(days=1)
+        else:
+            windows.append([day, day + datetime.timedelta(days=1)])
+    return [tuple(window) for window in windows]
+
+def load_windows(service, calendar_id, windows, count=True):
+    """Returns (events, exception) per window, answering fully cached windows
+    from the day cache and loading the rest. Prefetches pass count=False so
+    that only lookups made by commands show up in the hit/miss counters.
+    """
+    results = []
+    missing = []
+    for window in windows:
+        days = day_cache.get_range(calendar_id, *window, count=count)
+        if days is None:
+            # 後で読み込んだ結果に置き換える
+            missing.append(window)
+            results.append(None)
         else:
-            # 時間帯とsummaryを一行ずつ出力
-            start_dt = datetime.datetime.strptime(
-                start, '%Y-%m-%dT%H:%M:%S%z').astimezone(jst)
-            end_dt = datetime.datetime.strptime(end, '%Y-%m-%dT%H:%M:%S%z').astimezone(jst)
-            time_range = f'{start_dt.strftime("%H:%M")}~{end_dt.strftime("%H:%M")}'
-            time_range = time_range.ljust(12)
-            summary = summary.ljust(30)
-            print(f'{time_range} {summary} {id}')
+            results.append((merge_day_events(days), None))
+
+    if missing:
+        loaded = iter(load_windows_uncached(service, calendar_id, missing))
+        for i, result in enumerate(results):
+            if result is None:
+                events, exception = results[i] = next(loaded)
+                if exception is None:
+                    day_cache.put_days(calendar_id, bucket_events_by_day(events, *windows[i]))
+    for window, (events, exception) in zip(windows, results):
+        if exception is None:
+            index_window(calendar_id, window, events)
+    return results
+
+def prefetch_window(service, calendar_id, window):
+    """Loads a window for the prefetcher, behind the requests of commands."""
+    with lane(BACKGROUND):
+        return load_windows(service, calendar_id, [window], count=False)
+
+def merge_day_events(days):
+    """Joins cached days into one list, keeping events spanning days once."""
+    events = []
+    seen = set()
+    for day_events in days:
+        for event in day_events:
+            if event.id not in seen:
+                seen.add(event.id)
+                events.append(event)
+    return events
+
+def load_windows_uncached(service, calendar_id, windows):
+    """Returns (events, exception) per window from the local store when it is
+    open, syncing it first if it is stale, and from the API otherwise.
+    """
+    service = worker_service(service)
+    if event_store is None:
+        return [(events and [EventRecord.from_resource(event) for event in events], exception)
+                for events, exception in fetch_windows(service, calendar_id, windows)]
+
+    try:
+        refresh_store(service, calendar_id)
+    except HttpError as e:
+        return [(None, e)] * len(windows)
+    jst = pytz.timezone('Asia/Tokyo')
+    results = []
+    for start_date, end_date in windows:
+        start_ts = jst.localize(datetime.datetime.combine(start_date, datetime.time())).timestamp()
+        end_ts = jst.localize(datetime.datetime.combine(end_date, datetime.time())).timestamp()
+        results.append(([EventRecord.from_resource(event)
+                         for event in event_store.query(calendar_id, start_ts, end_ts)], None))
+    return results
+
+def refresh_store(service, calendar_id):
+    """Syncs the store if it is stale. In offline mode, or when the network
+    cannot be reached, the store is used as it is.
+    """
+    if offline_mode or event_store.is_fresh(calendar_id):
+        return
+    try:
+        event_store.sync(service, calendar_id)
+    except NETWORK_ERRORS:
+        return
+    if mutation_queue is not None:
+        # 全件同期で消えた未送信の変更を反映し直す
+        mutation_queue.reapply(calendar_id)
+
+def set_recurrence_mode(mode):
+    """Shows or switches how recurring events are expanded: "server" lists
+    the instances expanded by the API (singleEvents), "local" syncs each
+    series once and expands it for the listed range.
+    """
+    if event_store is None:
+        print("Recurring events are expanded locally only with the local event store")
+        return
+    if mode in ('local', 'server'):
+        event_store.set_expand_recurrence(mode == 'local')
+        day_cache.clear()
+        interval_indexes.clear()
+    elif mode:
+        print(f"Invalid mode : {mode}")
+        return
+    print(f"Recurring events are expanded by the {'client' if event_store.expand_recurrence else 'server'}")
+
+def as_calendar_ids(calendar_id):
+    """Accepts one calendar id or a list of them (multi-calendar view)."""
+    return calendar_id if isinstance(calendar_id, list) else [calendar_id]
+
+def remember_event_calendar(event_id, calendar_id):
+    event_calendars.setdefault(event_id, set()).add(calendar_id)
+
+def forget_event_calendar(event_id, calendar_id):
+    owners = event_calendars.get(event_id)
+    if owners is not None:
+        owners.discard(calendar_id)
+        if not owners:
+            del event_calendars[event_id]
+
+def event_owner(calendar_id, event_id):
+    """Returns (calendar id, event id) for an id given to rm or edit.
+
+    "{calendar id}:{event id}" names the calendar. Otherwise the id goes to
+    the selected calendar it was listed from, and ValueError is raised when
+    several selected calendars have an event with that id.
+    """
+    owner, separator, bare_id = event_id.rpartition(':')
+    if separator:
+        return owner, bare_id
+    calendar_ids = as_calendar_ids(calendar_id)
+    known = event_calendars.get(event_id, ())
+    owners = [cid for cid in calendar_ids if cid in known]
+    if len(owners) > 1:
+        raise ValueError(f"{event_id} is in several calendars ({', '.join(owners)}). "
+                         f"Use {{calendar id}}:{event_id}")
+    return (owners[0] if owners else calendar_ids[0]), event_id
+
+def event_start_key(event):
+    return event.start
+
+def load_calendars_windows(service, calendar_id, windows):
+    """Loads the windows of every selected calendar concurrently and merges
+    the events of each window by start time.
+    """
+    calendar_ids = as_calendar_ids(calendar_id)
+    if len(calendar_ids) == 1:
+        return load_windows(service, calendar_ids[0], windows)
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(calendar_ids))) as executor:
+        per_calendar = list(executor.map(
+            lambda cid: load_windows(service, cid, windows), calendar_ids))
+
+    results = []
+    for i in range(len(windows)):
+        merged = []
+        exception = None
+        for cid, calendar_results in zip(calendar_ids, per_calendar):
+            events, error = calendar_results[i]
+            if error is not None:
+                exception = error
+                continue
+            for event in events:
+                remember_event_calendar(event.id, cid)
+            merged.extend(event.with_calendar(cid) for event in events)
+        merged.sort(key=event_start_key)
+        results.append((merged if exception is None else None, exception))
+    return results
+
+def fetch_events_by_days(service, calendar_id, dates):
+    """Fetches the events of the given dates with one query per window.
+
+    Returns ({date: [event, ...]}, {date: exception}) so that a failing window
+    only affects its own dates.
+    """
+    events_by_day = {}
+    errors = {}
+    windows = group_date_windows(dates)
+    for (start_date, end_date), (events, exception) in zip(
+            windows, load_calendars_windows(service, calendar_id, windows)):
+        if exception is not None:
+            for i in range((end_date - start_date).days):
+                errors[start_date + datetime.timedelta(days=i)] = exception
+            continue
+        events_by_day.update(bucket_events_by_day(events, start_date, end_date))
+    return events_by_day, errors
+
+def print_day(day, events):
+    week = num_to_week(day.weekday())
+    # 年-月-日を出力
+    print(f'{day.year}-{day.month}-{day.day}-{week}')
+    print_events(events)
+
+def list_events_by_date(service, calendar_id, year, month, date):
+    list_events_by_dates(service, calendar_id, [(year, month, date)])
+
+def list_events_by_dates(service, calendar_id, paths):
+    """Lists the events of several (year, month, date) paths in one round trip."""
+    dates = [datetime.date(int(year), int(month), int(date)) for year, month, date in paths]
+    events_by_day, errors = fetch_events_by_days(service, calendar_id, dates)
+
+    for i, day in enumerate(dates):
+        if i > 0:
+            print()
+        if day in errors:
+            print(f"Error: events of {day} are not listed. {errors[day]}")
+        else:
+            print_day(day, events_by_day[day])
     return
 
-def move_to_parent_directory(current_year, current_month, current_date):
-    if current_date:
-        current_date = None
-    elif current_month:
-        current_month = None
-    elif current_year:
-        current_year = None
+def iter_events_range(service, calendar_id, start_date, end_date):
+    """Yields the events of the range in start time order, reading the local
+    store in chunks or following nextPageToken one page at a time.
+    """
+    if event_store is not None:
+        refresh_store(service, calendar_id)
+        jst = pytz.timezone('Asia/Tokyo')
+        start_ts = jst.localize(datetime.datetime.combine(start_date, datetime.time())).timestamp()
+        end_ts = jst.localize(datetime.datetime.combine(end_date, datetime.time())).timestamp()
+        for event in event_store.iter_query(calendar_id, start_ts, end_ts):
+            yield EventRecord.from_resource(event)
+        return
+
+    page_token = None
+    while True:
+        events_result = events_list_request(
+            service, calendar_id, start_date, end_date, page_token).execute()
+        for event in events_result.get('items', []):
+            yield EventRecord.from_resource(event)
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            return
+
+def iter_calendars_events(service, calendar_id, start_date, end_date):
+    """Merges the event streams of the selected calendars by start time."""
+    calendar_ids = as_calendar_ids(calendar_id)
+    if len(calendar_ids) == 1:
+        return iter_events_range(service, calendar_ids[0], start_date, end_date)
+
+    def tagged(cid):
+        for event in iter_events_range(service, cid, start_date, end_date):
+            remember_event_calendar(event.id, cid)
+            yield event.with_calendar(cid)
+    return heapq.merge(*[tagged(cid) for cid in calendar_ids], key=event_start_key)
+
+def iter_days(events, start_date, end_date):
+    """Groups a start time ordered event stream into (date, [event, ...]) for
+    each day that has events, yielding a day as soon as it is complete.
+
+    Only the events that are still running are kept, so memory does not grow
+    with the length of the range.
+    """
+    running = []
+    current = start_date
+
+    def flush(limit):
+        nonlocal running, current
+        while current < limit:
+            if not running:
+                current = limit
+                break
+            day_events = [event for first, last, event in running if first <= current]
+            if day_events:
+                yield current, day_events
+            running = [item for item in running if item[1] > current]
+            current += datetime.timedelta(days=1)
+
+    for event in events:
+        first_day = event.first_day()
+        yield from flush(min(first_day, end_date))
+        running.append((first_day, event.last_day(), event))
+    yield from flush(end_date)
+
+def list_events_range(service, calendar_id, start_date, end_date):
+    """Prints every day of the range that has events, streaming page by page."""
+    try:
+        for i, (day, events) in enumerate(iter_days(
+                iter_calendars_events(service, calendar_id, start_date, end_date),
+                start_date, end_date)):
+            if i > 0:
+                print()
+            print_day(day, events)
+    except HttpError as e:
+        print(f"Error: events are not listed. {e}")
+    return
+
+def print_calendar(service, calendar_id, year, month=None):
+    """Draws the month grid, or the year view without month, with the event
+    count and busy hours of each day, aggregated in one pass over one range
+    query.
+    """
+    if month:
+        start_date = datetime.date(int(year), int(month), 1)
+        end_date = (start_date + datetime.timedelta(days=32)).replace(day=1)
     else:
-        print("You are already at the top directory")
-    return current_year, current_month, current_date
+        start_date = datetime.date(int(year), 1, 1)
+        end_date = start_date.replace(year=start_date.year + 1)
+    totals = DayTotals(start_date, end_date)
+    try:
+        if month:
+            # 月は先読みキャッシュにあればそこから、なければ1回の範囲取得で読み込む
+            events, exception = load_calendars_windows(service, calendar_id, [(start_date, end_date)])[0]
+            if exception is not None:
+                raise exception
+        else:
+            # 1年分はキャッシュに入れずにページごとに流しながら集計する
+            events = iter_calendars_events(service, calendar_id, start_date, end_date)
+        totals.add_all(events)
+    except HttpError as e:
+        print(f"Error: calendar is not shown. {e}")
+        return
+    if month:
+        sys.stdout.write(format_month(start_date.year, start_date.month, totals))
+    else:
+        sys.stdout.write(format_year(start_date.year, totals))
+
+def print_usage(service, calendar_id, directories, summary_only=False):
+    """Prints the busy hours, event and all-day counts and the busiest
+    weekday and hour of each directory and its sub-directories, streaming
+    one range query per directory.
+    """
+    # usageはduコマンドでしか使わないので起動時には読み込まない
+    from usage import UsageTotals, format_usage, usage_rows
+    rows = []
+    try:
+        for directory in directories:
+            start_date, end_date = directory_window(*directory)
+            totals = UsageTotals(start_date, end_date)
+            totals.add_all(iter_calendars_events(service, calendar_id, start_date, end_date))
+            rows.extend(usage_rows(totals, *directory, summary_only=summary_only))
+    except HttpError as e:
+        print(f"Error: usage is not shown. {e}")
+        return
+    sys.stdout.write(format_usage(rows))
+
+def search_events(service, calendar_id, query):
+    """Prints the events whose summary, description or location contain every
+    word of the query, using the local search index instead of the API.
+    """
+    if event_store is None:
+        print("Search needs the local event store")
+        return
+    calendar_ids = as_calendar_ids(calendar_id)
+    try:
+        for cid in calendar_ids:
+            refresh_store(service, cid)
+    except HttpError as e:
+        print(f"Error: events are not synced. {e}")
+
+    results = event_store.search(calendar_ids, query)
+    if not results:
+        print("No event is found")
+        return
+    events = []
+    for cid, event in results:
+        event = EventRecord.from_resource(event)
+        if len(calendar_ids) > 1:
+            remember_event_calendar(event.id, cid)
+            event.calendar_id = cid
+        events.append(event)
+    start_date = events[0].first_day()
+    end_date = max(event.last_day() for event in events) + datetime.timedelta(days=1)
+    for i, (day, day_events) in enumerate(iter_days(iter(events), start_date, end_date)):
+        if i > 0:
+            print()
+        print_day(day, day_events)
+    return
+
+def get_calendar_list(service):
+    """Returns the user's calendarList, fetched once per session."""
+    global calendar_list_cache
+    if calendar_list_cache is None:
+        calendars = []
+        page_token = None
+        while True:
+            calendar_list = service.calendarList().list(pageToken=page_token).execute()
+            calendars.extend(calendar_list.get('items', []))
+            page_token = calendar_list.get('nextPageToken')
+            if not page_token:
+                break
+        calendar_list_cache = calendars
+    return calendar_list_cache
+
+def calendar_name(calendar_id):
+    for item in calendar_list_cache or []:
+        if item.get('id') == calendar_id or (calendar_id == 'primary' and item.get('primary')):
+            return item.get('summary', calendar_id)
+    return calendar_id
+
+def list_calendars(service):
+    try:
+        calendars = get_calendar_list(service)
+    except HttpError as e:
+        print(f"Error: calendars are not listed. {e}")
+        return
+    for item in calendars:
+        summary = item.get('summary', '').ljust(30)
+        mark = '*' if item.get('primary') else ' '
+        print(f'{mark} {summary} {item.get("id", "")}')
+
+def select_calendars(service, command):
+    """Resolves "cd" arguments at the top level into calendar ids.
+
+    Several calendars can be joined with ',' and '*' selects every calendar.
+    Each name may be a calendar id or its summary.
+    """
+    try:
+        calendars = get_calendar_list(service)
+    except HttpError as e:
+        print(f"Error: calendars are not listed. {e}")
+        return None
+    calendar_ids = []
+    for name in command.rstrip('/').split(','):
+        name = name.strip()
+        if name == '*':
+            calendar_ids.extend(item['id'] for item in calendars)
+            continue
+        if name == 'primary':
+            calendar_ids.append('primary')
+            continue
+        matches = [item['id'] for item in calendars
+                   if name in (item.get('id'), item.get('summary'))]
+        if not matches:
+            print(f"No such calendar : {name}")
+            return None
+        calendar_ids.append(matches[0])
+    return list(dict.fromkeys(calendar_ids)) or None
 
 def whether_absolute_path(command):
     if not len(command) == 10:
@@ -202,98 +1559,16 @@ def whether_absolute_path(command):
         else:
             return False
         
-def whether_half_absolute_path(current_year, command):
-    if current_year == None:
-        return False
-    if not len(command) == 5:
-        return False
-    else:
-        if command[2] == '/':
-            if command[0:2].isdecimal() and command[3:5].isdecimal():
-                if int(command[0:2]) > 12 or int(command[3:5]) > 31:
-                    return False
-                return True
-            else:
-                return False
-
 def change_directory(current_year, current_month, current_date, command):
-    if whether_absolute_path(command):
-        current_year = command[0:4]
-        current_month = command[5:7]
-        current_date = command[8:10]
-        return current_year, current_month, current_date
-    elif whether_half_absolute_path(current_year, command):
-        current_month = command[0:2]
-        current_date = command[3:5]
-        return current_year, current_month, current_date
-    elif command.startswith('...'):
-        if len(command) == 3:
-            current_year, current_month, current_date = move_to_parent_directory(current_year, current_month, current_date)
-            return current_year, current_month, current_date
-        if len(command) == 4:
-            if command[3] == '/':
-                current_year, current_month, current_date = move_to_parent_directory(current_year, current_month, current_date)
-                return current_year, current_month, current_date
-            else:
-                print("Invalid command : 1")
-        new_command = command[4:]
-        current_year, current_month, current_date = move_to_parent_directory(current_year, current_month, current_date)
-        current_year, current_month, current_date = move_to_parent_directory(
-            current_year, current_month, current_date)
-        return change_directory(current_year, current_month, current_date, new_command)
-    if command.startswith('..'):
-        if len(command) == 2:
-            return move_to_parent_directory(current_year, current_month, current_date)
-        if len(command) == 3:
-            if command[2] == '/':
-                return move_to_parent_directory(current_year, current_month, current_date)
-            else:
-                print("Invalid command : 2")
-        new_command = command[3:]
-        current_year, current_month, current_date = move_to_parent_directory(current_year, current_month, current_date)
-        current_year, current_month, current_date = change_directory(current_year, current_month, current_date, new_command)
+    """Returns the directory command moves to. An invalid path is reported
+    and leaves the directory as it is.
+    """
+    try:
+        return resolve_path((current_year, current_month, current_date), command)
+    except PathError as e:
+        print(f"Invalid path : {command} ({e})")
         return current_year, current_month, current_date
 
-    elif command.startswith('.'):
-        if len(command) == 1:
-            return current_year, current_month, current_date
-        if len(command) == 2:
-            if command[1] == '/':
-                return current_year, current_month, current_date
-            else:
-                print("Invalid command : 1")
-        new_command = command[2:]
-        return change_directory(current_year, current_month, current_date, new_command)
-    else:
-        if not current_year:
-            if command.isdigit():
-                if int(command) < 0 or int(command) > 9999:
-                    print("Invalid command : 3")
-                current_year = command
-            else:
-                print("Invalid command : 4")
-        elif not current_month:
-            if command[:2] not in ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12']:
-                print("Invalid command : 5")
-            else:
-                current_month = command[:2]
-                if len(command) > 2:
-                    new_command = command[3:]
-                    current_year, current_month, current_date = change_directory(current_year, current_month, current_date, new_command)
-        elif not current_date:
-            if command[:2] not in ['01', '02', '03', '04', '05', '06', '07', '08', '09', '10', '11', '12', '13', '14', \
-                                    '15', '16', '17', '18', '19', '20', '21', '22', '23', '24', \
-                                    '25', '26', '27', '28', '29', '30', '31']:
-                print("Invalid command : 6")
-            else:
-                current_date = command[:2]
-                if len(command) > 2:
-                    new_command = command[3:]
-                    current_year, current_month, current_date = change_directory(current_year, current_month, current_date, new_command)
-        else:
-            print("You are already at the bottom level")
-        return current_year, current_month, current_date
-    
 def week_to_num(week):
     if week == "Mon":
         return 0
@@ -310,311 +1585,540 @@ def week_to_num(week):
     elif week == "Sun":
         return 6
     
-def get_week_events(creds, calendar_id, year, month, week):
-    jst = pytz.timezone('Asia/Tokyo')
-    service = build('calendar', 'v3', credentials=creds)
+def month_dates(year, month):
+    """Returns every date of the month."""
+    days = calendar.monthrange(year, month)[1]
+    return [datetime.date(year, month, day) for day in range(1, days + 1)]
+
+def weekday_dates(year, month, week):
+    """Returns the dates of the month falling on week ("Mon", "Tue", ...)."""
+    return [date for date in month_dates(year, month) if date.weekday() == week_to_num(week)]
+
+def one_week_dates(year, month, week_num):
+    """Returns the dates of the week_num-th week (days 1-7, 8-14, ...) of the month."""
+    return [date for date in month_dates(year, month)
+            if date.day > 7 * (week_num-1) and date.day <= 7 * week_num]
 
+def get_week_events(service, calendar_id, year, month, week):
     year = int(year)
     month = int(month)
-    
-    # 指定した月の最初の日を取得
-    start_date = datetime.date(year, month, 1)
 
-    # 最初の日から最後の日までの日付を生成
-    dates = [
-        start_date + datetime.timedelta(days=i)
-        for i in range((datetime.date(year, month+1, 1) - start_date).days)
-    ]
+    weeks = weekday_dates(year, month, week)
 
-    weeks = [date for date in dates if date.weekday() == week_to_num(week)]
+    # 月全体を1回で取得して曜日ごとに振り分ける
+    events_by_day, errors = fetch_events_by_days(service, calendar_id, weeks)
+    if errors:
+        print(f"Error: events are not listed. {next(iter(errors.values()))}")
+        return
 
-    # 月曜日の日付を文字列に変換
-    start_dates = [date.strftime('%Y-%m-%d') for date in weeks]
+    for date in weeks:
+        # 空白の行を挿入して日付を出力
+        print()
+        print(f'{date.strftime("%Y-%m-%d")}')
+        print_events(events_by_day[date])
+    return
 
-    # イベントを取得
-    events = []
-    current_date = None
-    for start_date in start_dates:
-        
-        # 日付が変わったら日付を出力
-        if current_date != start_date:
-            current_date = start_date
-            # 空白の行を挿入して日付を出力
-            print()
-            print(f'{start_date}')
-            events = []
-            
-        start_datetime = datetime.datetime.strptime(
-            start_date, '%Y-%m-%d').replace(tzinfo=jst).isoformat()
-
-        end_datetime = (datetime.datetime.strptime(
-            start_date, '%Y-%m-%d') + datetime.timedelta(days=1)).replace(tzinfo=jst).isoformat()
-        
-        try:
-            events_result = service.events().list(
-                calendarId=calendar_id,
-                timeMin=start_datetime,
-                timeMax=end_datetime,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
-        except:
-            print("Error")
-            return
+def get_one_week_events(service, calendar_id, year, month, week_num):
+    year = int(year)
+    month = int(month)
 
-        events.extend(events_result.get('items', []))
-        
-        for event in events:
-            start = event.get('start', {}).get(
-                'dateTime', event.get('start', {}).get('date', ''))
-            end = event.get('end', {}).get(
-                'dateTime', event.get('end', {}).get('date', ''))
-            summary = event.get('summary', '')
-            id = event.get('id', '')
-
-            flag_all_day = 'T' not in start and 'T' not in end
-            if flag_all_day:
-                # 終日の予定の場合はsummaryのみ出力
-                all_day_str = 'All Day'.ljust(12)
-                summary = summary.ljust(30)
-                print(f'{all_day_str} {summary} {id}')
-            else:
-                # 時間帯とsummaryを一行ずつ出力
-                start_dt = datetime.datetime.strptime(
-                    start, '%Y-%m-%dT%H:%M:%S%z').astimezone(jst)
-                end_dt = datetime.datetime.strptime(
-                    end, '%Y-%m-%dT%H:%M:%S%z').astimezone(jst)
-                time_range = f'{start_dt.strftime("%H:%M")}~{end_dt.strftime("%H:%M")}'
-                time_range = time_range.ljust(12)
-                summary = summary.ljust(30)
-                print(f'{time_range} {summary} {id}')
+    week_dates = one_week_dates(year, month, week_num)
+
+    if not week_dates:
+        return
+
+    # 1週間分を1回で取得して日ごとに振り分ける
+    events_by_day, errors = fetch_events_by_days(service, calendar_id, week_dates)
+    if errors:
+        print(f"Error: events are not listed. {next(iter(errors.values()))}")
+        return
+
+    for date in week_dates:
+        week = num_to_week(date.weekday())
+        # 空白の行を挿入して日付を出力
+        print()
+        print(f'{date.strftime("%Y-%m-%d")} {week}')
+        print_events(events_by_day[date])
     return
 
-def get_one_week_events(creds, calendar_id, year, month, week_num):
-    jst = pytz.timezone('Asia/Tokyo')
-    service = build('calendar', 'v3', credentials=creds)
+def print_startup_profile():
+    """Prints how long it took to show the first prompt (--profile-startup).
 
-    year = int(year)
-    month = int(month)
+    The times are measured from the first line of run.py, so the interpreter
+    start-up itself is not included.
+    """
+    to_prompt = (time.perf_counter() - startup_started) * 1000
+    stats.record('startup', 'time to prompt', to_prompt / 1000)
+    with stats.lock:
+        phases = [(name, histogram.total) for (kind, name), histogram in stats.histograms.items()
+                  if kind == 'startup' and name != 'time to prompt']
+    for name, ms in phases:
+        print(f'{name.ljust(28)} {ms:8.1f} ms')
+    status = 'ok' if to_prompt <= STARTUP_TARGET_MS else 'slow'
+    print(f'{"time to prompt".ljust(28)} {to_prompt:8.1f} ms (target {STARTUP_TARGET_MS} ms: {status})')
+    print('background phases are shown by "stats" once they finish')
 
-    # 指定した月の最初の日を取得
-    start_date = datetime.date(year, month, 1)
+WEEKDAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+WEEK_NUMBERS = ["1", "2", "3", "4", "5"]
 
-    # 最初の日から最後の日までの日付を生成
-    dates = [
-        start_date + datetime.timedelta(days=i)
-        for i in range((datetime.date(year, month+1, 1) - start_date).days)
-    ]
+class Shell:
+    """The current directory of the REPL and the commands run in it.
 
-    week_dates = []
-    
-    for date in dates:
-        if date.day > 7 * (week_num-1) and date.day <= 7 * week_num:
-            week_dates.append(date)
+    main() reads the commands from the terminal and run_script() from a
+    script, and both run them with execute().
+    """
 
-    # 1週間の日付を文字列に変換
-    start_dates = [[date.strftime('%Y-%m-%d'), date.weekday()] for date in week_dates]
+    def __init__(self, service, prefetch=True):
+        self.service = service
+        self.calendar_ids = ['primary']
+        # cdの後に周辺の予定をバックグラウンドで先読みする (-fのスクリプトでは必要な日付だけを読み込む)
+        self.prefetch = prefetch
+        self.prefetcher = Prefetcher(day_cache, lambda calendar_id, window: prefetch_window(service, calendar_id, window))
+        jst = pytz.timezone('Asia/Tokyo')
+        now = datetime.datetime.now().astimezone(jst)
+        self.year = now.year
+        self.month = now.strftime('%m')
+        self.date = now.strftime('%d')
 
-    # イベントを取得
-    events = []
-    current_date = None
-    for start_date in start_dates:
-
-        # 日付が変わったら日付を出力
-        if current_date != start_date[0]:
-            current_date = start_date[0]
-            week = num_to_week(start_date[1])
-            # 空白の行を挿入して日付を出力
-            print()
-            print(f'{start_date[0]} {week}')
-            events = []
+    def prompt(self):
+        calendar_path = ','.join(self.calendar_ids or [])
+        if not self.calendar_ids:
+            return '/'
+        elif self.year and self.month and self.date:
+            return f'({calendar_path}) {self.year}/{self.month}/{self.date}'
+        elif self.year and self.month:
+            return f'({calendar_path}) {self.year}/{self.month}/'
+        elif self.year:
+            return f'({calendar_path}) {self.year}/'
+        return f'({calendar_path}) '
 
-        start_datetime = datetime.datetime.strptime(
-            start_date[0], '%Y-%m-%d').replace(tzinfo=jst).isoformat()
+    def directory(self):
+        return (self.year, self.month, self.date)
 
-        end_datetime = (datetime.datetime.strptime(
-            start_date[0], '%Y-%m-%d') + datetime.timedelta(days=1)).replace(tzinfo=jst).isoformat()
+    def cd(self, argument):
+        """Moves to the calendars or the date given to cd."""
+        if not self.calendar_ids:
+            # カレンダーを選択する
+            self.calendar_ids = select_calendars(self.service, argument)
+            self.year, self.month, self.date = None, None, None
+        elif argument == '/' or (not self.year and argument.rstrip('/') == '..'):
+            # カレンダーを選択する階層に戻る
+            self.calendar_ids = None
+            self.year, self.month, self.date = None, None, None
+        else:
+            self.year, self.month, self.date = change_directory(self.year, self.month, self.date, argument)
 
+    def read_dates(self, command):
+        """Returns the dates whose events the command reads, so that
+        run_script can load them before running the script.
+        """
+        if not self.calendar_ids:
+            return []
         try:
-            events_result = service.events().list(
-                calendarId=calendar_id,
-                timeMin=start_datetime,
-                timeMax=end_datetime,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
-        except:
-            print("Error")
-            return
-
-        events.extend(events_result.get('items', []))
+            if command == "ls" and self.year and self.month and self.date:
+                return [datetime.date(int(self.year), int(self.month), int(self.date))]
+            if command.startswith("ls -") and self.year and self.month:
+                week = command[4:]
+                if week in WEEKDAYS:
+                    return weekday_dates(int(self.year), int(self.month), week)
+                if week in WEEK_NUMBERS:
+                    return one_week_dates(int(self.year), int(self.month), int(week))
+                return []
+            if command.startswith("ls "):
+                dates = []
+                for argument in command[3:].split():
+                    for year, month, date in resolve_paths(self.directory(), argument):
+                        if date:
+                            dates.append(datetime.date(int(year), int(month), int(date)))
+                return dates
+            if command == "cal" and self.year and self.month:
+                return month_dates(int(self.year), int(self.month))
+            if command.startswith("add ") and self.year and self.month:
+                # 重なる予定を探すためにその週を読み込む
+                arguments = command[4:].split(" ")
+                if len(arguments) == 3:
+                    year, month, date = resolve_path(self.directory(), arguments[0])
+                    day = datetime.date(int(year), int(month), int(date))
+                    monday = day - datetime.timedelta(days=day.weekday())
+                    return [monday + datetime.timedelta(days=i) for i in range(7)]
+        except (TypeError, ValueError):
+            # 日付が正しくないコマンドは実行時にエラーを表示する
+            pass
+        return []
 
-        for event in events:
-            start = event.get('start', {}).get(
-                'dateTime', event.get('start', {}).get('date', ''))
-            end = event.get('end', {}).get(
-                'dateTime', event.get('end', {}).get('date', ''))
-            summary = event.get('summary', '')
-            id = event.get('id', '')
-
-            flag_all_day = 'T' not in start and 'T' not in end
-            if flag_all_day:
-                # 終日の予定の場合はsummaryのみ出力
-                all_day_str = 'All Day'.ljust(12)
-                summary = summary.ljust(30)
-                print(f'{all_day_str} {summary} {id}')
-            else:
-                # 時間帯とsummaryを一行ずつ出力
-                start_dt = datetime.datetime.strptime(
-                    start, '%Y-%m-%dT%H:%M:%S%z').astimezone(jst)
-                end_dt = datetime.datetime.strptime(
-                    end, '%Y-%m-%dT%H:%M:%S%z').astimezone(jst)
-                time_range = f'{start_dt.strftime("%H:%M")}~{end_dt.strftime("%H:%M")}'
-                time_range = time_range.ljust(12)
-                summary = summary.ljust(30)
-                print(f'{time_range} {summary} {id}')
-    return
+    def execute(self, command, batch=None):
+        """Runs one command. Returns False when the command is exit.
 
-def main(creds):
-    current_calendar_id = 'primary'
-    jst = pytz.timezone('Asia/Tokyo')
-    now = datetime.datetime.now().astimezone(jst)
-    current_year = now.year
-    current_month = now.strftime('%m')
-    current_date = now.strftime('%d')
+        With a WriteBatch, add and rm queue their requests in it instead of
+        sending them.
+        """
+        global offline_mode
+        service = self.service
 
-    while True:
-        path = f'({current_calendar_id}) {current_year}/{current_month}/{current_date}'
-        if current_year and current_month and current_date:
-            print_path = path
-        elif current_year and current_month:
-            print_path = f'({current_calendar_id}) {current_year}/{current_month}/'
-        elif current_year:
-            print_path = f'({current_calendar_id}) {current_year}/'
-        command = input(f'{print_path} >>> ')
+        # カレンダーを選択する階層
+        if not self.calendar_ids:
+            if command == "ls":
+                list_calendars(service)
+            elif command.startswith("cd "):
+                self.cd(command[3:])
+                self.prefetcher.cancel()
+            elif command == "exit":
+                return False
+            elif command.startswith("run_script "):
+                return run_script(self, command[11:].strip())
+            elif command and command != "clear":
+                print("You must choose calendars with cd")
+            if command == "clear":
+                os.system('clear')
+            return True
 
         # current_dirの予定を表示
         if command == "ls":
-            if current_year and current_month and current_date:
-                list_events_by_date(creds, current_calendar_id,
-                                    current_year, current_month, current_date)
-                
+            if self.year and self.month and self.date:
+                list_events_by_date(service, self.calendar_ids, self.year, self.month, self.date)
+            elif self.year and self.month:
+                start_date = datetime.date(int(self.year), int(self.month), 1)
+                end_date = (start_date + datetime.timedelta(days=32)).replace(day=1)
+                list_events_range(service, self.calendar_ids, start_date, end_date)
+                print()
+            elif self.year:
+                start_date = datetime.date(int(self.year), 1, 1)
+                list_events_range(service, self.calendar_ids,
+                                  start_date, start_date.replace(year=start_date.year + 1))
+                print()
+
         elif command.startswith("ls -"):
             week = command[4:]
-            if week in ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]:
-                if current_year and current_month:
-                    get_week_events(creds, current_calendar_id, current_year, current_month, week)
+            if week in WEEKDAYS:
+                if self.year and self.month:
+                    get_week_events(service, self.calendar_ids, self.year, self.month, week)
                     print()
                 else:
                     print("You must specify year and month")
-            elif week in ["1", "2", "3", "4", "5"]:
-                if current_year and current_month:
-                    get_one_week_events(creds, current_calendar_id, current_year, current_month, int(week))
+            elif week in WEEK_NUMBERS:
+                if self.year and self.month:
+                    get_one_week_events(service, self.calendar_ids, self.year, self.month, int(week))
                     print()
                 else:
                     print("You must specify year and month")
             else:
                 print("Invalid command")
-        
-        # dirを指定してls
+
+        # dirを指定してls (2024/05/{01..07} や 2024/*/15 のようなパターンも可)
         elif command.startswith("ls"):
-            command = command[3:]
-            ls_commands = command.split(" ")
-            for ls_command in ls_commands:    
-                print()                          
-                year, month, date = change_directory(current_year, current_month, current_date, ls_command)
-                list_events_by_date(creds, current_calendar_id, year, month, date)
+            paths = []
+            for ls_command in command[3:].split():
+                try:
+                    directories = resolve_paths(self.directory(), ls_command)
+                except PathError as e:
+                    print(f"Invalid path : {ls_command} ({e})")
+                    continue
+                if all(date for _, _, date in directories):
+                    paths.extend(directories)
+                else:
+                    print(f"You must specify year, month and date : {ls_command}")
+            # まとめて取得してから引数の順に表示
             print()
-        
-        # 予定をidで削除 
-        if command.startswith("rm"):
-            command = command[3:]
-            rm_commands = command.split(" ")
-            for rm_command in rm_commands:
-                remove_event(creds, current_calendar_id, rm_command)
-
-        if command.startswith("cd"):
-            mv_command = command[3:]
-            current_year, current_month, current_date = change_directory(current_year, current_month, current_date, mv_command)
-
-        # create_event(creds, calendar_id, event_summary, year, month, date, start_time, end_time)
-                
-        if command.startswith("add"):
-            add_command = command[4:]
-            add_command = add_command.split(" ")
-            if current_year and current_month:
+            if paths:
+                list_events_by_dates(service, self.calendar_ids, paths)
+                print()
+
+        # 予定をidで削除
+        elif command.startswith("rm"):
+            rm_commands = [rm_command for rm_command in command[3:].split(" ") if rm_command]
+            if rm_commands:
+                remove_events(service, self.calendar_ids, rm_commands, batch=batch)
+
+        elif command.startswith("cd"):
+            self.cd(command[3:])
+            if self.calendar_ids and self.prefetch:
+                self.prefetcher.schedule(self.calendar_ids, neighbour_windows(self.year, self.month, self.date))
+            else:
+                self.prefetcher.cancel()
+
+        elif command == "stats":
+            stats.print_report(day_cache)
+        elif command == "stats reset":
+            stats.reset()
+
+        elif command == "fields":
+            print(f"Listing fields: {list_fields}")
+            print(f"Projections: {', '.join(LIST_PROJECTIONS)} or a list of event fields")
+        elif command.startswith("fields "):
+            set_list_projection(command[7:].strip())
+
+        elif command == "recurrence" or command.startswith("recurrence "):
+            set_recurrence_mode(command[11:].strip())
+
+        # 月のカレンダー (年の階層とcal -yでは1年分)
+        elif command == "cal" or command.startswith("cal "):
+            argument = command[4:].strip()
+            year, month = self.year, self.month
+            if argument == "-y":
+                month = None
+            elif argument:
+                try:
+                    year, month, _ = resolve_path(self.directory(), argument)
+                except PathError as e:
+                    print(f"Invalid path : {argument} ({e})")
+                    return True
+            if year:
+                print_calendar(service, self.calendar_ids, year, month)
+            else:
+                print("You must specify year")
+
+        # 予定の時間の集計 (du -sでは指定したディレクトリの合計だけ)
+        elif command == "du" or command.startswith("du "):
+            arguments = command[3:].split()
+            summary_only = "-s" in arguments
+            directories = []
+            for path in [argument for argument in arguments if argument != "-s"] or ["."]:
+                try:
+                    directories.extend(resolve_paths(self.directory(), path))
+                except PathError as e:
+                    print(f"Invalid path : {path} ({e})")
+                    return True
+            if all(year for year, _, _ in directories):
+                print_usage(service, self.calendar_ids, directories, summary_only)
+            else:
+                print("You must specify year")
+
+        elif command == "cache":
+            revalidated = listing_validators.revalidated + (event_store.revalidated if event_store else 0)
+            print(f'hits: {day_cache.hits} misses: {day_cache.misses} days: {len(day_cache.entries)} '
+                  f'revalidated: {revalidated}')
+
+        # create_event(service, calendar_id, event_summary, year, month, date, start_time, end_time)
+        elif command.startswith("add"):
+            add_command = command[4:].split(" ")
+            if self.year and self.month:
                 if len(add_command) == 1:
                     print("You need to input summary")
-                    continue
+                    return True
+                try:
+                    year, month, date = resolve_path(self.directory(), add_command[0])
+                except PathError as e:
+                    print(f"Invalid path : {add_command[0]} ({e})")
+                    return True
+                if not date:
+                    print(f"You must specify year, month and date : {add_command[0]}")
+                    return True
                 if len(add_command) == 2:
                     # 終日の場合
-                    year, month, date = change_directory(current_year, current_month, current_date, add_command[0])
                     summary = add_command[1]
-                    create_event(creds, current_calendar_id, summary, year, month, date, None, None)
+                    create_event(service, self.calendar_ids, summary, year, month, date, None, None, batch=batch)
                 elif len(add_command) == 3:
-                    # 開始時間のみ指定
-                    year, month, date = change_directory(
-                        current_year, current_month, current_date, add_command[0])
-                    time = add_command[1]
+                    # 開始時間のみ、または開始時間と終了時間を指定
                     summary = add_command[2]
-                    if len(time) == 5:
-                        start_time = time
-                        end_time = None
-                        if ":" not in start_time:
-                            print("You need to include ':' in start time")
-                            continue
-                        if len(start_time) != 3:
-                            print("You need to add '0' to the time")
-                            continue
-                        start_hour = int(start_time[:2])
-                        start_minute = int(start_time[3:])
-                        if start_hour > 23 or start_hour < 0 or start_minute > 59 or start_minute < 0:
-                            print("You need to input valid time")
-                            continue
-                        create_event(creds, current_calendar_id, summary, year, month, date, start_time, end_time)
-                    elif len(time) == 11:
-                        start_time = time[:5]
-                        end_time = time[6:]
-                        if ":" not in start_time or ":" not in end_time:
-                            print("You need to include ':' in start time and end time")
-                            continue
-                        if len(start_time) != 5 or len(end_time) != 5:
-                            print("You need to add '0' to the time")
-                            continue
-                        if start_time > end_time:
-                            print("Start time must be earlier than end time")
-                            continue
-                        start_hour = int(start_time[:2])
-                        start_minute = int(start_time[3:])
-                        end_hour = int(end_time[:2])
-                        end_minute = int(end_time[3:])
-                        if start_hour > 23 or start_hour < 0 or start_minute > 59 or start_minute < 0:
-                            print("You need to input valid time")
-                            continue
-                        if end_hour > 23 or end_hour < 0 or end_minute > 59 or end_minute < 0:
-                            print("You need to input valid time")
-                            continue
-                        create_event(creds, current_calendar_id, summary, year, month, date, start_time, end_time)
-
+                    try:
+                        start_time, end_time = parse_time_range(add_command[1])
+                    except ValueError as e:
+                        print(e)
+                        return True
+                    create_event(service, self.calendar_ids, summary, year, month, date, start_time, end_time, batch=batch)
             else:
                 print("You need to specify year and month")
 
-        if command == "clear":
+        # 予定の変更 (edit {id} summary=... date={パス} time=HH:MM~HH:MM|allday)
+        elif command.startswith("edit"):
+            edit_command = [argument for argument in command[5:].split(" ") if argument]
+            if not edit_command:
+                print("You need to input event id")
+                return True
+            try:
+                changes = parse_edit_arguments(edit_command[1:])
+            except ValueError as e:
+                print(e)
+                return True
+            day = None
+            if 'date' in changes:
+                try:
+                    day = resolve_path(self.directory(), changes['date'])
+                except PathError as e:
+                    print(f"Invalid path : {changes['date']} ({e})")
+                    return True
+                if not day[2]:
+                    print(f"You must specify year, month and date : {changes['date']}")
+                    return True
+            edit_event(service, self.calendar_ids, edit_command[0], changes, day)
+
+        elif command == "offline" or command.startswith("offline "):
+            if command not in ("offline", "offline on", "offline off"):
+                print("Usage: offline [on|off]")
+                return True
+            offline_mode = command != "offline off"
+            print(f"Offline mode: {'on' if offline_mode else 'off'}")
+
+        elif command == "queue":
+            pending = mutation_queue.pending() if mutation_queue is not None else []
+            print(f"{len(pending)} change(s) waiting to be sent")
+            for mutation in pending:
+                print(f"{mutation['kind'].ljust(8)} {mutation['event_id']} ({mutation['calendar_id']})")
+            for mutation in mutation_queue.failures if mutation_queue is not None else []:
+                print(f"rejected {mutation['event_id']} ({mutation['calendar_id']})")
+
+        elif command.startswith("grep ") or command.startswith("find "):
+            search_events(service, self.calendar_ids, command[5:].strip())
+            print()
+
+        # 期間の予定をファイルに書き出す
+        elif command == "export" or command.startswith("export "):
+            run_export(self, command[7:].split())
+
+        elif command.startswith("import "):
+            try:
+                path, concurrency = parse_import_arguments(command[7:].strip())
+            except ValueError as e:
+                print(e)
+                return True
+            import_events(service, self.calendar_ids, path, concurrency)
+
+        elif command.startswith("run_script "):
+            return run_script(self, command[11:].strip())
+
+        elif command == "clear":
             os.system('clear')
 
         # 入力に応じた処理を実行
-        if command == "exit":
-            break  # ループを終了する条件
-        elif command == "run_script":
-            # 実行したいPythonコードを記述
-            print("Running script...")
-            # ここにコードを記述
+        elif command == "exit":
+            return False  # ループを終了する条件
+
+        return True
+
+def read_script(path):
+    """Returns the commands of a script file ('-' reads stdin). Blank lines
+    and lines starting with '#' are skipped.
+    """
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+def is_write_command(command):
+    return command.startswith("add ") or command.startswith("rm ")
+
+def prefetch_script_reads(shell, commands):
+    """Loads every date the script reads before running it.
+
+    The cd commands are followed on a copy of the shell to find the dates of
+    each ls and add, and the dates of each calendar are merged into as few
+    windows as possible. The commands then read them from the day cache.
+    """
+    planner = copy.copy(shell)
+    dates = {}
+    # cdで表示されるエラーは実行時に表示する
+    with contextlib.redirect_stdout(io.StringIO()):
+        for command in commands:
+            for date in planner.read_dates(command):
+                for calendar_id in planner.calendar_ids:
+                    dates.setdefault(calendar_id, set()).add(date)
+            if command.startswith("cd "):
+                planner.cd(command[3:])
+    if not dates:
+        return
+
+    def load(calendar_id):
+        load_windows(shell.service, calendar_id, group_date_windows(sorted(dates[calendar_id])), count=False)
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(dates))) as executor:
+        list(executor.map(load, dates))
+
+def run_write_batch(shell, commands):
+    """Runs consecutive add/rm commands as one batch request and prints the
+    output of each command in order.
+    """
+    batch = WriteBatch()
+    outputs = []
+    for command in commands:
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            shell.execute(command, batch=batch)
+        outputs.append(output)
+    batch.execute(shell.service)
+    for output in outputs:
+        sys.stdout.write(output.getvalue())
+
+def run_script(shell, path):
+    """Runs the commands of a script file non-interactively (-f or run_script).
+
+    The whole script is read first so that the dates it lists are loaded with
+    a few range queries, and runs of add/rm are sent as batch requests. The
+    output stays in the order of the commands. Returns False if the script
+    ends with exit.
+    """
+    try:
+        commands = read_script(path)
+    except OSError as e:
+        print(f"Error: script is not read. {e}")
+        return True
+    prefetch_script_reads(shell, commands)
+
+    i = 0
+    while i < len(commands):
+        started = time.perf_counter()
+        if is_write_command(commands[i]) and not offline_mode:
+            j = i
+            while j < len(commands) and is_write_command(commands[j]):
+                j += 1
+            run_write_batch(shell, commands[i:j])
+            stats.record('command', 'write batch', time.perf_counter() - started)
+            i = j
+            continue
+        command = commands[i]
+        i += 1
+        if not shell.execute(command):
+            return False
+        stats.record('command', command.split(' ')[0], time.perf_counter() - started)
+    return True
+
+def main(service, profile_startup=False, script=None):
+    shell = Shell(service, prefetch=script is None)
+    if script is not None:
+        run_script(shell, script)
+        return
+    command_name = None
+    if profile_startup:
+        print_startup_profile()
+
+    while True:
+        if command_name is not None:
+            stats.record('command', command_name, time.perf_counter() - started)
+        try:
+            command = input(f'{shell.prompt()} >>> ')
+        except EOFError:
+            print()
+            break
+        started = time.perf_counter()
+        command_name = command.split(' ')[0]
+        if not shell.execute(command):
+            break
 
     print("Exiting the program")
 
 
 if __name__ == '__main__':
-    # 初期化処理を実行
-    creds = init()
+    parser = argparse.ArgumentParser(description='Google Calendar CLI')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='append a JSON line for every API call and command to FILE')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the time it took to show the prompt')
+    parser.add_argument('-f', '--file', metavar='SCRIPT',
+                        help="run the commands in SCRIPT ('-' for stdin) instead of the prompt")
+    args = parser.parse_args()
+    if args.trace:
+        stats.open_trace(args.trace)
+    stats.record('startup', 'imports', time.perf_counter() - startup_started)
+
+    started = time.perf_counter()
+    event_store = EventStore(STORE_FILE)
+    mutation_queue = MutationQueue(event_store)
+    stats.record('startup', 'open store', time.perf_counter() - started)
+    # 初期化処理を実行 (認証とサービスの構築はバックグラウンドで行う)
+    service = start_session()
+    replayer = Replayer(mutation_queue, lambda mutation: apply_mutation(service, mutation))
     # ターミナルからの入力を取得
-    main(creds)
+    main(service, profile_startup=args.profile_startup, script=args.file)
+    event_store.close()
+    stats.close()
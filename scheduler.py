@@ -0,0 +1,160 @@
+import contextlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+from instrumentation import stats
+
+# 優先度 (小さいほど先に送る)。コマンドの応答を先読み・同期・取り込みより優先する
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+LANE_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background', BULK: 'bulk'}
+
+# Calendar APIのユーザーごとの上限 (1分あたり600リクエスト) に合わせたトークンバケット (0で無制限)
+RATE = 10.0
+# バッチリクエスト1つ分 (50件) はまとめて送れるようにする
+BURST = 50
+# 同時に送るリクエストの最大数
+MAX_CONCURRENCY = 4
+# レート制限・サーバーエラーの再送回数と待ち時間 (秒)
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 32.0
+
+lane_local = threading.local()
+
+
+@contextlib.contextmanager
+def lane(priority):
+    """Sends the API calls made by this thread inside the block with priority."""
+    previous = current_lane()
+    lane_local.priority = priority
+    try:
+        yield
+    finally:
+        lane_local.priority = previous
+
+
+def current_lane():
+    return getattr(lane_local, 'priority', INTERACTIVE)
+
+
+def is_idempotent(request):
+    """Whether sending request again cannot create a second event: every
+    method but insert, and inserts that carry their own event id.
+    """
+    body = request.body or ''
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    return request.method != 'POST' or '"id"' in body
+
+
+def is_retryable(exception, idempotent=True):
+    """Rate limit errors (429, 403 rateLimitExceeded/userRateLimitExceeded)
+    are always retried, 5xx only when the request is idempotent.
+    """
+    if not isinstance(exception, HttpError):
+        return False
+    status = exception.resp.status
+    if status == 429 or (status == 403 and 'ratelimitexceeded' in str(exception.content).lower()):
+        return True
+    return status >= 500 and idempotent
+
+
+class RequestScheduler:
+    """The one path every Calendar API call takes.
+
+    A call waits for its turn by (lane, arrival), for one of max_concurrency
+    slots and for tokens from a bucket refilled at rate per second. Rate
+    limited and 5xx responses are retried after a jittered exponential
+    backoff (or the Retry-After of the response), so bulk work keeps to the
+    quota instead of failing.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, max_concurrency=MAX_CONCURRENCY,
+                 max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.arrivals = itertools.count()
+        self.active = 0
+        self.tokens = float(burst)
+        self.refilled_at = time.monotonic()
+
+    def _refill(self):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def acquire(self, cost=1, priority=None):
+        """Blocks until the call is first in line, a slot is free and cost
+        tokens are available. Costs above burst are taken as debt.
+        """
+        priority = current_lane() if priority is None else priority
+        ticket = (priority, next(self.arrivals))
+        started = time.perf_counter()
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                timeout = None
+                if self.waiting[0] == ticket and self.active < self.max_concurrency:
+                    self._refill()
+                    needed = min(cost, self.burst)
+                    if not self.rate or self.tokens >= needed:
+                        heapq.heappop(self.waiting)
+                        if self.rate:
+                            self.tokens -= cost
+                        self.active += 1
+                        self.condition.notify_all()
+                        break
+                    timeout = (needed - self.tokens) / self.rate
+                self.condition.wait(timeout)
+        stats.record('schedule', f'wait {LANE_NAMES.get(priority, priority)}', time.perf_counter() - started)
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def backoff(self, attempt, exception=None):
+        """Returns the seconds to wait before retry number attempt + 1."""
+        retry_after = exception.resp.get('retry-after') if isinstance(exception, HttpError) else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def wait_backoff(self, attempt, exception=None):
+        delay = self.backoff(attempt, exception)
+        stats.record('schedule', 'backoff', delay)
+        time.sleep(delay)
+
+    def run(self, call, cost=1, idempotent=True, priority=None):
+        """Runs call() when the scheduler allows it, retrying rate limited and
+        server errors up to max_retries times.
+        """
+        for attempt in itertools.count():
+            self.acquire(cost, priority)
+            try:
+                return call()
+            except HttpError as e:
+                if attempt >= self.max_retries or not is_retryable(e, idempotent):
+                    raise
+                exception = e
+            finally:
+                self.release()
+            self.wait_backoff(attempt, exception)
+
+
+scheduler = RequestScheduler()
@@ -0,0 +1,37 @@
+# 予定の検索用のn-gram (日本語は単語で区切れないため文字単位で索引を作る)
+SEARCH_FIELDS = ('summary', 'description', 'location')
+
+
+def event_text(event):
+    """Returns the searchable text of an event, lower-cased."""
+    return '\n'.join(event.get(field) or '' for field in SEARCH_FIELDS).lower()
+
+
+def bigrams(text):
+    """Returns the set of character bigrams of text.
+
+    A sentinel is appended so that every character starts at least one
+    bigram, which lets one-character queries use a prefix lookup.
+    """
+    text = text + '\0'
+    return {text[i:i + 2] for i in range(len(text) - 1) if not text[i].isspace()}
+
+
+def query_terms(query):
+    """Splits a query into the bigrams every matching event must contain, and
+    the one-character words that are looked up by prefix.
+    """
+    terms = set()
+    prefixes = set()
+    for word in query.lower().split():
+        if len(word) == 1:
+            prefixes.add(word)
+        else:
+            terms.update(word[i:i + 2] for i in range(len(word) - 1))
+    return terms, prefixes
+
+
+def matches(event, query):
+    """Checks the candidates of the index against the actual text."""
+    text = event_text(event)
+    return all(word in text for word in query.lower().split())
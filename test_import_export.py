@@ -0,0 +1,81 @@
+"""Tests of reading import files and of importing exports (python -m pytest test_import_export.py)."""
+from exporter import CsvWriter
+from importer import import_event_id, iter_import_rows
+
+
+def write_ics(tmp_path, *events):
+    path = tmp_path / 'events.ics'
+    lines = ['BEGIN:VCALENDAR']
+    for properties in events:
+        lines += ['BEGIN:VEVENT', *properties, 'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    path.write_text('\r\n'.join(lines) + '\r\n', encoding='utf-8')
+    return str(path)
+
+
+def test_ics_tzid_is_converted_to_jst(tmp_path):
+    path = write_ics(tmp_path, [
+        'UID:ny', 'SUMMARY:Standup',
+        'DTSTART;TZID=America/New_York:20240305T090000',
+        'DTEND;TZID=America/New_York:20240305T093000',
+    ])
+    # 3月5日のニューヨーク (EST, UTC-5) の9:00は日本時間の23:00
+    [(_, date, time, summary, _, error)] = iter_import_rows(path)
+    assert (date, time, summary, error) == ('2024/03/05', '23:00~23:30', 'Standup', None)
+
+
+def test_ics_unknown_tzid_is_rejected(tmp_path):
+    path = write_ics(tmp_path, [
+        'UID:mars', 'SUMMARY:Landing',
+        'DTSTART;TZID=Mars/Olympus:20240305T090000',
+        'DTEND;TZID=Mars/Olympus:20240305T093000',
+    ])
+    [(_, _, _, _, _, error)] = iter_import_rows(path)
+    assert error == 'Unknown time zone : Mars/Olympus'
+
+
+def test_ics_rows_that_cannot_be_imported_give_a_reason(tmp_path):
+    path = write_ics(
+        tmp_path,
+        ['UID:a', 'SUMMARY:Trip', 'DTSTART;VALUE=DATE:20240305', 'DTEND;VALUE=DATE:20240308'],
+        ['UID:b', 'SUMMARY:Night', 'DTSTART:20240305T220000', 'DTEND:20240306T020000'],
+        ['UID:c', 'SUMMARY:Broken', 'DTSTART:2024-03-05'],
+        ['UID:d', 'SUMMARY:Nothing'],
+    )
+    errors = [row[5] for row in iter_import_rows(path)]
+    assert errors == [
+        'Events spanning several days are not imported',
+        'Events spanning several days are not imported',
+        'Invalid date : 2024-03-05',
+        'The event has no DTSTART',
+    ]
+
+
+def test_csv_export_round_trip(tmp_path):
+    events = [
+        {'id': 'abc123', 'summary': 'Review', 'location': 'Room 1',
+         'start': {'dateTime': '2024-05-01T10:00:00+09:00'}, 'end': {'dateTime': '2024-05-01T11:30:00+09:00'}},
+        {'id': 'def456', 'summary': 'Holiday, all day',
+         'start': {'date': '2024-05-03'}, 'end': {'date': '2024-05-04'}},
+    ]
+    path = tmp_path / 'export.csv'
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = CsvWriter(f)
+        writer.begin()
+        for event in events:
+            writer.write(event, 'primary')
+        writer.end()
+
+    rows = list(iter_import_rows(str(path)))
+    assert [(date, time, summary, error) for _, date, time, summary, _, error in rows] == [
+        ('2024/05/01', '10:00~11:30', 'Review', None),
+        ('2024/05/03', '', 'Holiday, all day', None),
+    ]
+    ids = [import_event_id('work', *row[1:5]) for row in rows]
+
+    # 名前を変えた書き出しを取り込み直しても同じidになり、重複しない
+    path.write_text(path.read_text(encoding='utf-8').replace('Review', 'Design review'), encoding='utf-8')
+    edited = list(iter_import_rows(str(path)))
+    assert edited[0][3] == 'Design review'
+    assert [import_event_id('work', *row[1:5]) for row in edited] == ids
+    assert len(set(ids)) == 2
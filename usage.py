@@ -0,0 +1,91 @@
+"""Time usage of the calendar directories, reported like du(1).
+
+The events of a directory are streamed once into per-day and per-hour
+totals (flat lists indexed by day and by day * 24 + hour), and the rows of
+its sub-directories, their busiest weekday and hour are sums over slices of
+those lists, so a year or more of events is aggregated in one pass.
+"""
+import calendar
+import datetime
+
+from month_grid import WEEK_HEADER, DayTotals, hours
+
+HOUR = 60 * 60
+USAGE_HEADER = f'{"busy".rjust(8)} {"events".rjust(7)} {"all-day".rjust(7)} {"weekday".rjust(7)} {"hour".rjust(5)}  path'
+
+
+class UsageTotals(DayTotals):
+    """DayTotals that also keeps the busy seconds of every hour of every day."""
+
+    def __init__(self, start_date, end_date):
+        super().__init__(start_date, end_date)
+        self.hourly = [0] * (len(self.counts) * 24)
+
+    def add_busy(self, i, day_start, start, end):
+        super().add_busy(i, day_start, start, end)
+        hour = (start - day_start) // HOUR
+        while start < end:
+            hour_end = min(end, day_start + (hour + 1) * HOUR)
+            self.hourly[i * 24 + hour] += hour_end - start
+            start = hour_end
+            hour += 1
+
+    def usage(self, start_date, end_date, count):
+        """Returns the row of the days in [start_date, end_date): (busy
+        seconds, count, all-day events per day, busiest weekday, busiest hour).
+        The weekday and the hour are None when nothing is busy.
+        """
+        lo = start_date.toordinal() - self.first
+        hi = end_date.toordinal() - self.first
+        busy = sum(self.busy[lo:hi])
+        if not busy:
+            return busy, count, sum(self.all_day[lo:hi]), None, None
+        # 曜日ごとの合計は7日おきのスライス、時間帯ごとの合計は24個おきのスライス
+        weekdays = [0] * 7
+        for i in range(lo, min(lo + 7, hi)):
+            weekdays[datetime.date.fromordinal(self.first + i).weekday()] = sum(self.busy[i:hi:7])
+        by_hour = [sum(self.hourly[lo * 24 + hour:hi * 24:24]) for hour in range(24)]
+        weekday = max(range(7), key=weekdays.__getitem__)
+        hour = max(range(24), key=by_hour.__getitem__)
+        return busy, count, sum(self.all_day[lo:hi]), weekday, hour
+
+
+def usage_rows(totals, year, month, date, summary_only=False):
+    """Returns (row, path) for the non-empty sub-directories of a year, month
+    or day directory followed by the directory itself, like du.
+    """
+    rows = []
+    if date:
+        day = datetime.date(int(year), int(month), int(date))
+        return [(totals.usage(day, day + datetime.timedelta(days=1), totals.day(day)[0]),
+                 f'{year}/{month}/{date}')]
+    if month:
+        first = datetime.date(int(year), int(month), 1)
+        last = first + datetime.timedelta(days=calendar.monthrange(first.year, first.month)[1])
+        if not summary_only:
+            for ordinal in range(first.toordinal(), last.toordinal()):
+                day = datetime.date.fromordinal(ordinal)
+                if totals.day(day)[0]:
+                    rows.append((totals.usage(day, day + datetime.timedelta(days=1), totals.day(day)[0]),
+                                 f'{year}/{month}/{day.day:02d}'))
+        rows.append((totals.usage(first, last, totals.month(first.year, first.month)[0]), f'{year}/{month}'))
+        return rows
+    first = datetime.date(int(year), 1, 1)
+    if not summary_only:
+        for month_number in range(1, 13):
+            count = totals.month(first.year, month_number)[0]
+            if count:
+                start = datetime.date(first.year, month_number, 1)
+                end = start + datetime.timedelta(days=calendar.monthrange(first.year, month_number)[1])
+                rows.append((totals.usage(start, end, count), f'{year}/{month_number:02d}'))
+    rows.append((totals.usage(first, first.replace(year=first.year + 1), totals.total), str(year)))
+    return rows
+
+
+def format_usage(rows):
+    lines = [USAGE_HEADER]
+    for (busy, count, all_day, weekday, hour), path in rows:
+        weekday = '-' if weekday is None else WEEK_HEADER[weekday]
+        hour = '-' if hour is None else f'{hour:02d}:00'
+        lines.append(f'{hours(busy).rjust(8)} {count:7d} {all_day:7d} {weekday.rjust(7)} {hour.rjust(5)}  {path}')
+    return '\n'.join(lines) + '\n'